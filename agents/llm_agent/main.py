@@ -1,9 +1,11 @@
 # agents/llm_agent/main.py
 
 import os
+import json
 import time
 import threading
 import asyncio
+import random
 from uuid import uuid4
 from datetime import datetime, timezone
 from typing import Optional, Any, Dict, Tuple
@@ -11,12 +13,16 @@ import logging
 
 import requests
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
+from server.a2a_channel import A2A_WEBSOCKET, BrokerChannel
+from server.a2a_chunks import Reensamblador
+from server.a2a_delivery import AckBatcher, ReliableSender, correlation_ids
 from server.a2a_models import A2AMessage, AgentInfo, Envelope
-from utils.model_utils import generar_sql, generar_respuesta
-from requests.exceptions import ReadTimeout
+from server.wire_codec import codec_para
+from utils.model_utils import generar_sql, generar_respuesta, generar_respuesta_stream
+from utils.sql_cache import CacheConsultas
 
 # —————————————————————————————————————————————————————————————————————————————
 app = FastAPI(title="LLM Agent (A2A)")
@@ -33,13 +39,26 @@ CALLBACK_URL   = os.getenv("CALLBACK_URL", "http://llm-agent:8003/inbox")
 FIXED_AGENT_ID = os.getenv("LLM_AGENT_ID")
 # Intervalo de heartbeat en segundos
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
-# Estado de retransmisiones
-pending_acks: Dict[str, Tuple[Envelope, int, float]] = {}
-BASE_ACK_TIMEOUT = 5.0  # s
-MAX_ACK_ATTEMPTS = 3
+# Elección del agente de ventas entre los online: p2c (mejor de dos al azar),
+# least (el de menos peticiones pendientes) o first (el primero, sin carga)
+ROUTING_STRATEGY = os.getenv("ROUTING_STRATEGY", "p2c").lower()
+# Sesión WebSocket opcional con el broker (A2A_WEBSOCKET=1); sin ella, HTTP
+canal = BrokerChannel(MCP_URL, HEARTBEAT_INTERVAL, nombre="LLM Agent") if A2A_WEBSOCKET else None
+# Retransmisiones hasta ACK (A2A_ACK_TIMEOUT, A2A_MAX_ATTEMPTS, A2A_MAX_BACKOFF)
+delivery = ReliableSender(MCP_URL, nombre="LLM Agent", canal=canal)
+# ACKs agrupados por destinatario (ACK_FLUSH_MS, ACK_MAX_BATCH, ACK_MAX_QUEUE)
+acks = AckBatcher(MCP_URL, nombre="LLM Agent", canal=canal)
 
 agent_id: Optional[str] = None
 pending: Dict[str, asyncio.Future] = {}
+# Queries propias aún sin respuesta, por agente de ventas
+en_vuelo: Dict[str, int] = {}
+# Respuestas que llegan troceadas, hasta tener todos sus trozos (A2A_CHUNK_TTL)
+reensamblador = Reensamblador()
+
+# Caché persistente pregunta→SQL y pregunta+datos→respuesta
+# (SQL_CACHE_PATH, SQL_CACHE_MAX_ENTRIES, SQL_CACHE_FUZZY_THRESHOLD, ANSWER_CACHE)
+cache = CacheConsultas()
 
 # —————————————————————————————————————————————————————————————————————————————
 # ENDPOINT DE DIAGNÓSTICO
@@ -49,19 +68,18 @@ def ping():
     logger.info("[LLM Agent] /ping recibido")
     return {"pong": True}
 
-# —————————————————————————————————————————————————————————————————————————————
-# Helper para enviar ACKs
-# —————————————————————————————————————————————————————————————————————————————
-def _send_ack(env_dict: Dict[str, Any]):
-    """
-    Envía un ACK al broker sin bloquear el handler.
-    """
-    try:
-        logger.info(f"[LLM Agent] Lanzando hilo de envío ACK {env_dict['message_id']}")
-        requests.post(f"{MCP_URL}/agent/send", json=env_dict, timeout=15).raise_for_status()
-        logger.info("[LLM Agent] ACK enviado correctamente")
-    except Exception as e:
-        logger.error(f"[LLM Agent] Error enviando ACK: {e}")
+@app.get("/cache/stats")
+def cache_stats():
+    return cache.stats()
+
+@app.get("/a2a/stats")
+def a2a_stats():
+    return {
+        "entrega": delivery.stats(),
+        "acks": acks.stats(),
+        "websocket": canal.stats() if canal is not None else None,
+        "trozos": reensamblador.stats(),
+    }
 
 # —————————————————————————————————————————————————————————————————————————————
 # HILO DE REGISTRO A2A
@@ -100,7 +118,10 @@ def heartbeat_loop():
     # Espera a que el agente esté registrado
     time.sleep(HEARTBEAT_INTERVAL)
     while True:
-        if agent_id:
+        # Con sesión WebSocket abierta los latidos viajan por ella, y si
+        # hubo tráfico en este intervalo el broker ya lo contó como latido
+        reciente = time.time() - max(delivery.ultima_actividad, acks.ultima_actividad) < HEARTBEAT_INTERVAL
+        if agent_id and not reciente and not (canal is not None and canal.connected):
             env = Envelope(
                 version="1.0",
                 message_id=str(uuid4().hex),
@@ -119,49 +140,20 @@ def heartbeat_loop():
         time.sleep(HEARTBEAT_INTERVAL)
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+    await delivery.start()
+    await acks.start()
+    if canal is not None:
+        canal.start(lambda: agent_id, procesar_envelope)
     threading.Thread(target=register_loop, daemon=True).start()
     threading.Thread(target=heartbeat_loop, daemon=True).start()
 
-# —————————————————————————————————————————————————————————————————————————————
-# RETRANSMISIÓN DE MENSAJES A2A SI NO LLEGA ACK
-# —————————————————————————————————————————————————————————————————————————————
-async def send_with_retries(env: Envelope):
-    
-    # Envía un Envelope y, si no llega ACK, lo reintenta con backoff exponencial.
-    envelope_dict = env.model_dump(mode="json")
-    msg_id = env.message_id
-    attempts = 0
-    timeout = BASE_ACK_TIMEOUT
-
-    # Registrar el primer estado
-    pending_acks[msg_id] = (env, attempts, timeout)
-
-    while attempts < MAX_ACK_ATTEMPTS:
-        attempts += 1
-        try:
-            # Envío real
-            requests.post(f"{MCP_URL}/agent/send", json=envelope_dict, timeout=20).raise_for_status()
-            logger.info(f"[LLM Agent] Envío {msg_id}, intento {attempts}")
-        except ReadTimeout:
-            logger.warning(f"[LLM Agent] Primer intento de envío {msg_id} superó timeout... reintentando")
-        except Exception as e:
-            logger.error(f"[LLM Agent] Error enviando {msg_id} (intento {attempts}): {e}")
-
-        # Esperar el timeout antes de posible reintento
-        await asyncio.sleep(timeout)
-
-        # Si ya recibimos ACK, salimos
-        if msg_id not in pending_acks:
-            return
-
-        # Ajustar backoff
-        timeout *= 2
-        pending_acks[msg_id] = (env, attempts, timeout)
-
-    # Si expiraron los intentos
-    logger.error(f"[LLM Agent] No se recibió ACK para {msg_id} tras {MAX_ACK_ATTEMPTS} intentos")
-    pending_acks.pop(msg_id, None)
+@app.on_event("shutdown")
+async def shutdown_event():
+    if canal is not None:
+        await canal.close()
+    await delivery.close()
+    await acks.close()
 
 # —————————————————————————————————————————————————————————————————————————————
 # ESQUEMA DE ENVÍO A2A
@@ -169,30 +161,31 @@ async def send_with_retries(env: Envelope):
 class ConsultaRequest(BaseModel):
     pregunta: str
 
-@app.post("/query")
-async def hacer_consulta(request: Request):
-    # 1) Parsear y validar JSON
+class ConsultaFallida(HTTPException):
+    # 502 porque el MCP no pudo ejecutar el SQL (no por un fallo de entrega)
+    pass
+
+async def _leer_consulta(request: Request) -> ConsultaRequest:
+    # Parsear y validar JSON; 400 si no es {'pregunta': '...'}
     try:
         body = await request.json()
-        req = ConsultaRequest(**body)
+        return ConsultaRequest(**body)
     except Exception:
-        return JSONResponse(
-            status_code=400,
-            content={"error": "JSON inválido. Debe ser {'pregunta':'...'}"}
-        )
-
-    if agent_id is None:
-        raise HTTPException(503, "Aún no registrado en MCP; inténtalo de nuevo en unos segundos.")
-
-    logger.info(f"[LLM Agent] /query recibida: {req.pregunta}")
-    loop = asyncio.get_running_loop()
-
-    # 2) Generar SQL
+        raise HTTPException(400, "JSON inválido. Debe ser {'pregunta':'...'}")
+
+async def _obtener_sql(pregunta: str) -> Tuple[str, bool]:
+    # Generar SQL (o reutilizarlo si la pregunta ya se hizo); True si es nuevo
+    sql = cache.get_sql(pregunta)
+    if sql is not None:
+        logger.info(f"[LLM Agent] SQL desde caché: {sql}")
+        return sql, False
     logger.info("[LLM Agent] empezando a generar consulta…")
-    sql: str = await loop.run_in_executor(None, generar_sql, req.pregunta)
+    sql = await asyncio.get_running_loop().run_in_executor(None, generar_sql, pregunta)
     logger.info(f"[LLM Agent] SQL generado: {sql}")
+    return sql, True
 
-    # 3) Descubrir dinámicamente destinatario mediante Service Cards
+def _elegir_destinatario() -> Tuple[str, Dict[str, Any]]:
+    # Descubrir dinámicamente destinatario mediante Service Cards
     try:
         resp = requests.get(
             f"{MCP_URL}/agent/services",
@@ -209,12 +202,34 @@ async def hacer_consulta(request: Request):
         ]
         if not candidates:
             raise HTTPException(502, "No hay agentes de ventas online")
-        # elegir el primero
-        recipient_id, recipient_card = candidates[0]
+        return _por_carga(candidates)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(502, f"Error resolviendo Service Cards: {e}")
-    
-    # 4) Construir mensaje A2A
+
+def _carga(candidato: Tuple[str, Dict[str, Any]]) -> Tuple[int, float]:
+    # (pendientes, latencia EWMA) según el broker; las queries propias aún
+    # sin reenviar todavía no cuentan allí, así que nunca menos que esas
+    aid, card = candidato
+    load = card.get("load") or {}
+    pendientes = max(load.get("outstanding") or 0, en_vuelo.get(aid, 0))
+    return pendientes, load.get("ewma_latency_ms") or 0.0
+
+def _por_carga(candidates: list) -> Tuple[str, Dict[str, Any]]:
+    if ROUTING_STRATEGY == "first" or len(candidates) == 1:
+        return candidates[0]
+    if ROUTING_STRATEGY == "least":
+        # Empates (p.ej. todos ociosos) al azar para no cargar siempre al mismo
+        random.shuffle(candidates)
+        return min(candidates, key=_carga)
+    # Power of two choices: casi tan bueno como "least" y sin que todas las
+    # consultas simultáneas, que ven las mismas cards, elijan el mismo agente
+    return min(random.sample(candidates, 2), key=_carga)
+
+async def _consultar_ventas(sql: str, recipient_id: str) -> list:
+    # Envía la query A2A al agente de ventas y espera su respuesta
+    loop = asyncio.get_running_loop()
     corr = uuid4().hex
     msg = A2AMessage(
         message_id=corr,
@@ -225,7 +240,7 @@ async def hacer_consulta(request: Request):
         body={"sql": sql, "correlation_id": corr}
     )
 
-    # 5) Envolver en Envelope y enviar al broker
+    # Envolver en Envelope y enviar al broker
     env = Envelope(
         version="1.0",
         message_id=msg.message_id,
@@ -236,34 +251,159 @@ async def hacer_consulta(request: Request):
         payload=msg.model_dump(mode="json")
     )
 
-    pending[corr] = loop.create_future()
+    respuesta = pending[corr] = loop.create_future()
     logger.info(f"[LLM Agent] Enviando envelope A2A a {recipient_id}")
 
-    # 6) Envío con retransmisiones y ACKs
-    await send_with_retries(env)
+    # Envío con retransmisiones y ACKs; si se agotan los intentos (o se
+    # cancela el envío) no tiene sentido seguir esperando la respuesta
+    def _entrega(f: asyncio.Future):
+        if (f.cancelled() or not f.result()) and not respuesta.done():
+            respuesta.set_exception(HTTPException(502, "ventas-agent no confirmó la consulta"))
+    delivery.send(env).add_done_callback(_entrega)
+    en_vuelo[recipient_id] = en_vuelo.get(recipient_id, 0) + 1
 
-    # 7) Esperar respuesta
+    # Esperar respuesta; si llega troceada, el plazo se renueva mientras
+    # sigan llegando trozos
     try:
-        datos = await asyncio.wait_for(pending[corr], timeout=30)
-    except asyncio.TimeoutError:
+        recibidos = 0
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(respuesta), timeout=30)
+            except asyncio.TimeoutError:
+                if reensamblador.recibidos(corr) == recibidos:
+                    raise HTTPException(504, "Timeout esperando respuesta de ventas-agent")
+                recibidos = reensamblador.recibidos(corr)
+    finally:
         pending.pop(corr, None)
-        raise HTTPException(504, "Timeout esperando respuesta de ventas-agent")
+        reensamblador.descartar(corr)
+        if en_vuelo[recipient_id] > 1:
+            en_vuelo[recipient_id] -= 1
+        else:
+            del en_vuelo[recipient_id]
+
+async def _ejecutar_sql(pregunta: str, sql: str, nuevo: bool, recipient_id: str) -> list:
+    # El SQL generado solo se cachea una vez ejecutado sin error, y el que
+    # falla en el MCP sale de la caché aunque viniera de ella
+    try:
+        datos = await _consultar_ventas(sql, recipient_id)
+    except ConsultaFallida:
+        cache.descartar_sql(pregunta, sql)
+        raise
+    if nuevo:
+        cache.put_sql(pregunta, sql)
+    return datos
 
-    # 8) Generar respuesta
-    logger.info("[LLM Agent] empezando a generar respuesta…")
-    respuesta: str = await loop.run_in_executor(None, generar_respuesta, req.pregunta, datos)
-    logger.info("[LLM Agent] terminado generar_respuesta")
+@app.post("/query")
+async def hacer_consulta(request: Request):
+    # 1) Parsear y validar JSON
+    try:
+        req = await _leer_consulta(request)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+
+    if agent_id is None:
+        raise HTTPException(503, "Aún no registrado en MCP; inténtalo de nuevo en unos segundos.")
+
+    logger.info(f"[LLM Agent] /query recibida: {req.pregunta}")
+    loop = asyncio.get_running_loop()
+
+    # 2) Generar SQL
+    sql, nuevo = await _obtener_sql(req.pregunta)
+
+    # 3) Descubrir dinámicamente destinatario mediante Service Cards
+    recipient_id, _ = _elegir_destinatario()
+
+    # 4-7) Query A2A al agente de ventas con retransmisiones y ACKs
+    datos = await _ejecutar_sql(req.pregunta, sql, nuevo, recipient_id)
+
+    # 8) Generar respuesta (o reutilizarla si los datos son los mismos)
+    respuesta = cache.get_respuesta(req.pregunta, datos)
+    if respuesta is None:
+        logger.info("[LLM Agent] empezando a generar respuesta…")
+        respuesta = await loop.run_in_executor(None, generar_respuesta, req.pregunta, datos)
+        cache.put_respuesta(req.pregunta, datos, respuesta)
+        logger.info("[LLM Agent] terminado generar_respuesta")
 
-    pending.pop(corr, None)
     logger.info("[LLM Agent] respuesta final lista")
     return {"sql": sql, "respuesta": respuesta}
 
+# —————————————————————————————————————————————————————————————————————————————
+# CONSULTA CON STREAMING (Server-Sent Events)
+# —————————————————————————————————————————————————————————————————————————————
+def _evento(nombre: str, datos: Dict[str, Any]) -> str:
+    return f"event: {nombre}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/query/stream")
+# Igual que /query, pero emite eventos SSE por etapas (sql, agente, filas) y
+# después los fragmentos de la respuesta (token) según los genera el modelo;
+# termina con 'fin' (o 'error').
+async def hacer_consulta_stream(request: Request):
+    req = await _leer_consulta(request)
+    if agent_id is None:
+        raise HTTPException(503, "Aún no registrado en MCP; inténtalo de nuevo en unos segundos.")
+    logger.info(f"[LLM Agent] /query/stream recibida: {req.pregunta}")
+
+    async def eventos():
+        loop = asyncio.get_running_loop()
+        # Se fija al terminar por cualquier motivo (también si el cliente se
+        # desconecta y se cierra el generador) para parar model.generate
+        cancelar = threading.Event()
+        try:
+            sql, nuevo = await _obtener_sql(req.pregunta)
+            yield _evento("sql", {"sql": sql})
+
+            recipient_id, card = _elegir_destinatario()
+            yield _evento("agente", {"agent_id": recipient_id, "name": card.get("name")})
+
+            datos = await _ejecutar_sql(req.pregunta, sql, nuevo, recipient_id)
+            yield _evento("filas", {"filas": len(datos)})
+
+            respuesta = cache.get_respuesta(req.pregunta, datos)
+            if respuesta is not None:
+                yield _evento("token", {"texto": respuesta})
+            else:
+                partes = []
+                fragmentos = await loop.run_in_executor(
+                    None, generar_respuesta_stream, req.pregunta, datos, cancelar
+                )
+                while True:
+                    texto = await loop.run_in_executor(None, next, fragmentos, None)
+                    if texto is None:
+                        break
+                    if texto:
+                        partes.append(texto)
+                        yield _evento("token", {"texto": texto})
+                respuesta = "".join(partes).strip()
+                cache.put_respuesta(req.pregunta, datos, respuesta)
+            yield _evento("fin", {"sql": sql, "respuesta": respuesta})
+        except HTTPException as e:
+            yield _evento("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.error(f"[LLM Agent] error en /query/stream: {e}")
+            yield _evento("error", {"status": 500, "detail": str(e)})
+        finally:
+            cancelar.set()
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
 # —————————————————————————————————————————————————————————————————————————————
 # RECEPCIÓN DE MENSAJES A2A
 # —————————————————————————————————————————————————————————————————————————————
+async def _leer_envelope(request: Request) -> Envelope:
+    # El cuerpo viene en el codec que indique Content-Type (JSON o MessagePack)
+    try:
+        obj = codec_para(request.headers.get("content-type")).decode(await request.body())
+        return Envelope.model_validate(obj)
+    except Exception as e:
+        raise HTTPException(422, f"Envelope inválido: {e}")
+
 @app.post("/inbox")
-# Recibe un Envelope A2A. 
-async def inbox(env: Envelope):
+# Recibe un Envelope A2A por HTTP (callback del broker)
+async def inbox(request: Request):
+    return await procesar_envelope(await _leer_envelope(request))
+
+# Procesa un Envelope A2A, llegue por /inbox o por la sesión WebSocket
+async def procesar_envelope(env: Envelope):
     # Ignorar los heartbeats
     if env.type == "heartbeat":
         logger.info(f"[Ventas Agent] heartbeat recibido de {env.sender}")
@@ -273,10 +413,9 @@ async def inbox(env: Envelope):
     if env.type == "ack":
         try:
             ack_msg = A2AMessage.model_validate(env.payload)
-            corr = ack_msg.body.get("correlation_id")
-            if corr in pending_acks:
-                pending_acks.pop(corr)
-                logger.info(f"[LLM Agent] ACK de {corr} recibido, cancelando retransmisiones.")
+            for corr in correlation_ids(ack_msg):
+                if delivery.ack(corr):
+                    logger.info(f"[LLM Agent] ACK de {corr} recibido, cancelando retransmisiones.")
         except Exception as e:
             logger.warning(f"[LLM Agent] ACK recibido mal formado: {e}")
         return {"status": "ack recibido"}
@@ -287,32 +426,19 @@ async def inbox(env: Envelope):
     corr = msg.body.get("correlation_id")
     logger.info(f"[LLM Agent] inbox recibido correlation_id={corr} (pending={list(pending.keys())})")
     
-    # 2) Envía ACK inmediato al recibir un Envelope
-    ack_msg = A2AMessage(
-        message_id=str(uuid4().hex),
-        sender=agent_id,
-        recipient=env.sender,
-        timestamp=datetime.now(timezone.utc),
-        type="ack",
-        body={"status": "received", "correlation_id": env.message_id}
-    )
-    ack_env = Envelope(
-        version="1.0",
-        message_id=ack_msg.message_id,
-        timestamp=datetime.now(timezone.utc),
-        type="ack",
-        sender=ack_msg.sender,
-        recipient=ack_msg.recipient,
-        payload=ack_msg.model_dump(mode="json")
-    )
-    
-    env_dict = ack_env.model_dump(mode="json")
-    threading.Thread(target=_send_ack, args=(env_dict,), daemon=True).start()
+    # 2) Envía ACK inmediato al recibir un Envelope (agrupado, en segundo plano)
+    acks.ack(agent_id, env.sender, env.message_id)
     
     if msg.type == "response" and corr in pending:
         fut = pending[corr]
         if not fut.done():
-            fut.set_result(msg.body.get("resultado", []))
+            body = reensamblador.agregar(msg.body)
+            if body is None:
+                return {"status": "parcial"}
+            if "error" in body:
+                fut.set_exception(ConsultaFallida(502, f"La consulta falló en el MCP: {body['error']}"))
+            else:
+                fut.set_result(body.get("resultado", []))
             return {"status": "ok"}
         
     return {"status": "ignored"}
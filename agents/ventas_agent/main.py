@@ -1,5 +1,6 @@
 # agents/ventas_agent/main.py
 
+import asyncio
 import threading
 import time
 import os
@@ -7,12 +8,13 @@ import requests
 from uuid import uuid4
 from datetime import datetime, timezone
 import logging
-from typing import Optional, Dict, Tuple, Any
-from fastapi import FastAPI, HTTPException
+from typing import Optional, Dict, Any, Set
+from fastapi import FastAPI, HTTPException, Request
+from server.a2a_channel import A2A_WEBSOCKET, BrokerChannel
+from server.a2a_chunks import A2A_CHUNK_ROWS, VentanaEnvio
+from server.a2a_delivery import AckBatcher, ReliableSender, correlation_ids
 from server.a2a_models import A2AMessage, AgentInfo, Envelope
-from requests.exceptions import ReadTimeout
-
-import asyncio
+from server.wire_codec import codec_para
 
 # —————————————————————————————————————————————————————————————————————————————
 app = FastAPI(title="Ventas Agent (A2A)")
@@ -27,28 +29,24 @@ MCP_URL = os.getenv("MCP_URL", "http://mcp-server:8000")
 FIXED_AGENT_ID = os.getenv("VENTAS_AGENT_ID")
 # Intervalo de heartbeat en segundos
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
+# Segundos esperando a /tool/consulta; al MCP se le pide cancelar la consulta
+# un segundo antes para no dejarla ejecutándose cuando ya no se espera
+CONSULTA_TIMEOUT = float(os.getenv("CONSULTA_TIMEOUT", "10"))
+# Filas máximas de una respuesta, sumando todas sus páginas
+CONSULTA_MAX_FILAS = int(os.getenv("CONSULTA_MAX_FILAS", "50000"))
 
-# Estado de retransmisiones: message_id → (Envelope, attempts, next_timeout)
-pending_acks: Dict[str, Tuple[Envelope, int, float]] = {}
-BASE_ACK_TIMEOUT = 5.0    # segundos antes del primer reintento
-MAX_ACK_ATTEMPTS = 3      # máximo de envíos por mensaje
+# Sesión WebSocket opcional con el broker (A2A_WEBSOCKET=1); sin ella, HTTP
+canal = BrokerChannel(MCP_URL, HEARTBEAT_INTERVAL, nombre="Ventas Agent") if A2A_WEBSOCKET else None
+# Retransmisiones hasta ACK (A2A_ACK_TIMEOUT, A2A_MAX_ATTEMPTS, A2A_MAX_BACKOFF)
+delivery = ReliableSender(MCP_URL, nombre="Ventas Agent", canal=canal)
+# ACKs agrupados por destinatario (ACK_FLUSH_MS, ACK_MAX_BATCH, ACK_MAX_QUEUE)
+acks = AckBatcher(MCP_URL, nombre="Ventas Agent", canal=canal)
 
 # Se almacenará aquí el agent_id tras registrarse
 agent_id: Optional[str] = None
+# Respuestas troceadas que siguen paginando en segundo plano
+_envios_troceados: Set[asyncio.Task] = set()
 
-# —————————————————————————————————————————————————————————————————————————————
-# Helper para enviar ACKs
-# —————————————————————————————————————————————————————————————————————————————
-def _send_ack(env_dict: Dict[str, Any]):
-    """
-    Envía un ACK al broker sin bloquear el handler.
-    """
-    try:
-        logger.info(f"[LLM Agent] Lanzando hilo de envío ACK {env_dict['message_id']}")
-        requests.post(f"{MCP_URL}/agent/send", json=env_dict, timeout=15).raise_for_status()
-        logger.info("[Ventas Agent] ACK enviado correctamente")
-    except Exception as e:
-        logger.error(f"[Ventas Agent] Error enviando ACK: {e}")
 # —————————————————————————————————————————————————————————————————————————————
 # HILO DE REGISTRO A2A
 # —————————————————————————————————————————————————————————————————————————————
@@ -90,7 +88,10 @@ def heartbeat_loop():
     # Espera a que el agente esté registrado
     time.sleep(HEARTBEAT_INTERVAL)
     while True:
-        if agent_id:
+        # Con sesión WebSocket abierta los latidos viajan por ella, y si
+        # hubo tráfico en este intervalo el broker ya lo contó como latido
+        reciente = time.time() - max(delivery.ultima_actividad, acks.ultima_actividad) < HEARTBEAT_INTERVAL
+        if agent_id and not reciente and not (canal is not None and canal.connected):
             env = Envelope(
                 version="1.0",
                 message_id=str(uuid4().hex),
@@ -106,59 +107,50 @@ def heartbeat_loop():
                 requests.post(f"{MCP_URL}/agent/heartbeat", json=j, timeout=3).raise_for_status()
             except:
                 pass
-        time.sleep(30)
+        time.sleep(HEARTBEAT_INTERVAL)
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+    await delivery.start()
+    await acks.start()
+    if canal is not None:
+        canal.start(lambda: agent_id, procesar_envelope)
     threading.Thread(target=register_loop, daemon=True).start()
     threading.Thread(target=heartbeat_loop, daemon=True).start()
 
-# —————————————————————————————————————————————————————————————————————————————
-# RETRANSMISIÓN DE MENSAJES A2A SI NO LLEGA ACK
-# —————————————————————————————————————————————————————————————————————————————
-async def send_with_retries(env: Envelope):
-    
-    # Envía un Envelope y, si no llega ACK, lo reintenta con backoff exponencial.
-    envelope_dict = env.model_dump(mode="json")
-    msg_id = env.message_id
-    attempts = 0
-    timeout = BASE_ACK_TIMEOUT
+@app.on_event("shutdown")
+async def shutdown_event():
+    if canal is not None:
+        await canal.close()
+    await delivery.close()
+    await acks.close()
 
-    # Registrar el primer estado
-    pending_acks[msg_id] = (env, attempts, timeout)
-
-    while attempts < MAX_ACK_ATTEMPTS:
-        attempts += 1
-        try:
-            # Envío real
-            requests.post(f"{MCP_URL}/agent/send", json=envelope_dict, timeout=20).raise_for_status()
-            logger.info(f"[LLM Agent] Envío {msg_id}, intento {attempts}")
-        except ReadTimeout:
-            logger.warning(f"[LLM Agent] Primer intento de envío {msg_id} superó timeout... reintentando")
-        except Exception as e:
-            logger.error(f"[LLM Agent] Error enviando {msg_id} (intento {attempts}): {e}")
-
-        # Esperar el timeout antes de posible reintento
-        await asyncio.sleep(timeout)
-
-        # Si ya recibimos ACK, salimos
-        if msg_id not in pending_acks:
-            return
-
-        # Ajustar backoff
-        timeout *= 2
-        pending_acks[msg_id] = (env, attempts, timeout)
-
-    # Si expiraron los intentos
-    logger.error(f"[LLM Agent] No se recibió ACK para {msg_id} tras {MAX_ACK_ATTEMPTS} intentos")
-    pending_acks.pop(msg_id, None)
+@app.get("/a2a/stats")
+def a2a_stats():
+    return {
+        "entrega": delivery.stats(),
+        "acks": acks.stats(),
+        "websocket": canal.stats() if canal is not None else None,
+    }
 
 # —————————————————————————————————————————————————————————————————————————————
 # RECEPCIÓN DE MENSAJES A2A
 # —————————————————————————————————————————————————————————————————————————————
+async def _leer_envelope(request: Request) -> Envelope:
+    # El cuerpo viene en el codec que indique Content-Type (JSON o MessagePack)
+    try:
+        obj = codec_para(request.headers.get("content-type")).decode(await request.body())
+        return Envelope.model_validate(obj)
+    except Exception as e:
+        raise HTTPException(422, f"Envelope inválido: {e}")
+
 @app.post("/inbox")
-# Recibe un Envelope A2A
-async def inbox(env: Envelope):
+# Recibe un Envelope A2A por HTTP (callback del broker)
+async def inbox(request: Request):
+    return await procesar_envelope(await _leer_envelope(request))
+
+# Procesa un Envelope A2A, llegue por /inbox o por la sesión WebSocket
+async def procesar_envelope(env: Envelope):
     # Ignorar los heartbeats
     if env.type == "heartbeat":
         logger.info(f"[Ventas Agent] heartbeat recibido de {env.sender}")
@@ -168,10 +160,9 @@ async def inbox(env: Envelope):
     if env.type == "ack":
         try:
             ack_msg = A2AMessage.model_validate(env.payload)
-            corr = ack_msg.body.get("correlation_id")
-            if corr in pending_acks:
-                pending_acks.pop(corr)
-                logger.info(f"[Ventas Agent] ACK recibido para mensaje {corr}, cancelando retransmisiones.")
+            for corr in correlation_ids(ack_msg):
+                if delivery.ack(corr):
+                    logger.info(f"[Ventas Agent] ACK recibido para mensaje {corr}, cancelando retransmisiones.")
         except Exception as e:
             logger.warning(f"[Ventas Agent] ACK mal formado: {e}")
         return {"status": "ack recibido"}
@@ -184,65 +175,93 @@ async def inbox(env: Envelope):
         logger.error(f"[Ventas Agent] error validando A2AMessage: {e}")
         raise HTTPException(400, f"Payload inválido: {e}")
     
-    # 2) Envía ACK inmediato al recibir un Envelope
-    ack_msg = A2AMessage(
-        message_id=str(uuid4()),
-        sender=agent_id,
-        recipient=env.sender,
-        timestamp=datetime.now(timezone.utc),
-        type="ack",
-        body={
-            "status": "received",
-            "correlation_id": env.message_id
-        }
-    )
-    ack_env = Envelope(
-        version="1.0",
-        message_id=ack_msg.message_id,
-        timestamp=datetime.now(timezone.utc),
-        type="ack",
-        sender=ack_msg.sender,
-        recipient=ack_msg.recipient,
-        payload=ack_msg.model_dump(mode="json")
-    )
-    env_dict = ack_env.model_dump(mode="json")
-    threading.Thread(target=_send_ack, args=(env_dict,), daemon=True).start()
+    # 2) Envía ACK inmediato al recibir un Envelope (agrupado, en segundo plano)
+    acks.ack(agent_id, env.sender, env.message_id)
 
     # 3) Validar que es una query
     if msg.type != "query" or "sql" not in msg.body or "correlation_id" not in msg.body:
         raise HTTPException(400, "Mensaje inválido: debe incluir type='query', body.sql y body.correlation_id")
 
-    # 4) Ejecutar consulta SQL vía MCP/tool/consulta
+    # 4) Ejecutar consulta SQL vía MCP/tool/consulta, por páginas de
+    # A2A_CHUNK_ROWS filas: la primera aquí y el resto en segundo plano.
+    # La query ya está aceptada: un fallo viaja en la respuesta ("error"),
+    # no como 5xx, que haría al broker repetir la entrega y la consulta
     sql = msg.body["sql"]
     corr = msg.body["correlation_id"]
     logger.info(f"[Ventas Agent] consulta recibida (corr={corr}): {sql}")
     try:
-        tool_resp = requests.get(
-            f"{MCP_URL}/tool/consulta",
-            params={"sql": sql},
-            timeout=10
-        )
-        tool_resp.raise_for_status()
+        datos = await _pagina(sql)
     except Exception as e:
-        raise HTTPException(502, f"Error llamando al MCP/tool: {e}")
+        logger.error(f"[Ventas Agent] error llamando al MCP/tool (corr={corr}): {e}")
+        datos = {"error": f"Error llamando al MCP/tool: {e}"}
+
+    # 5-7) Cada página viaja en su propio envelope (secuencia, ultimo) bajo
+    # el mismo correlation_id, con retransmisiones y ACKs por trozo
+    ventana = VentanaEnvio(delivery)
+    cursor = datos.get("cursor")
+    logger.info(f"[Ventas Agent] reenviando respuesta A2A (corr={corr}) a broker")
+    await ventana.enviar(_trozo(msg.sender, corr, 0, datos, ultimo=not cursor))
+    if cursor:
+        tarea = asyncio.create_task(_enviar_resto(sql, corr, msg.sender, cursor, datos, ventana))
+        _envios_troceados.add(tarea)
+        tarea.add_done_callback(_envios_troceados.discard)
+
+    return {"status": "ok"}
+
+async def _pagina(sql: str, cursor: Optional[str] = None) -> Dict[str, Any]:
+    # Una página de /tool/consulta, sin bloquear el event loop
+    params = {"sql": sql, "timeout": max(1.0, CONSULTA_TIMEOUT - 1), "pagina": A2A_CHUNK_ROWS}
+    if cursor:
+        params["cursor"] = cursor
+    resp = await asyncio.to_thread(
+        requests.get, f"{MCP_URL}/tool/consulta", params=params, timeout=CONSULTA_TIMEOUT
+    )
+    resp.raise_for_status()
+    return resp.json()
 
-    resultados = tool_resp.json().get("resultado", [])
+async def _enviar_resto(sql: str, corr: str, destino: str, cursor: str,
+                        datos: Dict[str, Any], ventana: VentanaEnvio):
+    # Pide las páginas siguientes mientras haya cursor; un error llega al
+    # receptor como último trozo, con "error"
+    filas = len(datos.get("resultado", []))
+    secuencia = 1
+    while cursor:
+        try:
+            datos = await _pagina(sql, cursor)
+        except Exception as e:
+            datos = {"error": f"Error llamando al MCP/tool: {e}"}
+        cursor = datos.get("cursor")
+        resultado = datos.get("resultado", [])
+        if cursor and filas + len(resultado) >= CONSULTA_MAX_FILAS:
+            datos["resultado"] = resultado[:CONSULTA_MAX_FILAS - filas]
+            datos.setdefault("meta", {})["truncado"] = True
+            cursor = None
+        filas += len(datos.get("resultado", []))
+        if not await ventana.enviar(_trozo(destino, corr, secuencia, datos, ultimo=not cursor)):
+            logger.error(f"[Ventas Agent] trozo de la respuesta {corr} perdido, no se envía el resto")
+            return
+        secuencia += 1
+    if await ventana.cerrar():
+        logger.info(f"[Ventas Agent] respuesta {corr} enviada en {secuencia} trozos ({filas} filas)")
 
-    # 5) Construir A2AMessage de respuesta
+def _trozo(destino: str, corr: str, secuencia: int, datos: Dict[str, Any], ultimo: bool) -> Envelope:
+    # Construir A2AMessage de respuesta y envolverlo en un Envelope
     reply = A2AMessage(
         message_id=str(uuid4()),
         sender=agent_id,
-        recipient=msg.sender,
+        recipient=destino,
         timestamp=datetime.now(timezone.utc),
         type="response",
         body={
-            "resultado": resultados,
-            "correlation_id": corr
+            "resultado": datos.get("resultado", []),
+            "correlation_id": corr,
+            "secuencia": secuencia,
+            "ultimo": ultimo,
+            # Límites aplicados, truncado/cancelación y error de la consulta
+            **{k: datos[k] for k in ("meta", "error") if k in datos}
         }
     )
-
-    # 6) Envolver en Envelope y reenviar al broker
-    env_out = Envelope(
+    return Envelope(
         version="1.0",
         message_id=reply.message_id,
         timestamp=datetime.now(timezone.utc),
@@ -251,9 +270,3 @@ async def inbox(env: Envelope):
         recipient=reply.recipient,
         payload=reply.model_dump(mode="json")
     )
-    logger.info(f"[Ventas Agent] reenviando respuesta A2A (corr={corr}) a broker")
-    
-    # 7) Envío con retransmisiones y ACKs
-    await send_with_retries(env_out)
-
-    return {"status": "ok"}
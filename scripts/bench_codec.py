@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+scripts/bench_codec.py
+
+Micro-benchmark del coste por envelope en cada salto A2A:
+  - encode: el emisor serializa el envelope
+  - route:  el broker obtiene los campos de enrutado y lo persiste/reenvía
+  - decode: el receptor lo decodifica y valida (Envelope + A2AMessage)
+
+Compara el camino anterior (pydantic + jsonable_encoder + json estándar en
+el broker) con los codecs de server/wire_codec.py (orjson y MessagePack),
+en los que el broker solo lee la cabecera y reenvía los bytes tal cual.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+from uuid import uuid4
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fastapi.encoders import jsonable_encoder
+
+from server.a2a_models import A2AMessage, Envelope
+from server.wire_codec import CODECS, cabecera
+
+
+def envelope_respuesta(filas: int) -> dict:
+    # Respuesta típica de ventas_agent con `filas` filas de resultado
+    resultado = [
+        {"fecha": f"2024-04-{1 + i % 28:02d}", "producto": "Router X",
+         "cantidad": i % 7 + 1, "precio": 99.5}
+        for i in range(filas)
+    ]
+    msg = A2AMessage(
+        message_id=uuid4().hex, sender="ventas", recipient="llm",
+        timestamp=datetime.now(timezone.utc), type="response",
+        body={"resultado": resultado, "correlation_id": uuid4().hex},
+    )
+    env = Envelope(
+        message_id=msg.message_id, timestamp=datetime.now(timezone.utc), type=msg.type,
+        sender=msg.sender, recipient=msg.recipient, payload=msg.model_dump(mode="json"),
+    )
+    return env.model_dump(mode="json")
+
+
+def medir(fn, n: int) -> float:
+    # µs por llamada
+    t = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t) / n * 1e6
+
+
+def recibir(obj: dict):
+    env = Envelope.model_validate(obj)
+    return A2AMessage.model_validate(env.payload)
+
+
+def bench_pydantic(obj: dict, n: int) -> dict:
+    # Camino anterior: el broker valida el Envelope, lo pasa por
+    # jsonable_encoder y lo vuelve a serializar para reenviarlo
+    datos = json.dumps(obj).encode()
+
+    def broker():
+        env = Envelope.model_validate(json.loads(datos))
+        return json.dumps(jsonable_encoder(env)).encode()
+
+    return {
+        "encode": medir(lambda: json.dumps(obj).encode(), n),
+        "route": medir(broker, n),
+        "decode": medir(lambda: recibir(json.loads(datos)), n),
+        "bytes": len(datos),
+    }
+
+
+def bench_codec(nombre: str, obj: dict, n: int) -> dict:
+    codec = CODECS[nombre]
+    datos = codec.encode(obj)
+    return {
+        "encode": medir(lambda: codec.encode(obj), n),
+        "route": medir(lambda: cabecera(codec.decode(datos)), n),
+        "decode": medir(lambda: recibir(codec.decode(datos)), n),
+        "bytes": len(datos),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de codecs de envelopes A2A")
+    parser.add_argument("--filas", type=int, nargs="+", default=[0, 10, 100, 1000])
+    parser.add_argument("-n", type=int, default=2000, help="repeticiones por medida")
+    args = parser.parse_args()
+
+    print(f"{'filas':>6} {'camino':14} {'encode µs':>10} {'route µs':>10} "
+          f"{'decode µs':>10} {'total µs':>10} {'bytes':>8}")
+    for filas in args.filas:
+        obj = envelope_respuesta(filas)
+        n = max(50, args.n // max(1, filas // 10))
+        resultados = [("pydantic+json", bench_pydantic(obj, n))]
+        resultados += [(nombre, bench_codec(nombre, obj, n)) for nombre in CODECS]
+        for camino, r in resultados:
+            total = r["encode"] + r["route"] + r["decode"]
+            print(f"{filas:>6} {camino:14} {r['encode']:>10.1f} {r['route']:>10.1f} "
+                  f"{r['decode']:>10.1f} {total:>10.1f} {r['bytes']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+scripts/bench_inference.py
+
+Benchmark de las precisiones de inferencia de TinyLlama en CPU (fp32, bf16,
+int8): tokens/s, memoria residente y exact-match del SQL generado sobre un
+conjunto fijo de preguntas. Cada modo se ejecuta en un subproceso propio
+para que la memoria medida sea solo la de ese modo.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+RAIZ = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Metadatos fijos: el benchmark no depende de que el MCP esté levantado
+PRODUCTOS = ["Router X", "Switch Y", "Firewall Z"]
+FECHAS = ("2024-04-01", "2024-04-03")
+
+PREGUNTAS = [
+    ("¿Cuántas unidades de Router X se vendieron en total?",
+     "SELECT SUM(cantidad) FROM iceberg_space.ventas WHERE producto = 'Router X';"),
+    ("¿Cuál es el importe total de ventas?",
+     "SELECT SUM(cantidad * precio) FROM iceberg_space.ventas;"),
+    ("¿Cuántas ventas hubo el 2024-04-01?",
+     "SELECT COUNT(*) FROM iceberg_space.ventas WHERE fecha = '2024-04-01';"),
+    ("¿Qué productos se vendieron?",
+     "SELECT DISTINCT producto FROM iceberg_space.ventas;"),
+    ("¿Cuál es el precio máximo de Firewall Z?",
+     "SELECT MAX(precio) FROM iceberg_space.ventas WHERE producto = 'Firewall Z';"),
+    ("Unidades vendidas por producto",
+     "SELECT producto, SUM(cantidad) FROM iceberg_space.ventas GROUP BY producto;"),
+]
+
+
+def normalizar(sql: str) -> str:
+    return re.sub(r"\s+", " ", sql.strip().rstrip(";")).lower()
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for linea in f:
+            if linea.startswith("VmRSS:"):
+                return int(linea.split()[1]) / 1024
+    return 0.0
+
+
+def hijo(modo: str, semilla: int):
+    # Ejecuta un modo en este proceso y escribe el resultado como JSON
+    os.environ["INFERENCE_PRECISION"] = modo
+    os.environ["GEN_BATCHING"] = "0"
+    sys.path.insert(0, RAIZ)
+
+    t0 = time.perf_counter()
+    import torch
+    from utils import model_utils
+    carga_s = time.perf_counter() - t0
+    rss_carga = rss_mb()
+
+    model_utils.extraer_info_tabla = lambda: (PRODUCTOS, *FECHAS)
+
+    contador = {"tokens": 0, "segundos": 0.0}
+    generate_original = model_utils.model.generate
+
+    def generate_medido(*args, **kwargs):
+        t = time.perf_counter()
+        output = generate_original(*args, **kwargs)
+        contador["segundos"] += time.perf_counter() - t
+        contador["tokens"] += output.shape[1] - kwargs["input_ids"].shape[1]
+        return output
+
+    model_utils.model.generate = generate_medido
+
+    aciertos = 0
+    for pregunta, esperado in PREGUNTAS:
+        torch.manual_seed(semilla)
+        sql = model_utils.generar_sql(pregunta)
+        aciertos += normalizar(sql) == normalizar(esperado)
+
+    print(json.dumps({
+        "modo": modo,
+        "precision_efectiva": model_utils.precision,
+        "hilos": torch.get_num_threads(),
+        "carga_s": round(carga_s, 2),
+        "rss_mb": round(rss_carga, 1),
+        "pico_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tokens": contador["tokens"],
+        "tokens_s": round(contador["tokens"] / contador["segundos"], 2) if contador["segundos"] else 0.0,
+        "exact_match": f"{aciertos}/{len(PREGUNTAS)}",
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de precisiones de inferencia")
+    parser.add_argument("--modos", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--hijo", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        hijo(args.hijo, args.semilla)
+        return
+
+    print(f"{'modo':6} {'efectiva':9} {'hilos':>5} {'carga s':>8} {'RSS MB':>8} "
+          f"{'pico MB':>8} {'tokens':>7} {'tok/s':>8} {'exact':>6}")
+    for modo in args.modos:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--hijo", modo, "--semilla", str(args.semilla)],
+            capture_output=True, text=True, env=os.environ.copy(),
+        )
+        lineas = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+        if proc.returncode != 0 or not lineas:
+            error = (proc.stderr.strip().splitlines() or ["sin salida"])[-1]
+            print(f"{modo:6} ERROR: {error}")
+            continue
+        r = json.loads(lineas[-1])
+        print(f"{r['modo']:6} {r['precision_efectiva']:9} {r['hilos']:>5} {r['carga_s']:>8} "
+              f"{r['rss_mb']:>8} {r['pico_rss_mb']:>8} {r['tokens']:>7} {r['tokens_s']:>8} "
+              f"{r['exact_match']:>6}")
+
+
+if __name__ == "__main__":
+    main()
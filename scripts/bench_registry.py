@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+scripts/bench_registry.py
+
+Benchmark del registro de agentes del broker: compara las búsquedas por
+capacidad del AgentRegistry indexado con el recorrido completo del dict
+AGENTS que hacían antes /agent/discover y /agent/services.
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+from registry import AgentRegistry  # noqa: E402
+
+
+def escaneo_lineal(agents, service, ttl, now):
+    # Réplica de la lógica previa: filtra y recalcula 'online' para cada agente
+    results = {}
+    for aid, info in agents.items():
+        caps = info.get("capabilities", {})
+        if caps.get("tool") != service and caps.get("role") != service:
+            continue
+        last = info.get("last_heartbeat")
+        results[aid] = bool(last and (now - last).total_seconds() < ttl)
+    return results
+
+
+def cronometrar(fn, repeticiones):
+    t0 = time.perf_counter()
+    for _ in range(repeticiones):
+        fn()
+    return (time.perf_counter() - t0) / repeticiones * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del registro de agentes")
+    parser.add_argument("--agentes", type=int, default=10000, help="Agentes registrados")
+    parser.add_argument("--servicios", type=int, default=100, help="Valores distintos de 'tool'")
+    parser.add_argument("--repeticiones", type=int, default=200)
+    args = parser.parse_args()
+
+    ttl = 60
+    registry = AgentRegistry(ttl_seconds=ttl)
+    now = datetime.now(timezone.utc)
+
+    t0 = time.perf_counter()
+    for i in range(args.agentes):
+        aid = f"agent-{i}"
+        registry.register({
+            "agent_id": aid,
+            "name": aid,
+            "callback_url": f"http://agent-{i}:8000/inbox",
+            "capabilities": {"tool": f"servicio_{i % args.servicios}", "role": "worker"},
+        })
+        # La mitad de los agentes con latido reciente, la otra mitad caducados
+        latido = now if i % 2 == 0 else now - timedelta(seconds=2 * ttl)
+        registry.heartbeat(aid, latido)
+    alta_us = (time.perf_counter() - t0) / args.agentes * 1e6
+
+    servicio = "servicio_7"
+    esperado = escaneo_lineal(registry.agents, servicio, ttl, now)
+    indexado = {aid: registry.is_online(aid) for aid in registry.find_any(servicio, ("tool", "role"))}
+    assert esperado == indexado, "El registro indexado no coincide con el escaneo lineal"
+
+    lineal_us = cronometrar(
+        lambda: escaneo_lineal(registry.agents, servicio, ttl, datetime.now(timezone.utc)),
+        args.repeticiones,
+    )
+    indice_us = cronometrar(
+        lambda: {aid: registry.is_online(aid) for aid in registry.find_any(servicio, ("tool", "role"))},
+        args.repeticiones,
+    )
+    discover_us = cronometrar(
+        lambda: registry.find(role="worker", tool=servicio),
+        args.repeticiones,
+    )
+
+    print(f"Agentes registrados:          {args.agentes}")
+    print(f"Coincidencias por servicio:   {len(esperado)}")
+    print(f"Alta + latido por agente:     {alta_us:10.2f} µs")
+    print(f"/agent/services (lineal):     {lineal_us:10.2f} µs")
+    print(f"/agent/services (indexado):   {indice_us:10.2f} µs")
+    print(f"/agent/discover (indexado):   {discover_us:10.2f} µs")
+    print(f"Aceleración services:         {lineal_us / indice_us:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,60 @@ scripts/cli.py
 
 Cliente de línea de comandos para enviar preguntas al LLM-Agent
 y mostrar en consola el SQL generado y la respuesta.
+Con --stream la respuesta se imprime a medida que se genera (SSE).
 """
 
 import os
 import sys
+import json
 import argparse
 import requests
 import textwrap
 
+def eventos_sse(resp):
+    """
+    Itera (evento, datos) de una respuesta text/event-stream.
+    """
+    evento, datos = "message", []
+    for linea in resp.iter_lines(decode_unicode=True):
+        if linea is None:
+            continue
+        if not linea:
+            if datos:
+                yield evento, json.loads("\n".join(datos))
+            evento, datos = "message", []
+        elif linea.startswith("event:"):
+            evento = linea[len("event:"):].strip()
+        elif linea.startswith("data:"):
+            datos.append(linea[len("data:"):].strip())
+
+def consulta_stream(endpoint: str, payload: dict):
+    try:
+        resp = requests.post(f"{endpoint}/stream", json=payload, stream=True, timeout=(10, 200))
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        print(f"❌ Error conectando al LLM-Agent: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    resp.encoding = "utf-8"
+    for evento, datos in eventos_sse(resp):
+        if evento == "sql":
+            print("\n--- SQL generado ---")
+            print(datos["sql"])
+        elif evento == "agente":
+            print(f"\n→ Agente de ventas: {datos.get('name')} ({datos['agent_id']})")
+        elif evento == "filas":
+            print(f"→ Filas recibidas: {datos['filas']}")
+            print("\n--- Respuesta LLM ---")
+            print("  ", end="", flush=True)
+        elif evento == "token":
+            print(datos["texto"].replace("\n", "\n  "), end="", flush=True)
+        elif evento == "fin":
+            print()
+        elif evento == "error":
+            print(f"\n❌ Error {datos.get('status')}: {datos.get('detail')}", file=sys.stderr)
+            sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Enviar una pregunta en lenguaje natural al LLM-Agent"
@@ -26,12 +72,21 @@ def main():
         default=os.getenv("LLM_AGENT_URL", "http://localhost:8003"),
         help="URL base del LLM-Agent (p.ej. http://llm-agent:8003)"
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Mostrar etapas y respuesta a medida que se generan (/query/stream)"
+    )
     args = parser.parse_args()
 
     q = " ".join(args.pregunta).strip()
     endpoint = f"{args.url.rstrip('/')}/query"
     payload = {"pregunta": q}
 
+    if args.stream:
+        consulta_stream(endpoint, payload)
+        return
+
     try:
         resp = requests.post(endpoint, json=payload, timeout=200)
         resp.raise_for_status()
@@ -0,0 +1,174 @@
+# server/a2a_channel.py
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from uuid import uuid4
+
+import websockets
+
+from server.a2a_models import Envelope
+from server.wire_codec import CODECS, Codec, codec as codec_por_nombre
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# 1 = mantener una sesión WebSocket con el broker (el HTTP queda de respaldo)
+A2A_WEBSOCKET = os.getenv("A2A_WEBSOCKET", "0") == "1"
+# Espera máxima (s) entre intentos de reconexión
+A2A_WS_RECONNECT_MAX = float(os.getenv("A2A_WS_RECONNECT_MAX", "30"))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class BrokerChannel:
+    """
+    Sesión WebSocket persistente de un agente con el broker
+    (/agent/ws/{agent_id}).
+
+    Por la misma conexión viajan, como envelopes codificados (JSON en frames
+    de texto, MessagePack en binarios), los mensajes que el
+    agente envía (query, response, ack), sus heartbeats y lo que el broker
+    le entrega, que se pasa a `on_envelope` igual que si llegara a /inbox.
+    send() devuelve False si no hay sesión abierta: el llamante usa
+    entonces el camino HTTP de siempre. La conexión se restablece sola con
+    backoff exponencial.
+    """
+
+    def __init__(self, broker_url: str, heartbeat_interval: float,
+                 nombre: str = "A2A", reconnect_max: float = A2A_WS_RECONNECT_MAX):
+        base = broker_url.rstrip("/")
+        if base.startswith("https://"):
+            base = "wss://" + base[len("https://"):]
+        elif base.startswith("http://"):
+            base = "ws://" + base[len("http://"):]
+        self.ws_base = f"{base}/agent/ws"
+        self.heartbeat_interval = heartbeat_interval
+        self.nombre = nombre
+        self.reconnect_max = reconnect_max
+        self._ws = None
+        self._lock = asyncio.Lock()
+        self._tarea: Optional[asyncio.Task] = None
+        self._recepciones: Set[asyncio.Task] = set()
+        self.codec = codec_por_nombre()
+        self.enviados = 0
+        self.recibidos = 0
+        self.reconexiones = 0
+        self.ultimo_envio = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    def start(self, agent_id: Callable[[], Optional[str]],
+              on_envelope: Callable[[Envelope], Awaitable[Any]]):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle(agent_id, on_envelope))
+
+    async def close(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+        for tarea in list(self._recepciones):
+            tarea.cancel()
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+
+    async def send(self, datos: bytes, codec: Codec) -> bool:
+        """
+        Envía un envelope ya codificado: frame binario si el codec lo es
+        (MessagePack), de texto si es JSON. False si no hay sesión.
+        """
+        ws = self._ws
+        if ws is None:
+            return False
+        try:
+            async with self._lock:
+                await ws.send(datos if codec.binario else datos.decode())
+        except Exception as e:
+            logger.warning(f"[{self.nombre}] envío por WebSocket fallido, se usa HTTP: {e}")
+            return False
+        self.enviados += 1
+        self.ultimo_envio = time.time()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conectado": self.connected,
+            "enviados": self.enviados,
+            "recibidos": self.recibidos,
+            "reconexiones": self.reconexiones,
+        }
+
+    async def _bucle(self, agent_id: Callable[[], Optional[str]],
+                     on_envelope: Callable[[Envelope], Awaitable[Any]]):
+        espera = 1.0
+        while True:
+            aid = agent_id()
+            if not aid:
+                await asyncio.sleep(1)  # aún sin registrar en el broker
+                continue
+            try:
+                async with websockets.connect(f"{self.ws_base}/{aid}") as ws:
+                    self._ws = ws
+                    espera = 1.0
+                    logger.info(f"[{self.nombre}] sesión WebSocket con el broker abierta")
+                    latidos = asyncio.create_task(self._latidos(aid))
+                    try:
+                        async for frame in ws:
+                            self._recibir(frame, on_envelope)
+                    finally:
+                        latidos.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[{self.nombre}] sesión WebSocket caída ({e}), reintento en {espera:.0f}s")
+            finally:
+                self._ws = None
+            self.reconexiones += 1
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, self.reconnect_max)
+
+    def _recibir(self, frame, on_envelope: Callable[[Envelope], Awaitable[Any]]):
+        self.recibidos += 1
+        try:
+            if isinstance(frame, bytes):
+                env = Envelope.model_validate(CODECS["msgpack"].decode(frame))
+            else:
+                env = Envelope.model_validate_json(frame)
+        except Exception as e:
+            logger.warning(f"[{self.nombre}] envelope WebSocket mal formado: {e}")
+            return
+        # Cada envelope se procesa en su propia tarea para no frenar la lectura
+        tarea = asyncio.create_task(self._procesar(env, on_envelope))
+        self._recepciones.add(tarea)
+        tarea.add_done_callback(self._recepciones.discard)
+
+    async def _procesar(self, env: Envelope, on_envelope: Callable[[Envelope], Awaitable[Any]]):
+        try:
+            await on_envelope(env)
+        except Exception as e:
+            logger.error(f"[{self.nombre}] error procesando {env.type} {env.message_id} por WebSocket: {e}")
+
+    async def _latidos(self, aid: str):
+        while True:
+            # Cualquier frame renueva el lease en el broker: si ya se envió
+            # algo en este intervalo, el latido explícito sobra
+            if time.time() - self.ultimo_envio < self.heartbeat_interval:
+                await asyncio.sleep(self.heartbeat_interval)
+                continue
+            env = Envelope(
+                version="1.0",
+                message_id=uuid4().hex,
+                timestamp=datetime.now(timezone.utc),
+                type="heartbeat",
+                sender=aid,
+                recipient=aid,
+                payload={},
+            )
+            await self.send(self.codec.encode(env.model_dump(mode="json")), self.codec)
+            await asyncio.sleep(self.heartbeat_interval)
@@ -0,0 +1,139 @@
+# server/a2a_chunks.py
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from server.a2a_models import Envelope
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Filas por trozo de una respuesta A2A (una página de /tool/consulta)
+A2A_CHUNK_ROWS = int(os.getenv("A2A_CHUNK_ROWS", "1000"))
+# Trozos enviados sin ACK como máximo antes de preparar el siguiente
+A2A_CHUNK_WINDOW = int(os.getenv("A2A_CHUNK_WINDOW", "4"))
+# Segundos sin trozos nuevos tras los que se descarta una respuesta a medias
+A2A_CHUNK_TTL = float(os.getenv("A2A_CHUNK_TTL", "120"))
+
+
+class VentanaEnvio:
+    """
+    Envío de los trozos de una respuesta con a lo sumo `ventana` sin ACK,
+    para que quien los produce no se adelante a un broker o un receptor
+    lentos. Cada trozo es un envelope con su propio message_id: se confirma
+    y se retransmite por separado. Si uno se da por perdido, el resto ya no
+    se envía (el receptor no podría completar la respuesta).
+    """
+
+    def __init__(self, delivery, ventana: int = A2A_CHUNK_WINDOW):
+        self.delivery = delivery
+        self.ventana = max(1, ventana)
+        self._en_vuelo: Deque[asyncio.Future] = deque()
+        self.perdido = False
+
+    async def enviar(self, env: Envelope) -> bool:
+        """Envía `env` cuando hay hueco en la ventana. False si ya se perdió un trozo."""
+        while len(self._en_vuelo) >= self.ventana and not self.perdido:
+            self.perdido = not await self._en_vuelo.popleft()
+        if self.perdido:
+            return False
+        self._en_vuelo.append(self.delivery.send(env))
+        return True
+
+    async def cerrar(self) -> bool:
+        """Espera los ACKs pendientes. True si se confirmaron todos los trozos."""
+        while self._en_vuelo:
+            if not await self._en_vuelo.popleft():
+                self.perdido = True
+        return not self.perdido
+
+
+class _Parcial:
+    __slots__ = ("trozos", "total", "actualizado")
+
+    def __init__(self):
+        self.trozos: Dict[int, Dict[str, Any]] = {}
+        self.total: Optional[int] = None     # se conoce al llegar el último
+        self.actualizado = time.monotonic()
+
+
+class Reensamblador:
+    """
+    Reensambla por correlation_id las respuestas A2A troceadas: cada trozo
+    lleva body.secuencia (0, 1, ...) y el último body.ultimo=True. Los
+    trozos pueden llegar repetidos (retransmisiones) o desordenados; la
+    respuesta está completa cuando están todos hasta el último. Un body sin
+    `secuencia` es una respuesta entera, como antes de trocear.
+    """
+
+    def __init__(self, ttl: float = A2A_CHUNK_TTL):
+        self.ttl = ttl
+        self._parciales: Dict[str, _Parcial] = {}
+        self.trozos = 0
+        self.duplicados = 0
+        self.completas = 0
+        self.caducadas = 0
+
+    def agregar(self, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Añade un trozo. Devuelve el body completo (resultado concatenado,
+        meta y error del último trozo) o None si aún faltan trozos.
+        """
+        if "secuencia" not in body:
+            return body
+        self._purgar()
+        corr = body["correlation_id"]
+        p = self._parciales.get(corr)
+        if p is None:
+            p = self._parciales[corr] = _Parcial()
+        p.actualizado = time.monotonic()
+        secuencia = int(body["secuencia"])
+        if secuencia in p.trozos:
+            self.duplicados += 1
+            return None
+        self.trozos += 1
+        p.trozos[secuencia] = body
+        if body.get("ultimo"):
+            p.total = secuencia + 1
+        if p.total is None or len(p.trozos) < p.total:
+            return None
+        del self._parciales[corr]
+        self.completas += 1
+        return self._unir(p)
+
+    def recibidos(self, corr: str) -> int:
+        """Trozos distintos recibidos de una respuesta aún incompleta."""
+        p = self._parciales.get(corr)
+        return len(p.trozos) if p is not None else 0
+
+    def descartar(self, corr: str):
+        self._parciales.pop(corr, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "incompletas": len(self._parciales),
+            "trozos": self.trozos,
+            "duplicados": self.duplicados,
+            "completas": self.completas,
+            "caducadas": self.caducadas,
+        }
+
+    @staticmethod
+    def _unir(p: _Parcial) -> Dict[str, Any]:
+        orden = [p.trozos[i] for i in range(p.total)]
+        body = {k: v for k, v in orden[-1].items() if k not in ("secuencia", "ultimo")}
+        body["resultado"] = [fila for trozo in orden for fila in trozo.get("resultado", [])]
+        if isinstance(body.get("meta"), dict):
+            body["meta"] = dict(body["meta"], filas=len(body["resultado"]))
+        body["trozos"] = p.total
+        return body
+
+    def _purgar(self):
+        # Respuestas abandonadas (emisor caído, trozo perdido): fuera tras el TTL
+        limite = time.monotonic() - self.ttl
+        for corr in [c for c, p in self._parciales.items() if p.actualizado < limite]:
+            del self._parciales[corr]
+            self.caducadas += 1
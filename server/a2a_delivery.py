@@ -0,0 +1,431 @@
+# server/a2a_delivery.py
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+import httpx
+
+from server.a2a_models import A2AMessage, Envelope
+from server.wire_codec import Codec, codec as codec_por_nombre
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Segundos de espera por el ACK antes del primer reintento
+A2A_ACK_TIMEOUT = float(os.getenv("A2A_ACK_TIMEOUT", "5"))
+# Envíos máximos por mensaje (el primero incluido)
+A2A_MAX_ATTEMPTS = int(os.getenv("A2A_MAX_ATTEMPTS", "3"))
+# Tope del backoff exponencial entre reintentos (s)
+A2A_MAX_BACKOFF = float(os.getenv("A2A_MAX_BACKOFF", "60"))
+# Tiempo máximo (s) de cada POST a /agent/send
+A2A_HTTP_TIMEOUT = float(os.getenv("A2A_HTTP_TIMEOUT", "10"))
+# Conexiones simultáneas hacia el broker
+A2A_MAX_CONNECTIONS = int(os.getenv("A2A_MAX_CONNECTIONS", "32"))
+# Ventana (ms) en la que se agrupan los ACKs hacia un mismo destinatario
+ACK_FLUSH_MS = float(os.getenv("ACK_FLUSH_MS", "10"))
+# ACKs máximos por envelope agrupado
+ACK_MAX_BATCH = int(os.getenv("ACK_MAX_BATCH", "256"))
+# ACKs encolados como máximo; por encima se descartan (el emisor reintentará)
+ACK_MAX_QUEUE = int(os.getenv("ACK_MAX_QUEUE", "10000"))
+# POSTs de ACK simultáneos hacia el broker
+ACK_MAX_INFLIGHT = int(os.getenv("ACK_MAX_INFLIGHT", "4"))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class _Pendiente:
+    __slots__ = ("env", "datos", "intentos", "espera", "future")
+
+    def __init__(self, env: Envelope, datos: bytes, espera: float, future: asyncio.Future):
+        self.env = env
+        self.datos = datos              # codificado una vez, reutilizado en cada reintento
+        self.intentos = 0
+        self.espera = espera
+        self.future = future
+
+
+class ReliableSender:
+    """
+    Entrega fiable de envelopes A2A a través del broker (/agent/send).
+
+    Todos los mensajes pendientes de ACK comparten un único cliente HTTP
+    asíncrono y una única tarea temporizadora: los plazos de ACK viven en un
+    heap (deadline, secuencia, message_id, intento) y la tarea duerme hasta
+    el más próximo. Si vence sin ACK, el mensaje se reenvía y su plazo se
+    duplica (hasta A2A_MAX_BACKOFF); tras A2A_MAX_ATTEMPTS envíos se da por
+    perdido. ack() cancela el mensaje en O(1): su entrada del heap se
+    descarta al salir. Nada bloquea el event loop.
+    """
+
+    def __init__(
+        self,
+        broker_url: str,
+        ack_timeout: float = A2A_ACK_TIMEOUT,
+        max_attempts: int = A2A_MAX_ATTEMPTS,
+        max_backoff: float = A2A_MAX_BACKOFF,
+        http_timeout: float = A2A_HTTP_TIMEOUT,
+        max_connections: int = A2A_MAX_CONNECTIONS,
+        nombre: str = "A2A",
+        canal=None,
+        codec: Optional[Codec] = None,
+    ):
+        self.send_url = f"{broker_url.rstrip('/')}/agent/send"
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.max_backoff = max_backoff
+        self.http_timeout = http_timeout
+        self.max_connections = max_connections
+        self.nombre = nombre
+        # BrokerChannel opcional: si hay sesión WebSocket se envía por ella
+        self.canal = canal
+        # Codec del cable (A2A_CODEC): json (orjson) | msgpack
+        self.codec = codec or codec_por_nombre()
+        self._headers = {"Content-Type": self.codec.media_type}
+        # Último envío aceptado por el broker (time.time()); el broker lo
+        # cuenta como latido, así que el agente puede omitir el heartbeat
+        self.ultima_actividad = 0.0
+        self._pendientes: Dict[str, _Pendiente] = {}
+        self._plazos: List[Tuple[float, int, str, int]] = []
+        self._secuencia = 0
+        self._despertar: Optional[asyncio.Event] = None
+        self._temporizador: Optional[asyncio.Task] = None
+        self._envios: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.enviados = 0
+        self.reintentos = 0
+        self.confirmados = 0
+        self.perdidos = 0
+
+    # — ciclo de vida —
+    async def start(self):
+        if self._temporizador is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=self.http_timeout,
+            limits=httpx.Limits(max_connections=self.max_connections),
+        )
+        self._despertar = asyncio.Event()
+        self._temporizador = asyncio.create_task(self._bucle())
+
+    async def close(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        for tarea in list(self._envios):
+            tarea.cancel()
+        for p in self._pendientes.values():
+            if not p.future.done():
+                p.future.set_result(False)
+        self._pendientes.clear()
+        self._plazos.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # — API —
+    def send(self, env: Envelope) -> asyncio.Future:
+        """
+        Envía `env` y programa sus reintentos. Devuelve un Future que se
+        resuelve a True cuando llega el ACK o a False si se agotan los
+        intentos. No hace falta esperarlo.
+        """
+        if self._temporizador is None:
+            raise RuntimeError("ReliableSender no iniciado: llama a start() en el arranque")
+        future = asyncio.get_running_loop().create_future()
+        p = _Pendiente(env, self.codec.encode(env.model_dump(mode="json")), self.ack_timeout, future)
+        self._pendientes[env.message_id] = p
+        self._transmitir(env.message_id, p)
+        return future
+
+    def ack(self, message_id: str) -> bool:
+        """
+        Marca `message_id` como confirmado y cancela sus reintentos.
+        False si no estaba pendiente (ACK duplicado o tardío).
+        """
+        p = self._pendientes.pop(message_id, None)
+        if p is None:
+            return False
+        self.confirmados += 1
+        if not p.future.done():
+            p.future.set_result(True)
+        return True
+
+    def pending(self) -> int:
+        return len(self._pendientes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pendientes": len(self._pendientes),
+            "plazos_en_heap": len(self._plazos),
+            "enviados": self.enviados,
+            "reintentos": self.reintentos,
+            "confirmados": self.confirmados,
+            "perdidos": self.perdidos,
+        }
+
+    # — internos —
+    def _transmitir(self, msg_id: str, p: _Pendiente):
+        # Lanza el POST sin esperarlo y programa el siguiente plazo de ACK
+        p.intentos += 1
+        self.enviados += 1
+        tarea = asyncio.create_task(self._post(msg_id, p.datos, p.intentos))
+        self._envios.add(tarea)
+        tarea.add_done_callback(self._envios.discard)
+
+        loop = asyncio.get_running_loop()
+        self._secuencia += 1
+        plazo = loop.time() + p.espera
+        es_el_primero = not self._plazos or plazo < self._plazos[0][0]
+        heapq.heappush(self._plazos, (plazo, self._secuencia, msg_id, p.intentos))
+        if es_el_primero:
+            self._despertar.set()
+
+    async def _post(self, msg_id: str, datos: bytes, intento: int):
+        if self.canal is not None and await self.canal.send(datos, self.codec):
+            logger.info(f"[{self.nombre}] Envío {msg_id} por WebSocket, intento {intento}")
+            self.ultima_actividad = time.time()
+            return
+        try:
+            resp = await self._client.post(self.send_url, content=datos, headers=self._headers)
+            resp.raise_for_status()
+            self.ultima_actividad = time.time()
+            logger.info(f"[{self.nombre}] Envío {msg_id}, intento {intento}")
+        except httpx.TimeoutException:
+            logger.warning(f"[{self.nombre}] Envío {msg_id} (intento {intento}) superó el timeout")
+        except Exception as e:
+            logger.error(f"[{self.nombre}] Error enviando {msg_id} (intento {intento}): {e}")
+
+    async def _bucle(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._despertar.clear()
+            if not self._plazos:
+                await self._despertar.wait()
+                continue
+            espera = self._plazos[0][0] - loop.time()
+            if espera > 0:
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, msg_id, intento = heapq.heappop(self._plazos)
+            p = self._pendientes.get(msg_id)
+            if p is None or p.intentos != intento:
+                continue  # ya confirmado: entrada obsoleta
+            self._vencido(msg_id, p)
+
+    def _vencido(self, msg_id: str, p: _Pendiente):
+        if p.intentos >= self.max_attempts:
+            self._pendientes.pop(msg_id, None)
+            self.perdidos += 1
+            logger.error(f"[{self.nombre}] No se recibió ACK para {msg_id} tras {p.intentos} intentos")
+            if not p.future.done():
+                p.future.set_result(False)
+            return
+        p.espera = min(p.espera * 2, self.max_backoff)
+        self.reintentos += 1
+        self._transmitir(msg_id, p)
+
+
+def correlation_ids(ack: A2AMessage) -> List[str]:
+    """
+    IDs confirmados por un ACK: `correlation_ids` si viene agrupado,
+    si no el `correlation_id` individual.
+    """
+    ids = ack.body.get("correlation_ids")
+    if ids:
+        return list(ids)
+    corr = ack.body.get("correlation_id")
+    return [corr] if corr else []
+
+
+def ack_envelope(sender: str, recipient: str, ids: List[str]) -> Envelope:
+    """
+    Envelope de ACK para uno o varios mensajes. `correlation_id` se mantiene
+    con el primero para los receptores que solo lean ese campo.
+    """
+    ack_msg = A2AMessage(
+        message_id=uuid4().hex,
+        sender=sender,
+        recipient=recipient,
+        timestamp=datetime.now(timezone.utc),
+        type="ack",
+        body={"status": "received", "correlation_id": ids[0], "correlation_ids": ids},
+    )
+    return Envelope(
+        version="1.0",
+        message_id=ack_msg.message_id,
+        timestamp=datetime.now(timezone.utc),
+        type="ack",
+        sender=ack_msg.sender,
+        recipient=ack_msg.recipient,
+        payload=ack_msg.model_dump(mode="json"),
+    )
+
+
+class AckBatcher:
+    """
+    Envío asíncrono y agrupado de ACKs A2A.
+
+    ack() solo encola (cola acotada a ACK_MAX_QUEUE). Un único worker recoge
+    lo que llega durante ACK_FLUSH_MS, junta los ACKs de un mismo par
+    emisor→destinatario en un solo envelope (hasta ACK_MAX_BATCH ids) y los
+    envía por un cliente HTTP keep-alive con a lo sumo ACK_MAX_INFLIGHT
+    POSTs en vuelo. Un ACK perdido no es grave: el emisor retransmite y el
+    receptor vuelve a confirmar.
+    """
+
+    def __init__(
+        self,
+        broker_url: str,
+        flush_ms: float = ACK_FLUSH_MS,
+        max_batch: int = ACK_MAX_BATCH,
+        max_queue: int = ACK_MAX_QUEUE,
+        max_inflight: int = ACK_MAX_INFLIGHT,
+        http_timeout: float = A2A_HTTP_TIMEOUT,
+        nombre: str = "A2A",
+        canal=None,
+        codec: Optional[Codec] = None,
+    ):
+        self.send_url = f"{broker_url.rstrip('/')}/agent/send"
+        self.flush = flush_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.max_queue = max_queue
+        self.max_inflight = max(1, max_inflight)
+        self.http_timeout = http_timeout
+        self.nombre = nombre
+        # BrokerChannel opcional: si hay sesión WebSocket se envía por ella
+        self.canal = canal
+        # Codec del cable (A2A_CODEC): json (orjson) | msgpack
+        self.codec = codec or codec_por_nombre()
+        self._headers = {"Content-Type": self.codec.media_type}
+        # Último envío aceptado por el broker (time.time()); el broker lo
+        # cuenta como latido, así que el agente puede omitir el heartbeat
+        self.ultima_actividad = 0.0
+        self._cola: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._envios: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.encolados = 0
+        self.descartados = 0
+        self.lotes = 0
+        self.enviados = 0
+        self.errores = 0
+        self.profundidad_max = 0
+        self.en_vuelo = 0
+
+    async def start(self):
+        if self._worker is not None:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=self.http_timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_inflight,
+                max_keepalive_connections=self.max_inflight,
+            ),
+        )
+        self._cola = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._worker = asyncio.create_task(self._bucle())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for tarea in list(self._envios):
+            tarea.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def ack(self, sender: str, recipient: str, correlation_id: str) -> bool:
+        """
+        Encola el ACK de `correlation_id` sin esperar. False si la cola está
+        llena y se ha descartado.
+        """
+        if self._worker is None:
+            raise RuntimeError("AckBatcher no iniciado: llama a start() en el arranque")
+        if not sender:
+            logger.warning(f"[{self.nombre}] ACK de {correlation_id} sin emisor (agente no registrado)")
+            return False
+        try:
+            self._cola.put_nowait((sender, recipient, correlation_id))
+        except asyncio.QueueFull:
+            self.descartados += 1
+            logger.warning(f"[{self.nombre}] cola de ACKs llena, ACK de {correlation_id} descartado")
+            return False
+        self.encolados += 1
+        self.profundidad_max = max(self.profundidad_max, self._cola.qsize())
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cola": self._cola.qsize() if self._cola is not None else 0,
+            "cola_max": self.profundidad_max,
+            "en_vuelo": self.en_vuelo,
+            "encolados": self.encolados,
+            "descartados": self.descartados,
+            "lotes": self.lotes,
+            "envelopes": self.enviados,
+            "errores": self.errores,
+        }
+
+    async def _recoger(self) -> List[Tuple[str, str, str]]:
+        lote = [await self._cola.get()]
+        limite = asyncio.get_running_loop().time() + self.flush
+        while True:
+            try:
+                lote.append(self._cola.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            restante = limite - asyncio.get_running_loop().time()
+            if restante <= 0:
+                return lote
+            try:
+                lote.append(await asyncio.wait_for(self._cola.get(), timeout=restante))
+            except asyncio.TimeoutError:
+                return lote
+
+    async def _bucle(self):
+        while True:
+            lote = await self._recoger()
+            grupos: Dict[Tuple[str, str], List[str]] = {}
+            for sender, recipient, corr in lote:
+                grupos.setdefault((sender, recipient), []).append(corr)
+            self.lotes += 1
+            for (sender, recipient), ids in grupos.items():
+                for i in range(0, len(ids), self.max_batch):
+                    env = ack_envelope(sender, recipient, ids[i:i + self.max_batch])
+                    # El semáforo acota los POSTs en vuelo; si están todos
+                    # ocupados el worker espera y la cola absorbe la ráfaga
+                    await self._slots.acquire()
+                    self.en_vuelo += 1
+                    tarea = asyncio.create_task(self._post(env))
+                    self._envios.add(tarea)
+                    tarea.add_done_callback(self._envios.discard)
+
+    async def _post(self, env: Envelope):
+        try:
+            datos = self.codec.encode(env.model_dump(mode="json"))
+            if self.canal is None or not await self.canal.send(datos, self.codec):
+                resp = await self._client.post(self.send_url, content=datos, headers=self._headers)
+                resp.raise_for_status()
+            self.ultima_actividad = time.time()
+            self.enviados += 1
+            n = len(env.payload["body"]["correlation_ids"])
+            logger.info(f"[{self.nombre}] ACK de {n} mensaje(s) enviado a {env.recipient}")
+        except Exception as e:
+            self.errores += 1
+            logger.error(f"[{self.nombre}] Error enviando ACK: {e}")
+        finally:
+            self.en_vuelo -= 1
+            self._slots.release()
@@ -0,0 +1,93 @@
+# server/db_pool.py
+
+import os
+import queue
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+import duckdb
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Cursores disponibles (= consultas que pueden ejecutarse a la vez)
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", str(os.cpu_count() or 4)))
+# Abrir la base de datos en solo lectura ("1") o lectura/escritura ("0")
+DUCKDB_READ_ONLY = os.getenv("DUCKDB_READ_ONLY", "0") == "1"
+# Segundos máximos esperando un cursor libre
+DUCKDB_POOL_TIMEOUT = float(os.getenv("DUCKDB_POOL_TIMEOUT", "30"))
+# Memoria e hilos de la instancia DuckDB, compartidos por todas las consultas
+# del pool (vacío = valor por defecto de DuckDB: 80% de la RAM, un hilo por núcleo)
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "")
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "0"))
+
+
+class CursorPool:
+    """
+    Pool acotado de cursores DuckDB sobre una misma base de datos.
+
+    Cada cursor es una conexión independiente a la misma instancia, con su
+    propio estado de resultado (`description`, `fetch*`), y se presta en
+    exclusiva al hilo que lo pide hasta que lo devuelve. Así las consultas
+    de distintos hilos del threadpool se ejecutan en paralelo sin mezclar
+    resultados.
+
+    memory_limit y threads son de la instancia (DuckDB no los admite por
+    conexión): acotan el conjunto de consultas en curso, no cada una.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = DUCKDB_POOL_SIZE,
+        read_only: bool = DUCKDB_READ_ONLY,
+        init_sql: Iterable[str] = (),
+        timeout: float = DUCKDB_POOL_TIMEOUT,
+        memory_limit: str = DUCKDB_MEMORY_LIMIT,
+        threads: int = DUCKDB_THREADS,
+    ):
+        self.path = path
+        self.size = max(1, size)
+        self.read_only = read_only
+        self.timeout = timeout
+        config = {}
+        if memory_limit:
+            config["memory_limit"] = memory_limit
+        if threads > 0:
+            config["threads"] = threads
+        self.con = duckdb.connect(path, read_only=read_only, config=config)
+        for stmt in init_sql:
+            self.con.execute(stmt)
+        self.memory_limit, self.threads = self.con.execute(
+            "SELECT current_setting('memory_limit'), current_setting('threads')"
+        ).fetchone()
+        self._free: "queue.LifoQueue[duckdb.DuckDBPyConnection]" = queue.LifoQueue()
+        for _ in range(self.size):
+            self._free.put(self.con.cursor())
+
+    def acquire(self, timeout: Optional[float] = None) -> duckdb.DuckDBPyConnection:
+        """
+        Toma un cursor libre; espera hasta `timeout` segundos si no hay.
+        Debe devolverse con release().
+        """
+        try:
+            return self._free.get(timeout=self.timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise RuntimeError("No hay cursores DuckDB libres; inténtalo más tarde")
+
+    def release(self, cur: duckdb.DuckDBPyConnection):
+        self._free.put(cur)
+
+    @contextmanager
+    def cursor(self, timeout: Optional[float] = None) -> Iterator[duckdb.DuckDBPyConnection]:
+        # Presta un cursor durante el bloque `with`
+        cur = self.acquire(timeout)
+        try:
+            yield cur
+        finally:
+            self.release(cur)
+
+    def close(self):
+        while not self._free.empty():
+            self._free.get_nowait().close()
+        self.con.close()
@@ -0,0 +1,88 @@
+# server/forwarder.py
+
+import asyncio
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Tiempo máximo (s) de un reenvío, incluida la espera por un hueco libre
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "20"))
+# Reenvíos simultáneos permitidos hacia un mismo callback_url
+FORWARD_MAX_CONCURRENCY = int(os.getenv("FORWARD_MAX_CONCURRENCY", "16"))
+# Conexiones keep-alive que se conservan abiertas por callback_url
+FORWARD_KEEPALIVE = int(os.getenv("FORWARD_KEEPALIVE", "8"))
+
+
+class Forwarder:
+    """
+    Reenvío asíncrono de envelopes A2A hacia los callback_url de los agentes.
+
+    Cada destinatario tiene su propio pool de conexiones keep-alive y un
+    semáforo que acota cuántos reenvíos hay en vuelo hacia él, de modo que
+    un agente lento no acapara los recursos del broker.
+    """
+
+    def __init__(
+        self,
+        timeout: float = FORWARD_TIMEOUT,
+        max_concurrency: int = FORWARD_MAX_CONCURRENCY,
+        keepalive: int = FORWARD_KEEPALIVE,
+    ):
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.keepalive = keepalive
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+
+    def _pool(self, callback_url: str) -> tuple:
+        client = self._clients.get(callback_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.keepalive,
+                ),
+            )
+            self._clients[callback_url] = client
+            self._slots[callback_url] = asyncio.Semaphore(self.max_concurrency)
+        return client, self._slots[callback_url]
+
+    async def _post(self, callback_url: str, **kwargs) -> httpx.Response:
+        client, slots = self._pool(callback_url)
+        async with slots:
+            resp = await client.post(callback_url, **kwargs)
+            resp.raise_for_status()
+            return resp
+
+    async def forward(self, callback_url: str, payload: Any,
+                      timeout: Optional[float] = None) -> httpx.Response:
+        """
+        Envía `payload` por POST a `callback_url`. Lanza excepción si no hay
+        respuesta 2xx dentro del tiempo límite.
+        """
+        return await asyncio.wait_for(
+            self._post(callback_url, json=payload),
+            timeout=timeout or self.timeout,
+        )
+
+    async def forward_raw(self, callback_url: str, content: bytes, media_type: str,
+                          timeout: Optional[float] = None) -> httpx.Response:
+        """
+        Como forward(), pero envía `content` tal cual, ya codificado, con
+        Content-Type `media_type` (sin volver a serializarlo).
+        """
+        return await asyncio.wait_for(
+            self._post(callback_url, content=content, headers={"Content-Type": media_type}),
+            timeout=timeout or self.timeout,
+        )
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._slots.clear()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+server/ingest.py
+
+Ingesta masiva de ficheros de ventas (CSV, Parquet o NDJSON, de cualquier
+tamaño) en el lago de iceberg_space.ventas (ver ventas_lake.py).
+
+  python ingest.py extractos/2024-05/*.csv
+  python ingest.py extractos/ --lote-ficheros 64 --hilos 8 --memoria 2GB
+  python ingest.py --ejemplo        # las filas de ejemplo del antiguo load_data.py
+
+Cada lote de ficheros del mismo formato se lee con los lectores multi-fichero
+de DuckDB (read_csv/read_parquet/read_json, en paralelo con --hilos) y se
+escribe con un único COPY ... PARTITION_BY en streaming, con memoria acotada
+por --memoria (lo que no cabe se vuelca a disco), y se publica en el
+manifiesto de una vez: un lote es la unidad de commit. Al terminar se
+refresca el rollup diario × producto (ver ventas_rollup.py).
+
+El registro de ingesta (SQLite) guarda los ficheros ya cargados por ruta,
+tamaño y fecha de modificación, así que repetir la orden solo carga lo
+nuevo. Un lote interrumpido se reconcilia con el manifiesto al arrancar: si
+llegó a publicarse se da por cargado, si no se repite.
+
+Si la tabla DuckDB de ventas anterior al lago (data/lake.duckdb) aún no se
+ha importado, la ingesta la importa primero; si la base está en uso y el
+lago no existe, se niega a crearlo sin esas filas.
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+import duckdb
+
+from ventas_lake import COLUMNAS, DATA_DIR, VentasLake, _literal
+from ventas_rollup import VentasRollup
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Registro de ficheros ya ingeridos
+INGEST_LEDGER_PATH = os.getenv("INGEST_LEDGER_PATH", os.path.join(DATA_DIR, "ingest_ledger.sqlite"))
+# Ficheros por lote (cada lote se publica de una vez en el manifiesto)
+INGEST_BATCH_FILES = int(os.getenv("INGEST_BATCH_FILES", "32"))
+# Tope de bytes de entrada por lote (lo que se alcance antes)
+INGEST_BATCH_BYTES = int(os.getenv("INGEST_BATCH_BYTES", str(2 * 1024 ** 3)))
+# Hilos de DuckDB para leer y escribir
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", str(os.cpu_count() or 4)))
+# Memoria máxima de DuckDB durante la ingesta
+INGEST_MEMORY_LIMIT = os.getenv("INGEST_MEMORY_LIMIT", "1GB")
+# Base DuckDB del servidor (main.DB_PATH), con la tabla de ventas anterior
+# al lago hasta que se importa
+DUCKDB_PATH = os.path.join(DATA_DIR, "lake.duckdb")
+
+FORMATOS = {
+    ".csv": "csv", ".tsv": "csv", ".csv.gz": "csv", ".tsv.gz": "csv",
+    ".parquet": "parquet",
+    ".ndjson": "ndjson", ".jsonl": "ndjson", ".ndjson.gz": "ndjson", ".jsonl.gz": "ndjson",
+}
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS ficheros (
+    ruta      TEXT PRIMARY KEY,
+    bytes     INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    lote      TEXT NOT NULL,
+    estado    TEXT NOT NULL DEFAULT 'pendiente'
+);
+CREATE TABLE IF NOT EXISTS lotes (
+    lote      TEXT PRIMARY KEY,
+    ficheros  INTEGER NOT NULL,
+    filas     INTEGER NOT NULL,
+    segundos  REAL NOT NULL,
+    version   INTEGER NOT NULL,
+    creado    REAL NOT NULL
+);
+"""
+
+# Filas de ejemplo del antiguo load_data.py
+EJEMPLO = """
+SELECT * FROM (VALUES
+    ('2024-04-01', 'Router X', 10, 120.0),
+    ('2024-04-01', 'Switch Y', 5, 85.5),
+    ('2024-04-02', 'Router X', 7, 120.0),
+    ('2024-04-03', 'Switch Y', 2, 85.5),
+    ('2024-04-03', 'Firewall Z', 3, 300.0)
+) AS v(fecha, producto, cantidad, precio)
+"""
+
+
+def formato_de(ruta: str) -> Optional[str]:
+    nombre = ruta.lower()
+    for extension, formato in sorted(FORMATOS.items(), key=lambda e: -len(e[0])):
+        if nombre.endswith(extension):
+            return formato
+    return None
+
+
+def expandir(entradas: Iterable[str]) -> List[str]:
+    """Ficheros (rutas absolutas, sin repetir) de rutas, directorios y globs."""
+    vistos, ficheros = set(), []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            candidatos = sorted(
+                os.path.join(raiz, f) for raiz, _, nombres in os.walk(entrada) for f in nombres
+            )
+        else:
+            candidatos = sorted(glob.glob(entrada, recursive=True)) or [entrada]
+        for ruta in candidatos:
+            ruta = os.path.abspath(ruta)
+            if ruta not in vistos and formato_de(ruta) and os.path.isfile(ruta):
+                vistos.add(ruta)
+                ficheros.append(ruta)
+    return ficheros
+
+
+def fuente_sql(formato: str, rutas: List[str]) -> str:
+    """SELECT con las columnas de ventas sobre un lote de ficheros del mismo formato."""
+    lista = "[" + ", ".join(_literal(r) for r in rutas) + "]"
+    tipos = "{" + ", ".join(f"'{c}': '{t}'" for c, t in COLUMNAS) + "}"
+    if formato == "csv":
+        lector = f"read_csv({lista}, header = true, union_by_name = true, types = {tipos})"
+    elif formato == "parquet":
+        lector = f"read_parquet({lista}, union_by_name = true, hive_partitioning = false)"
+    else:
+        lector = f"read_json({lista}, format = 'newline_delimited', columns = {tipos})"
+    return f"SELECT {', '.join(c for c, _ in COLUMNAS)} FROM {lector}"
+
+
+class Ledger:
+    """Registro SQLite de ficheros ingeridos y de lotes publicados."""
+
+    def __init__(self, path: str = INGEST_LEDGER_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.con = sqlite3.connect(path, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.executescript(_ESQUEMA)
+
+    def reconciliar(self, publicados: set) -> Tuple[int, int]:
+        # Lotes que quedaron a medias: publicados → hechos; el resto se repite
+        pendientes = [l for (l,) in self.con.execute(
+            "SELECT DISTINCT lote FROM ficheros WHERE estado = 'pendiente'"
+        )]
+        hechos = [l for l in pendientes if l in publicados]
+        for lote in pendientes:
+            if lote in publicados:
+                self.con.execute("UPDATE ficheros SET estado = 'hecho' WHERE lote = ?", (lote,))
+            else:
+                self.con.execute("DELETE FROM ficheros WHERE lote = ?", (lote,))
+        return len(hechos), len(pendientes) - len(hechos)
+
+    def nuevos(self, rutas: List[str], todos: bool = False
+               ) -> Tuple[List[Tuple[str, int, int]], List[str]]:
+        """
+        (ruta, bytes, mtime_ns) de los ficheros a cargar, y rutas ya ingeridas
+        que han cambiado desde entonces: esas no se recargan sin `todos`,
+        porque sus filas se añadirían otra vez al lago.
+        """
+        resultado, modificados = [], []
+        for ruta in rutas:
+            st = os.stat(ruta)
+            fila = None if todos else self.con.execute(
+                "SELECT bytes, mtime_ns FROM ficheros WHERE ruta = ? AND estado = 'hecho'", (ruta,)
+            ).fetchone()
+            if fila is None:
+                resultado.append((ruta, st.st_size, st.st_mtime_ns))
+            elif fila != (st.st_size, st.st_mtime_ns):
+                modificados.append(ruta)
+        return resultado, modificados
+
+    def empezar(self, lote: str, ficheros: List[Tuple[str, int, int]]):
+        self.con.execute("BEGIN")
+        self.con.executemany(
+            "INSERT OR REPLACE INTO ficheros (ruta, bytes, mtime_ns, lote, estado) "
+            "VALUES (?, ?, ?, ?, 'pendiente')",
+            [(ruta, tamaño, mtime, lote) for ruta, tamaño, mtime in ficheros],
+        )
+        self.con.execute("COMMIT")
+
+    def terminar(self, lote: str, ficheros: int, filas: int, segundos: float, version: int):
+        self.con.execute("BEGIN")
+        self.con.execute("UPDATE ficheros SET estado = 'hecho' WHERE lote = ?", (lote,))
+        self.con.execute(
+            "INSERT INTO lotes (lote, ficheros, filas, segundos, version, creado) VALUES (?, ?, ?, ?, ?, ?)",
+            (lote, ficheros, filas, segundos, version, time.time()),
+        )
+        self.con.execute("COMMIT")
+
+    def descartar(self, lote: str):
+        self.con.execute("DELETE FROM ficheros WHERE lote = ?", (lote,))
+
+
+def lotes(ficheros: List[Tuple[str, int, int]], max_ficheros: int,
+          max_bytes: int) -> Iterable[Tuple[str, List[Tuple[str, int, int]]]]:
+    """Agrupa por formato en lotes de hasta max_ficheros / max_bytes."""
+    por_formato: Dict[str, List[Tuple[str, int, int]]] = {}
+    for fichero in ficheros:
+        por_formato.setdefault(formato_de(fichero[0]), []).append(fichero)
+    for formato, grupo in por_formato.items():
+        actual, tamaño = [], 0
+        for fichero in grupo:
+            if actual and (len(actual) >= max_ficheros or tamaño + fichero[1] > max_bytes):
+                yield formato, actual
+                actual, tamaño = [], 0
+            actual.append(fichero)
+            tamaño += fichero[1]
+        if actual:
+            yield formato, actual
+
+
+def conexion(hilos: int, memoria: str, temporal: str) -> duckdb.DuckDBPyConnection:
+    con = duckdb.connect()
+    con.execute(f"SET threads = {int(hilos)}")
+    con.execute(f"SET memory_limit = {_literal(memoria)}")
+    # Lo que no quepa en memoria_limit se vuelca aquí en vez de fallar
+    con.execute(f"SET temp_directory = {_literal(temporal)}")
+    # Sin orden de inserción que preservar, COPY escribe en streaming por hilo
+    con.execute("SET preserve_insertion_order = false")
+    return con
+
+
+def tabla_legada(con: duckdb.DuckDBPyConnection, lago: VentasLake) -> Optional[str]:
+    """
+    Tabla DuckDB de ventas aún sin importar al lago (adjuntada en solo
+    lectura como `legado`), o None. Si la base está en uso por el servidor
+    y el lago todavía no existe, no se puede comprobar: error, antes que
+    crear un lago sin esas filas.
+    """
+    if lago.importada() or not os.path.exists(DUCKDB_PATH):
+        return None
+    try:
+        con.execute(f"ATTACH {_literal(DUCKDB_PATH)} AS legado (READ_ONLY)")
+    except duckdb.Error as e:
+        if lago.existe():
+            return None  # el servidor la importa al arrancar
+        raise RuntimeError(
+            f"no se puede leer {DUCKDB_PATH} ({e}); arranca antes el servidor para que "
+            f"importe {lago.tabla} al lago, o páralo y repite la ingesta"
+        )
+    existe = con.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE database_name = 'legado' "
+        "AND schema_name = ? AND table_name = ?",
+        [lago.schema, lago.nombre],
+    ).fetchone() is not None
+    if not existe:
+        con.execute("DETACH legado")
+        return None
+    return f"legado.{lago.tabla}"
+
+
+def _velocidad(filas: int, segundos: float) -> str:
+    return f"{filas / segundos:,.0f} filas/s" if segundos > 0 else "-"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ingesta masiva de ventas en el lago Parquet")
+    parser.add_argument("rutas", nargs="*", help="ficheros, directorios o globs (.csv, .parquet, .ndjson)")
+    parser.add_argument("--lote-ficheros", type=int, default=INGEST_BATCH_FILES)
+    parser.add_argument("--lote-bytes", type=int, default=INGEST_BATCH_BYTES)
+    parser.add_argument("--hilos", type=int, default=INGEST_THREADS)
+    parser.add_argument("--memoria", default=INGEST_MEMORY_LIMIT, help="p. ej. 512MB, 2GB")
+    parser.add_argument("--ledger", default=INGEST_LEDGER_PATH)
+    parser.add_argument("--forzar", action="store_true",
+                        help="volver a cargar ficheros ya ingeridos (sus filas se añaden de nuevo)")
+    parser.add_argument("--ejemplo", action="store_true", help="cargar las filas de ejemplo")
+    args = parser.parse_args(argv)
+    if not args.rutas and not args.ejemplo:
+        parser.error("indica al menos un fichero, directorio o glob (o --ejemplo)")
+
+    lago = VentasLake()
+    temporal = os.path.join(lago.root, "_staging", "tmp")
+    os.makedirs(temporal, exist_ok=True)
+    con = conexion(args.hilos, args.memoria, temporal)
+    try:
+        legado = tabla_legada(con, lago)
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    if lago.inicializar(con, legado):
+        print(f"✅ {lago.tabla} de {DUCKDB_PATH} importada al lago")
+    if legado is not None:
+        con.execute("DETACH legado")  # sin bloquear la base al servidor
+    ledger = Ledger(args.ledger)
+    hechos, repetir = ledger.reconciliar(lago.lotes())
+    if hechos or repetir:
+        print(f"↺ lotes interrumpidos: {hechos} ya publicados, {repetir} a repetir")
+
+    if args.ejemplo:
+        r = lago.escribir(con, EJEMPLO)
+        print(f"✅ Datos de ejemplo insertados: {r['filas']} filas (versión {r['version']}).")
+
+    rutas = expandir(args.rutas)
+    pendientes, modificados = ledger.nuevos(rutas, todos=args.forzar)
+    if args.rutas:
+        print(f"{len(rutas)} ficheros, {len(rutas) - len(pendientes)} ya ingeridos, {len(pendientes)} a cargar")
+    for ruta in modificados:
+        print(f"⚠️  {ruta} ha cambiado desde su ingesta; se omite (usa --forzar para recargarlo)")
+
+    total_filas, total_segundos, errores = 0, 0.0, 0
+    for formato, lote_ficheros in lotes(pendientes, max(1, args.lote_ficheros), args.lote_bytes):
+        lote = uuid4().hex
+        ledger.empezar(lote, lote_ficheros)
+        inicio = time.perf_counter()
+        try:
+            r = lago.escribir(con, fuente_sql(formato, [f[0] for f in lote_ficheros]), lote=lote)
+        except Exception as e:
+            ledger.descartar(lote)
+            errores += 1
+            print(f"❌ lote de {len(lote_ficheros)} ficheros {formato} fallido: {e}", file=sys.stderr)
+            continue
+        segundos = time.perf_counter() - inicio
+        ledger.terminar(lote, len(lote_ficheros), r["filas"], segundos, r["version"])
+        total_filas += r["filas"]
+        total_segundos += segundos
+        megas = sum(f[1] for f in lote_ficheros) / 1024 ** 2
+        print(f"  lote {formato}: {len(lote_ficheros)} ficheros, {megas:,.1f} MB, {r['filas']:,} filas "
+              f"→ {r['ficheros']} parquet en {segundos:.2f}s ({_velocidad(r['filas'], segundos)}), "
+              f"versión {r['version']}")
+
+    # El rollup se pone al día una vez, con todos los ficheros nuevos
+    rollup = VentasRollup(lago).refrescar()
+    if rollup:
+        print(f"  rollup: {rollup['ficheros']} ficheros del lago agregados en {rollup['filas']:,} filas "
+              f"(versión {rollup['version']})")
+    if pendientes:
+        resumen = f"{total_filas:,} filas en {total_segundos:.2f}s ({_velocidad(total_filas, total_segundos)})"
+        print(f"⚠️  {resumen}, {errores} lotes fallidos" if errores else f"✅ {resumen}")
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# server/load_tracker.py
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Peso de la última muestra en la media móvil exponencial de latencia
+LOAD_EWMA_ALPHA = float(os.getenv("LOAD_EWMA_ALPHA", "0.2"))
+# Segundos tras los que una query sin respuesta deja de contar como pendiente
+LOAD_STALE_SECONDS = float(os.getenv("LOAD_STALE_SECONDS", "60"))
+
+
+class LoadTracker:
+    """
+    Carga por agente observada en los mensajes que reenvía el broker.
+
+    Una `query` hacia un agente abre una petición pendiente (clave: su
+    correlation_id); la `response` de ese agente con el mismo
+    correlation_id la cierra y aporta una muestra de latencia a su EWMA.
+    Las queries que nunca obtienen respuesta se descartan pasados
+    LOAD_STALE_SECONDS para que no inflen la cuenta indefinidamente.
+    """
+
+    def __init__(self, alpha: float = LOAD_EWMA_ALPHA, stale_seconds: float = LOAD_STALE_SECONDS):
+        self.alpha = alpha
+        self.stale_seconds = stale_seconds
+        # correlation_id → (agent_id, inicio), en orden de llegada
+        self._abiertas: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._pendientes: Dict[str, int] = {}
+        self._ewma_ms: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def query(self, recipient: str, correlation_id: str):
+        now = time.monotonic()
+        with self._lock:
+            self._purgar(now)
+            if correlation_id in self._abiertas:
+                return  # retransmisión de una query ya contada
+            self._abiertas[correlation_id] = (recipient, now)
+            self._pendientes[recipient] = self._pendientes.get(recipient, 0) + 1
+
+    def response(self, sender: str, correlation_id: str):
+        now = time.monotonic()
+        with self._lock:
+            abierta = self._abiertas.get(correlation_id)
+            if abierta is None or abierta[0] != sender:
+                return
+            del self._abiertas[correlation_id]
+            self._cerrar(sender)
+            muestra = (now - abierta[1]) * 1000
+            previa = self._ewma_ms.get(sender)
+            self._ewma_ms[sender] = muestra if previa is None else (
+                self.alpha * muestra + (1 - self.alpha) * previa
+            )
+
+    def _cerrar(self, agent_id: str):
+        n = self._pendientes.get(agent_id, 0) - 1
+        if n > 0:
+            self._pendientes[agent_id] = n
+        else:
+            self._pendientes.pop(agent_id, None)
+
+    def _purgar(self, now: float):
+        while self._abiertas:
+            corr, (agent_id, inicio) = next(iter(self._abiertas.items()))
+            if now - inicio < self.stale_seconds:
+                break
+            del self._abiertas[corr]
+            self._cerrar(agent_id)
+
+    def load(self, agent_id: str) -> Dict[str, Any]:
+        with self._lock:
+            self._purgar(time.monotonic())
+            ewma = self._ewma_ms.get(agent_id)
+            return {
+                "outstanding": self._pendientes.get(agent_id, 0),
+                "ewma_latency_ms": round(ewma, 1) if ewma is not None else None,
+            }
+
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS carga_abiertas (
+    correlation_id  TEXT PRIMARY KEY,
+    agent_id        TEXT NOT NULL,
+    inicio          REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS carga_abiertas_agente ON carga_abiertas (agent_id, inicio);
+CREATE TABLE IF NOT EXISTS carga_latencia (
+    agent_id  TEXT PRIMARY KEY,
+    ewma_ms   REAL NOT NULL
+);
+"""
+
+
+class SQLiteLoadTracker(LoadTracker):
+    """
+    LoadTracker compartido entre procesos del broker (mismo fichero SQLite
+    que el registro): la query y su response pueden pasar por workers
+    distintos. Las pendientes caducadas no se borran al consultar, solo se
+    dejan de contar; query() purga de vez en cuando.
+    """
+
+    def __init__(self, path: str, alpha: float = LOAD_EWMA_ALPHA,
+                 stale_seconds: float = LOAD_STALE_SECONDS):
+        super().__init__(alpha, stale_seconds)
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.executescript(_ESQUEMA)
+        self._purgado = 0.0
+
+    def query(self, recipient: str, correlation_id: str):
+        now = time.time()
+        with self._lock:
+            self._con.execute(
+                "INSERT OR IGNORE INTO carga_abiertas (correlation_id, agent_id, inicio) VALUES (?, ?, ?)",
+                (correlation_id, recipient, now),
+            )
+            if now - self._purgado > self.stale_seconds:
+                self._purgado = now
+                self._con.execute(
+                    "DELETE FROM carga_abiertas WHERE inicio < ?", (now - self.stale_seconds,)
+                )
+
+    def response(self, sender: str, correlation_id: str):
+        now = time.time()
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._con.execute(
+                    "SELECT inicio FROM carga_abiertas WHERE correlation_id = ? AND agent_id = ?",
+                    (correlation_id, sender),
+                ).fetchone()
+                if fila is not None:
+                    self._con.execute(
+                        "DELETE FROM carga_abiertas WHERE correlation_id = ?", (correlation_id,)
+                    )
+                    self._con.execute(
+                        "INSERT INTO carga_latencia (agent_id, ewma_ms) VALUES (?, ?) "
+                        "ON CONFLICT(agent_id) DO UPDATE SET "
+                        "ewma_ms = ? * excluded.ewma_ms + (1 - ?) * ewma_ms",
+                        (sender, (now - fila[0]) * 1000, self.alpha, self.alpha),
+                    )
+            finally:
+                self._con.execute("COMMIT")
+
+    def load(self, agent_id: str) -> Dict[str, Any]:
+        with self._lock:
+            (pendientes,) = self._con.execute(
+                "SELECT COUNT(*) FROM carga_abiertas WHERE agent_id = ? AND inicio >= ?",
+                (agent_id, time.time() - self.stale_seconds),
+            ).fetchone()
+            fila = self._con.execute(
+                "SELECT ewma_ms FROM carga_latencia WHERE agent_id = ?", (agent_id,)
+            ).fetchone()
+        return {
+            "outstanding": pendientes,
+            "ewma_latency_ms": round(fila[0], 1) if fila else None,
+        }
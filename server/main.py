@@ -1,18 +1,38 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from a2a_models import AgentInfo, Envelope, ServiceCard
+from forwarder import Forwarder
+from outbox import Outbox
+from ws_sessions import WebSocketSessions
+from wire_codec import JSON_MEDIA, MSGPACK_MEDIA, cabecera, codec_para
+from registry import AgentRegistry, RegistryBackend
+from registry_sqlite import SQLiteRegistry
+from load_tracker import LoadTracker, SQLiteLoadTracker
+from transitions import TransitionFeed
+from db_pool import CursorPool
+from query_cache import QueryCache, TableVersion, tipo_sentencia
+from query_guard import QueryGuard
+from result_cursors import ResultCursors
+from table_metadata import TableMetadata
+from ventas_lake import VentasLake
+from ventas_rollup import VentasRollup
+from result_formats import ARROW_STREAM, JSON, negociar_formato, pa, stream_arrow, stream_ndjson
 from datetime import datetime, timedelta, timezone
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.encoders import jsonable_encoder
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from uuid import uuid4
-import requests
-import duckdb
 import os
+import json
+import time
+import asyncio
+import threading
+import logging
 
 # —————————————————————————————————————————————————————————————————————————————
 # APP & STORAGE
 # —————————————————————————————————————————————————————————————————————————————
 app = FastAPI(title="Servidor MCP para Apache Iceberg y A2A Broker")
+logger = logging.getLogger("uvicorn.error")
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,15 +42,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Almacenamiento en memoria de agentes registrados, por cada agent_id:
-#   { name, callback_url, capabilities, last_heartbeat (datetime|None) }
-AGENTS: Dict[str, dict] = {}
-
-# Almacenamiento adicional de último heartbeat
-LAST_HEARTBEAT: Dict[str, datetime] = {}
 HEARTBEAT_TIMEOUT = timedelta(seconds=60)
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
 
+# Backend del registro: "memory" (un solo proceso) o "sqlite" (REGISTRY_PATH,
+# compartido entre workers de uvicorn y réplicas en la misma máquina)
+REGISTRY_BACKEND = os.getenv("REGISTRY_BACKEND", "memory").lower()
+
+# Registro de agentes, por cada agent_id:
+#   { name, callback_url, capabilities, last_heartbeat (datetime|None) }
+# con índices por capacidad y liveness incremental (online si hay latido en
+# los últimos 2 * HEARTBEAT_INTERVAL)
+REGISTRY: RegistryBackend = (
+    SQLiteRegistry(ttl_seconds=2 * HEARTBEAT_INTERVAL) if REGISTRY_BACKEND == "sqlite"
+    else AgentRegistry(ttl_seconds=2 * HEARTBEAT_INTERVAL)
+)
+
+# Transiciones online/offline publicadas por el registro (/agent/transitions)
+transiciones = TransitionFeed()
+REGISTRY.subscribe(transiciones.publish)
+# Intervalo máximo (s) entre barridos de leases vencidos
+LEASE_SWEEP_MAX = float(os.getenv("LEASE_SWEEP_MAX", "1"))
+
+async def _barrido_leases():
+    # Duerme hasta el próximo vencimiento (como mucho LEASE_SWEEP_MAX) y pasa
+    # a offline a quien no haya renovado su lease, sin esperar a una consulta
+    while True:
+        proximo = REGISTRY.expire_due()
+        espera = LEASE_SWEEP_MAX if proximo is None else proximo - time.time()
+        await asyncio.sleep(min(max(espera, 0.01), LEASE_SWEEP_MAX))
+
+# Peticiones pendientes y latencia EWMA por agente, observadas en las
+# query/response que pasan por el broker (LOAD_EWMA_ALPHA, LOAD_STALE_SECONDS);
+# con el registro compartido, en su mismo fichero
+carga = SQLiteLoadTracker(REGISTRY.path) if isinstance(REGISTRY, SQLiteRegistry) else LoadTracker()
+
+# Reenvío asíncrono con pool keep-alive y concurrencia acotada por destinatario
+forwarder = Forwarder()
+
+def _callback_url(agent_id: str) -> Optional[str]:
+    info = REGISTRY.get(agent_id)
+    return info["callback_url"] if info else None
+
+# Sesiones WebSocket persistentes de los agentes conectados (/agent/ws)
+sesiones = WebSocketSessions()
+
+# Cola de salida durable: /agent/send persiste y responde 202; un worker por
+# destinatario entrega con reintentos (OUTBOX_PATH, OUTBOX_MAX_ATTEMPTS, ...),
+# por la sesión WebSocket del agente si la tiene y si no por su callback_url
+outbox = Outbox(forwarder, _callback_url, push=sesiones.push)
+
+_tareas: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_event():
+    transiciones.bind(asyncio.get_running_loop())
+    _tareas.append(asyncio.create_task(_barrido_leases()))
+    await outbox.start()
+    await asyncio.to_thread(_preparar_lago)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for tarea in _tareas:
+        tarea.cancel()
+    await outbox.close()
+    await forwarder.aclose()
+    pool.close()
+
 # —————————————————————————————————————————————————————————————————————————————
 # DESCUBRIMIENTO DE AGENTES POR CAPACIDAD
 # —————————————————————————————————————————————————————————————————————————————
@@ -43,20 +121,14 @@ def discover_agents(
     Devuelve los agent_id de agentes que cumplan las capacidades solicitadas.
     Si no se pasa ningún filtro, devuelve todos.
     """
-    now = datetime.now(timezone.utc)
     found: Dict[str, Any] = {}
-    for aid, info in AGENTS.items():
-        caps = info.get("capabilities", {})
-        if role and caps.get("role") != role:
-            continue
-        if tool and caps.get("tool") != tool:
-            continue
-        last = info.get("last_heartbeat")
+    for aid in REGISTRY.find(role=role, tool=tool):
+        info = REGISTRY.get(aid)
         found[aid] = {
             "name": info["name"],
-            "capabilities": caps,
+            "capabilities": info.get("capabilities", {}),
             "callback_url": info["callback_url"],
-            "online": bool(last and (now - last).total_seconds() < 2 * HEARTBEAT_INTERVAL)
+            "online": REGISTRY.is_online(aid)
         }
     return found
 
@@ -72,36 +144,37 @@ def register_agent(info: AgentInfo):
     payload["agent_id"] = agent_id
     # Asegurar que callback_url es str
     payload["callback_url"] = str(payload.get("callback_url"))
-    # Guardar en memoria
-    AGENTS[agent_id] = payload
+    # Guardar en el registro (e indexar por capacidades)
+    REGISTRY.register(payload)
     return {"agent_id": agent_id}
 
 # —————————————————————————————————————————————————————————————————————————————
 # AGENT CARD: DINAMIC AGENT DISCOVERY
 # —————————————————————————————————————————————————————————————————————————————
+# Agent Card común a /agent/cards y /agent/services
+def _card(aid: str, info: dict, online: bool) -> Dict[str, Any]:
+    last = info.get("last_heartbeat")
+    return {
+        "agent_id":      aid,
+        "name":          info["name"],
+        "callback_url":  info["callback_url"],
+        "capabilities":  info.get("capabilities", {}),
+        "last_heartbeat": last if last else None,
+        "online":        online,
+        "load":          carga.load(aid),
+    }
+
 @app.get("/agent/cards")
 # Devuelve el Agent Card de todos los agentes registrados: name, callback_url,
 # capabilities, last_heartbeat (ISO) y online (bool)
 def agent_cards():
-    now = datetime.now(timezone.utc)
-    cards: Dict[str, Any] = {}
-    for aid, info in AGENTS.items():
-        last = info.get("last_heartbeat")
-        online = bool(last and (now - last).total_seconds() < (2 * HEARTBEAT_INTERVAL))
-        cards[aid] = {
-            "agent_id": aid,
-            "name": info["name"],
-            "callback_url": info["callback_url"],
-            "capabilities": info["capabilities"],
-            "last_heartbeat": last if last else None,
-            "online": online,
-        }
-    return cards
+    online = REGISTRY.online_ids()
+    return {aid: _card(aid, info, aid in online) for aid, info in REGISTRY.items()}
 
 @app.get("/agent/card/{agent_id}")
 # Devuelve el Agent Card del agente con ID dado
 def get_agent_card(agent_id: str):
-    card = AGENTS.get(agent_id)
+    card = REGISTRY.get(agent_id)
     if not card:
         raise HTTPException(404, f"Agent '{agent_id}' no registrado")
     return card
@@ -111,79 +184,206 @@ def get_agent_card(agent_id: str):
 # —————————————————————————————————————————————————————————————————————————————
 @app.get("/agent/services", response_model=Dict[str, Any])
 def service_cards(service: str):
-    now = datetime.now(timezone.utc)
-    results = {}
-    for aid, info in AGENTS.items():
-        caps = info.get("capabilities", {})
-        if caps.get("tool") != service and caps.get("role") != service:
-            continue
-        last = info.get("last_heartbeat")
-        online = bool(last and (now - last).total_seconds() < 2 * HEARTBEAT_INTERVAL)
-        results[aid] = {
-            "agent_id":      aid,
-            "name":          info["name"],
-            "callback_url":  info["callback_url"],
-            "capabilities":  caps,
-            "last_heartbeat": last if last else None,
-            "online":        online,
-        }
-    return results
+    # Solo se recorren los agentes cuyo 'tool' o 'role' coincide con el
+    # servicio, y solo de ellos se consulta la liveness
+    return {
+        aid: _card(aid, info, REGISTRY.is_online(aid))
+        for aid in REGISTRY.find_any(service, ("tool", "role"))
+        if (info := REGISTRY.get(aid)) is not None
+    }
 
 # —————————————————————————————————————————————————————————————————————————————
 # ENVÍO DE MENSAJES JAR-A2A (query/response)
 # —————————————————————————————————————————————————————————————————————————————
-@app.post("/agent/send")
-def send_message(env: Envelope):
+def _leer_envelope(datos: bytes, media_type: str) -> tuple:
+    # Solo se decodifica para leer la cabecera de enrutado; el payload no se
+    # valida ni se vuelve a serializar (lo persistido son los bytes recibidos)
+    try:
+        codec = codec_para(media_type)
+    except ValueError as e:
+        raise HTTPException(415, str(e))
+    try:
+        return cabecera(codec.decode(datos))
+    except Exception as e:
+        raise HTTPException(422, f"Envelope inválido: {e}")
+
+def _observar_carga(tipo: str, sender: str, recipient: str, clave: str):
+    if tipo == "query":
+        carga.query(recipient, clave)
+    elif tipo == "response":
+        carga.response(sender, clave)
+
+@app.post("/agent/send", status_code=202)
+async def send_message(request: Request):
     """
-    Recibe un Envelope A2A, verifica recipient y reenvía
-    únicamente payload al callback_url del destinatario.
+    Recibe un Envelope A2A (JSON o MessagePack, según Content-Type),
+    verifica recipient y lo deja en la cola de salida durable; la entrega
+    al callback_url del destinatario se hace después, con reintentos, sin
+    que el emisor espere al receptor.
     """
+    media_type = request.headers.get("content-type", JSON_MEDIA)
+    datos = await request.body()
+    message_id, tipo, sender, recipient, clave = _leer_envelope(datos, media_type)
+    # Cualquier envelope del emisor renueva su lease (latido implícito)
+    REGISTRY.heartbeat(sender, datetime.now(timezone.utc))
+
     # 1) Asegurarnos de que el destinatario existe
-    if env.recipient not in AGENTS:
-        raise HTTPException(404, f"Recipient '{env.recipient}' no registrado")
+    if recipient not in REGISTRY:
+        raise HTTPException(404, f"Recipient '{recipient}' no registrado")
+    _observar_carga(tipo, sender, recipient, clave)
+
+    # 2) persistir el Envelope tal como llegó y responder
+    nuevo = await outbox.encolar(message_id, recipient, clave, datos, codec_para(media_type).media_type)
+    return {"status": "queued" if nuevo else "duplicate"}
+
+@app.get("/agent/outbox/stats")
+async def outbox_stats():
+    return await outbox.stats()
 
-    callback_url = AGENTS[env.recipient]["callback_url"]
+@app.get("/agent/outbox/dead")
+# Mensajes en dead-letter (los más recientes primero)
+async def outbox_dead(limit: int = Query(100, ge=1, le=1000)):
+    return await outbox.dead_letters(limit)
 
-    # 2) reenvío HTTP POST -> /inbox del agente
+@app.post("/agent/outbox/dead/{message_id}/retry")
+async def outbox_retry(message_id: str):
+    if not await outbox.reintentar(message_id):
+        raise HTTPException(404, f"Mensaje '{message_id}' no está en dead-letter")
+    return {"status": "queued"}
+
+# —————————————————————————————————————————————————————————————————————————————
+# CANAL WEBSOCKET PERSISTENTE POR AGENTE
+# —————————————————————————————————————————————————————————————————————————————
+@app.websocket("/agent/ws/{agent_id}")
+async def agent_ws(ws: WebSocket, agent_id: str):
+    """
+    Sesión bidireccional con un agente registrado. Cada frame es un Envelope
+    (JSON en frames de texto, MessagePack en binarios): los heartbeats
+    actualizan el registro y el resto se encola como si llegara por
+    /agent/send. En sentido contrario, el outbox empuja por aquí
+    los envelopes destinados al agente en lugar de hacer POST a su /inbox.
+    """
+    if agent_id not in REGISTRY:
+        await ws.close(code=4404)
+        return
+    await ws.accept()
+    anterior = sesiones.add(agent_id, ws)
+    if anterior is not None:
+        try:
+            await anterior.close(code=4000)
+        except Exception:
+            pass
+    REGISTRY.heartbeat(agent_id, datetime.now(timezone.utc))
+    # Lo que estuviera pendiente para el agente sale ya por la sesión nueva
+    outbox.despertar(agent_id)
     try:
-        # convertir el Envelope a un JSON serializable
-        payload = jsonable_encoder(env)
-        # convertir datetimes a ISO strings
-        resp = requests.post(callback_url, json=payload, timeout=20)
-        resp.raise_for_status()
-    except Exception as e:
-        raise HTTPException(502, f"Error reenviando mensaje A2A: {e}")
+        while True:
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            sesiones.recibidos += 1
+            # Cualquier frame renueva el lease del agente (latido implícito)
+            REGISTRY.heartbeat(agent_id, datetime.now(timezone.utc))
+            if frame.get("bytes") is not None:
+                datos, media_type = frame["bytes"], MSGPACK_MEDIA
+            else:
+                datos, media_type = frame["text"].encode(), JSON_MEDIA
+            try:
+                message_id, tipo, _, recipient, clave = _leer_envelope(datos, media_type)
+            except HTTPException as e:
+                logger.warning(f"[WS] envelope inválido de {agent_id}: {e.detail}")
+                continue
+            if tipo == "heartbeat":
+                continue  # ya contado arriba
+            if recipient not in REGISTRY:
+                logger.warning(f"[WS] recipient '{recipient}' no registrado, envelope {message_id} descartado")
+                continue
+            _observar_carga(tipo, agent_id, recipient, clave)
+            await outbox.encolar(message_id, recipient, clave, datos, media_type)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sesiones.remove(agent_id, ws)
 
-    return {"status": "sent"}
+@app.get("/agent/ws/stats")
+def ws_stats():
+    return sesiones.stats()
 
 # —————————————————————————————————————————————————————————————————————————————
 # RECEPCIÓN DE HEARTBEAT A2A
 # —————————————————————————————————————————————————————————————————————————————
 @app.post("/agent/heartbeat")
-def agent_heartbeat(env: Envelope):
-    if env.type != "heartbeat":
+async def agent_heartbeat(request: Request):
+    # Solo se lee la cabecera del envelope; el lease se renueva desde ahora
+    media_type = request.headers.get("content-type", JSON_MEDIA)
+    _, tipo, sender, _, _ = _leer_envelope(await request.body(), media_type)
+    if tipo != "heartbeat":
         raise HTTPException(400, "Tipo de envelope inválido para heartbeat")
-    sender = env.sender
-    if sender not in AGENTS:
+    # Actualizamos el timestamp (y el estado online del agente)
+    if not REGISTRY.heartbeat(sender, datetime.now(timezone.utc)):
         raise HTTPException(404, f"Agent '{sender}' no registrado")
-    # Actualizamos el timestamp
-    AGENTS[sender]["last_heartbeat"] = env.timestamp.astimezone(timezone.utc)
     return {"status": "ok"}
 
+@app.post("/agent/heartbeat/batch")
+async def agent_heartbeat_batch(request: Request):
+    """
+    Latido agrupado para hosts que ejecutan muchos agentes:
+    {"agent_ids": [...]} en JSON o MessagePack. Devuelve los no registrados.
+    """
+    media_type = request.headers.get("content-type", JSON_MEDIA)
+    try:
+        cuerpo = codec_para(media_type).decode(await request.body())
+        agent_ids = cuerpo["agent_ids"]
+        if not isinstance(agent_ids, list):
+            raise ValueError("agent_ids debe ser una lista")
+    except ValueError as e:
+        raise HTTPException(415 if "Content-Type" in str(e) else 422, str(e))
+    except Exception as e:
+        raise HTTPException(422, f"Cuerpo inválido: {e}")
+    desconocidos = REGISTRY.heartbeat_many(agent_ids, datetime.now(timezone.utc))
+    return {"renovados": len(agent_ids) - len(desconocidos), "desconocidos": desconocidos}
+
+# —————————————————————————————————————————————————————————————————————————————
+# TRANSICIONES ONLINE/OFFLINE
+# —————————————————————————————————————————————————————————————————————————————
+@app.get("/agent/transitions")
+# Transiciones recientes con seq > since
+def agent_transitions(since: int = Query(0, ge=0)):
+    return {"seq": transiciones.seq, "transiciones": transiciones.since(since)}
+
+@app.get("/agent/transitions/stream")
+# Transiciones en vivo como Server-Sent Events (evento 'transicion')
+async def agent_transitions_stream(request: Request):
+    cola = transiciones.subscribe()
+
+    async def eventos():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: transicion\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            transiciones.unsubscribe(cola)
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
 # —————————————————————————————————————————————————————————————————————————————
 # ESTADO DE AGENTES REGISTRADOS
 # —————————————————————————————————————————————————————————————————————————————
 @app.get("/agent/status")
 def agent_status():
-    now = datetime.now(timezone.utc)
+    online = REGISTRY.online_ids()
     status: Dict[str, Any] = {}
-    for aid, info in AGENTS.items():
+    for aid, info in REGISTRY.items():
         last = info.get("last_heartbeat")
         status[aid] = {
             "name": info["name"],
             "last_heartbeat": last if last else None,
-            # marcamos online si hemos recibido un latido en los últimos 2 * HEARTBEAT_INTERVAL
-            "online": bool(last and (now - last).total_seconds() < (2*HEARTBEAT_INTERVAL))
+            # online si hemos recibido un latido en los últimos 2 * HEARTBEAT_INTERVAL
+            "online": aid in online
         }
     return status
 
@@ -191,27 +391,378 @@ def agent_status():
 # ENDPOINTS DE CONSULTA MCP
 # —————————————————————————————————————————————————————————————————————————————
 DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'lake.duckdb'))
-con = duckdb.connect(DB_PATH)
-con.execute("LOAD iceberg;")
+# Pool de cursores: cada consulta usa un cursor propio (DUCKDB_POOL_SIZE,
+# DUCKDB_READ_ONLY) y las consultas de distintos hilos corren en paralelo
+pool = CursorPool(DB_PATH, init_sql=["LOAD iceberg;"])
+
+# Caché de resultados indexada por SQL normalizado + versión del lake
+# (QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_ROWS)
+lake_version = TableVersion()
+query_cache = QueryCache()
+
+# iceberg_space.ventas como Parquet particionado por mes (y bucket de
+# producto) bajo VENTAS_LAKE_DIR: cada SELECT se reescribe para leer solo los
+# ficheros cuyo min/max de fecha/producto encaja con su WHERE
+lago = VentasLake()
+
+# Rollup diario × producto (VENTAS_ROLLUP_DIR) que responde los agregados que
+# encajan; se refresca en segundo plano con cada versión nueva del lago
+rollup = VentasRollup(lago)
+_refresco_rollup = threading.Lock()
+
+def _preparar_lago():
+    # Primer arranque: la tabla DuckDB existente se importa al lago (también
+    # a un lago ya creado que aún no tenga sus filas). Con la
+    # base en lectura/escritura, iceberg_space.ventas pasa a ser una vista
+    # sobre los ficheros del manifiesto (para lo que no se reescribe)
+    try:
+        with pool.cursor() as cur:
+            legado = cur.execute(
+                "SELECT 1 FROM duckdb_tables() WHERE schema_name = ? AND table_name = ?",
+                [lago.schema, lago.nombre],
+            ).fetchone() is not None
+            if lago.inicializar(cur, lago.tabla if legado else None):
+                logger.info(f"[Lago] {lago.tabla} importada a {lago.root}: {lago.stats()['filas']} filas")
+            if not pool.read_only:
+                # Solo con sus filas ya en el lago: si no, al cambiarla por la
+                # vista desaparecerían de iceberg_space.ventas
+                if legado and lago.importada():
+                    cur.execute(f"ALTER TABLE {lago.tabla} RENAME TO {lago.nombre}_importada")
+                cur.execute(f"CREATE SCHEMA IF NOT EXISTS {lago.schema}")
+                cur.execute(lago.sql_vista())
+    except Exception as e:
+        logger.error(f"[Lago] no se pudo preparar {lago.tabla}: {e}")
+        return
+    _refrescar_rollup(esperar=True)
+
+def _refrescar_rollup(esperar: bool = False):
+    # Uno a la vez por proceso (entre procesos, el bloqueo del rollup); hasta
+    # que termine, los agregados se responden desde los ficheros del lago
+    if not _refresco_rollup.acquire(blocking=False):
+        return
+
+    def tarea():
+        try:
+            while not rollup.al_dia():
+                r = rollup.refrescar()
+                if r:
+                    logger.info(f"[Rollup] {r['ficheros']} ficheros del lago agregados "
+                                f"({r['filas']} filas, versión {r['version']})")
+        except Exception as e:
+            logger.warning(f"[Rollup] no se pudo refrescar: {e}")
+        finally:
+            _refresco_rollup.release()
+
+    if esperar:
+        tarea()
+    else:
+        threading.Thread(target=tarea, daemon=True).start()
+
+def _version_lago() -> str:
+    # Token de la caché: cambia con las escrituras por SQL y con cada versión
+    # nueva del manifiesto, también si la publica otro proceso (la ingesta)
+    nuevo = lake_version.observar(lago.version())
+    if nuevo is not None:
+        query_cache.invalidate(nuevo)
+        if not pool.read_only and lago.existe():
+            try:
+                with pool.cursor() as cur:
+                    cur.execute(lago.sql_vista())
+            except Exception as e:
+                logger.warning(f"[Lago] no se pudo refrescar la vista {lago.tabla}: {e}")
+        _refrescar_rollup()
+    return lake_version.token()
+
+def _sql_lago(sql: str, tipo: str) -> Tuple[str, str]:
+    # (sql, fuente): los SELECT de agregación que encajan leen del rollup y
+    # el resto de referencias a la tabla, los ficheros del lago que hacen falta
+    if tipo != "lectura":
+        return sql, "duckdb"
+    sql, agregados = rollup.reescribir(sql)
+    sql, ficheros = lago.reescribir(sql)
+    if agregados:
+        return sql, "rollup+ventas" if ficheros else "rollup"
+    return sql, "ventas" if ficheros else "duckdb"
+
+# Límites de cada consulta: presupuesto de tiempo (QUERY_TIMEOUT, cancelada
+# con interrupt), filas devueltas (QUERY_MAX_ROWS) y estimación del plan
+# (QUERY_MAX_SCAN_ROWS, QUERY_MAX_JOIN_ROWS)
+guard = QueryGuard()
+
+# Resultados paginados (?pagina=), troceados en disco hasta leer la última
+# página (QUERY_CURSOR_DIR, QUERY_CURSOR_TTL)
+cursores = ResultCursors()
+
+# Productos y rango de fechas, recalculados solo cuando cambia la versión y
+# solo con los ficheros nuevos del lago
+metadata = TableMetadata(pool, _version_lago, reescribir=lambda sql: _sql_lago(sql, "lectura")[0],
+                         lago=lago)
+
+@app.get("/tool/cache/stats")
+# Aciertos, fallos y ocupación de la caché de consultas, y resultados paginados
+def estadisticas_cache():
+    return dict(query_cache.stats(), cursores=cursores.stats())
+
+@app.get("/tool/guard/stats")
+# Límites configurados y consultas rechazadas, interrumpidas y truncadas
+def estadisticas_guard():
+    return dict(guard.stats(), memory_limit=pool.memory_limit, threads=pool.threads)
+
+@app.get("/tool/lake/stats")
+# Ficheros, filas y particiones del lago, ficheros leídos/podados y rollup
+def estadisticas_lago():
+    return dict(lago.stats(), rollup=rollup.stats())
 
 @app.get("/tool/consulta")
-# Ejecutar consulta MCP
-def ejecutar_consulta(sql: str):
+# Ejecutar consulta MCP. El formato se negocia con la cabecera Accept:
+#   application/json (por defecto) → {"resultado": [ {col: valor}, ... ]}
+#   application/vnd.apache.arrow.stream → Arrow IPC stream por lotes
+#   application/x-ndjson → una fila JSON por línea, por lotes
+# "fuente" (cabecera X-Fuente en streaming) indica quién respondió: rollup,
+# ventas (ficheros del lago), rollup+ventas, duckdb (sin la tabla) o cache.
+# "meta" (cabecera X-Consulta-Meta) lleva los límites aplicados, la
+# estimación del plan, la duración y si el resultado se truncó o se canceló.
+# ?timeout= (s) y ?max_filas= ajustan el presupuesto dentro de los máximos.
+# ?pagina=N pagina un SELECT en JSON: la consulta se ejecuta una vez y la
+# respuesta trae la primera página y "cursor" para pedir la siguiente
+# (?cursor=, con la misma sql), o null en la última.
+# iceberg_space.ventas es una vista sobre el lago: un INSERT INTO sobre ella
+# se escribe como ficheros nuevos del lago (respuesta JSON con "Count") y el
+# resto de modificaciones (UPDATE, DELETE...) se rechazan con un error.
+def ejecutar_consulta(
+    sql: str,
+    request: Request,
+    timeout: Optional[float] = Query(None, gt=0),
+    max_filas: Optional[int] = Query(None, ge=1),
+    pagina: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+):
+    formato = negociar_formato(request.headers.get("accept"))
+    tipo = tipo_sentencia(sql)
+    segundos, limite = guard.presupuesto(timeout, max_filas)
+    meta = _meta(segundos, limite)
+    if cursor is not None and (formato != JSON or tipo != "lectura"):
+        return {"error": "Los cursores solo sirven para un SELECT con respuesta JSON", "meta": meta}
+    if tipo == "escritura":
+        respuesta = _escritura_lago(sql, meta)
+        if respuesta is not None:
+            return respuesta
+    if formato != JSON:
+        return _consulta_streaming(sql, formato, tipo, meta)
+    if cursor is not None:
+        return _pagina_siguiente(sql, cursor, meta)
+    if tipo != "lectura":
+        pagina = None
+
+    # Las lecturas repetidas sobre la misma versión del lake salen de caché
+    token = _version_lago()
+    if tipo == "lectura":
+        datos = query_cache.get(sql, token)
+        if datos is not None:
+            return _respuesta(sql, datos, "cache", meta, pagina)
+    inicio = time.perf_counter()
+    reloj = None
     try:
-        resultado = con.execute(sql).fetchall()
-        columnas = [desc[0] for desc in con.description]
+        sql_real, fuente = _sql_lago(sql, tipo)
+        with pool.cursor() as cur, guard.cronometro(cur, segundos) as reloj:
+            rechazo = _comprobar_plan(cur, sql_real, tipo, meta)
+            if rechazo:
+                return {"error": rechazo, "fuente": fuente, "meta": meta}
+            cur.execute(sql_real)
+            columnas = [desc[0] for desc in cur.description] if cur.description else []
+            # Una fila de más para saber si hay que truncar; DuckDB no
+            # calcula el resto del resultado
+            resultado = cur.fetchmany(limite + 1)
         datos = [dict(zip(columnas, fila)) for fila in resultado]
-        return {"resultado": datos}
+    except Exception as e:
+        return _error_consulta(e, reloj, meta, inicio)
+    finally:
+        if tipo == "escritura":
+            _tras_escritura()
+    meta["ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    # Solo se cachean resultados completos
+    if tipo == "lectura" and len(datos) <= limite:
+        query_cache.put(sql, token, datos)
+    return _respuesta(sql, datos, fuente, meta, pagina)
+
+def _pagina_siguiente(sql: str, cursor: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    # Página ya calculada en la ejecución que abrió el cursor
+    pagina = cursores.siguiente(cursor, sql)
+    if pagina is None:
+        return {"error": "Cursor no válido o caducado; repite la consulta sin cursor", "meta": meta}
+    filas, siguiente, info = pagina
+    meta["pagina"] = info
+    meta["filas"] = len(filas)
+    meta["truncado"] = info["truncado"]
+    return {"resultado": filas, "fuente": "cursor", "meta": meta, "cursor": siguiente}
+
+def _error_consulta(e: Exception, reloj, meta: Dict[str, Any], inicio: float) -> Dict[str, Any]:
+    meta["ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    if reloj is not None and reloj.interrumpida:
+        meta["interrumpida"] = True
+        return {"error": f"Consulta cancelada: superó el presupuesto de {meta['timeout_s']:g} s", "meta": meta}
+    return {"error": str(e), "meta": meta}
+
+def _meta(segundos: float, limite: int) -> Dict[str, Any]:
+    return {
+        "timeout_s": segundos,
+        "max_filas": limite,
+        "max_filas_escaneadas": guard.max_escaneo,
+        "max_filas_join": guard.max_join,
+        # De la instancia DuckDB, compartidos con las demás consultas
+        "memory_limit": pool.memory_limit,
+        "threads": pool.threads,
+    }
+
+def _comprobar_plan(cur, sql: str, tipo: str, meta: Dict[str, Any]) -> Optional[str]:
+    # EXPLAIN de las lecturas: error si el plan estimado excede los límites
+    if tipo != "lectura":
+        return None
+    meta["estimacion"] = guard.estimar(cur, sql)
+    motivo = guard.motivo_rechazo(meta["estimacion"])
+    return f"Consulta rechazada: {motivo}" if motivo else None
+
+def _respuesta(sql: str, datos: List[Dict[str, Any]], fuente: str, meta: Dict[str, Any],
+               pagina: Optional[int] = None) -> Dict[str, Any]:
+    limite = meta["max_filas"]
+    meta["truncado"] = len(datos) > limite
+    if meta["truncado"]:
+        guard.truncada()
+    datos = datos[:limite]
+    if pagina is None:
+        meta["filas"] = len(datos)
+        return {"resultado": datos, "fuente": fuente, "meta": meta}
+    # Paginada: el resto de páginas sale de este mismo resultado
+    datos, siguiente, meta["pagina"] = cursores.abrir(sql, datos, min(pagina, limite), meta["truncado"])
+    meta["filas"] = len(datos)
+    return {"resultado": datos, "fuente": fuente, "meta": meta, "cursor": siguiente}
+
+def _escritura_lago(sql: str, meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Las escrituras sobre la vista de iceberg_space.ventas van al lago
+    # (None si la sentencia no la modifica). Con la base en solo lectura la
+    # vista no se crea y DuckDB responde como con cualquier otra escritura.
+    if pool.read_only or not lago.existe():
+        return None
+    try:
+        fuente = lago.insercion(sql)
+    except ValueError as e:
+        return {"error": str(e), "meta": meta}
+    if fuente is None:
+        return None
+    inicio = time.perf_counter()
+    reloj = None
+    try:
+        with pool.cursor() as cur, guard.cronometro(cur, meta["timeout_s"]) as reloj:
+            escrito = lago.escribir(cur, fuente)
+    except Exception as e:
+        return _error_consulta(e, reloj, meta, inicio)
+    finally:
+        _tras_escritura()
+    logger.info(f"[Lago] INSERT en {lago.tabla}: {escrito['filas']} filas en "
+                f"{escrito['ficheros']} ficheros (versión {escrito['version']})")
+    meta["ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    return _respuesta(sql, [{"Count": escrito["filas"]}], "ventas", meta)
+
+def _tras_escritura():
+    # Nueva versión del lake: los resultados cacheados y los metadatos dejan
+    # de ser válidos (estos últimos se recalculan en la siguiente petición)
+    query_cache.invalidate(lake_version.bump())
+
+class _StreamingConCursor(StreamingResponse):
+    # StreamingResponse cuyo cuerpo tiene prestado un cursor del pool.
+    # al_cerrar() se llama siempre al acabar el envío, también si el cliente
+    # se desconecta o send falla antes de empezar a iterar el cuerpo, cuando
+    # el finally del generador nunca llega a ejecutarse.
+    def __init__(self, contenido, al_cerrar, **kwargs):
+        super().__init__(contenido, **kwargs)
+        self.al_cerrar = al_cerrar
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.al_cerrar()
+
+def _consulta_streaming(sql: str, formato: str, tipo: str, meta: Dict[str, Any]):
+    if formato == ARROW_STREAM and pa is None:
+        return JSONResponse(status_code=406, content={"error": "pyarrow no está instalado en el servidor"})
+    try:
+        cur = pool.acquire()
     except Exception as e:
         return {"error": str(e)}
+    # El presupuesto cubre también el envío: al agotarse se corta el stream
+    reloj = guard.iniciar(cur, meta["timeout_s"])
+    una_vez = threading.Lock()
+    empezado = False
+
+    def liberar():
+        # Idempotente: la llaman el generador y la respuesta, lo que ocurra
+        if una_vez.acquire(blocking=False):
+            guard.terminar(reloj)
+            pool.release(cur)
+
+    try:
+        sql_real, fuente = _sql_lago(sql, tipo)
+        rechazo = _comprobar_plan(cur, sql_real, tipo, meta)
+        if rechazo:
+            liberar()
+            return {"error": rechazo, "fuente": fuente, "meta": meta}
+        cur.execute(sql_real)
+    except Exception as e:
+        liberar()
+        if reloj.interrumpida:
+            meta["interrumpida"] = True
+            return {"error": f"Consulta cancelada: superó el presupuesto de {meta['timeout_s']:g} s", "meta": meta}
+        return {"error": str(e), "meta": meta}
+    finally:
+        if tipo == "escritura":
+            _tras_escritura()
+
+    # El cursor queda prestado hasta que se termina (o se corta) el streaming;
+    # una vez empezado lo libera el generador (al acabar o al cerrarse), nunca
+    # mientras otro hilo sigue leyendo de él
+    def cuerpo():
+        nonlocal empezado
+        empezado = True
+        try:
+            if formato == ARROW_STREAM:
+                yield from stream_arrow(cur, max_rows=meta["max_filas"])
+            else:
+                yield from stream_ndjson(cur, max_rows=meta["max_filas"])
+        except Exception:
+            # Cancelada a mitad: el cliente recibe un stream incompleto
+            if not reloj.interrumpida:
+                raise
+            logger.warning(f"[Consulta] streaming cancelado tras {meta['timeout_s']:g} s")
+        finally:
+            liberar()
+
+    def si_no_empezo():
+        if not empezado:
+            liberar()
+
+    cabeceras = {"X-Fuente": fuente, "X-Consulta-Meta": json.dumps(meta, ensure_ascii=True)}
+    return _StreamingConCursor(cuerpo(), si_no_empezo, media_type=formato, headers=cabeceras)
+
+@app.get("/tool/info/metadata")
+# Contexto MCP completo con versión. Admite If-None-Match → 304 Not Modified,
+# de modo que los clientes solo lo descargan cuando cambian los datos.
+def obtener_metadata(request: Request):
+    try:
+        snapshot = metadata.snapshot()
+    except Exception as e:
+        return {"error": str(e)}
+    version = snapshot["version"]
+    etag = f'"{version}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=snapshot, headers={"ETag": etag})
 
 @app.get("/tool/info/productos")
 # Contexto MCP
 def obtener_productos():
     try:
-        resultado = con.execute("SELECT DISTINCT producto FROM iceberg_space.ventas").fetchall()
-        productos = [fila[0] for fila in resultado]
-        return {"productos": productos}
+        return {"productos": metadata.snapshot()["productos"]}
     except Exception as e:
         return {"error": str(e)}
 
@@ -219,8 +770,7 @@ def obtener_productos():
 # Contexto MCP
 def obtener_rango_fechas():
     try:
-        resultado = con.execute("SELECT MIN(fecha), MAX(fecha) FROM iceberg_space.ventas").fetchone()
-        return {"min_fecha": str(resultado[0]), "max_fecha": str(resultado[1])}
+        snapshot = metadata.snapshot()
+        return {"min_fecha": snapshot["min_fecha"], "max_fecha": snapshot["max_fecha"]}
     except Exception as e:
         return {"error": str(e)}
-
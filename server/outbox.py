@@ -0,0 +1,351 @@
+# server/outbox.py
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from forwarder import Forwarder
+from wire_codec import JSON_MEDIA
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# Fichero SQLite de la cola de salida del broker
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", os.path.join(DATA_DIR, "outbox.sqlite"))
+# Intentos de entrega antes de mover el mensaje a dead-letter
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Backoff entre intentos: base * 2^(intento-1), con tope (s)
+OUTBOX_BASE_BACKOFF = float(os.getenv("OUTBOX_BASE_BACKOFF", "0.5"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "60"))
+# Mensajes que un worker entrega a la vez (uno por correlation_id)
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "16"))
+# Segundos que un mensaje queda reservado para el proceso que lo está
+# entregando (varios workers/réplicas comparten el fichero); si ese proceso
+# cae, pasado este plazo lo entrega otro
+OUTBOX_CLAIM_SECONDS = float(os.getenv("OUTBOX_CLAIM_SECONDS", "30"))
+# Segundos sin trabajo tras los que el worker de un destinatario termina
+OUTBOX_IDLE_SECONDS = float(os.getenv("OUTBOX_IDLE_SECONDS", "60"))
+
+logger = logging.getLogger("uvicorn.error")
+
+PENDIENTE = "pendiente"
+MUERTO = "muerto"
+
+# 4xx que sí pueden cambiar al repetir (el resto son rechazos definitivos)
+_4XX_TRANSITORIOS = {408, 425, 429}
+
+
+def _rechazo(e: Exception) -> Optional[int]:
+    # Código 4xx con el que el destinatario rechazó el envelope: repetir la
+    # entrega daría el mismo resultado
+    if isinstance(e, httpx.HTTPStatusError):
+        codigo = e.response.status_code
+        if 400 <= codigo < 500 and codigo not in _4XX_TRANSITORIOS:
+            return codigo
+    return None
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS mensajes (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id  TEXT NOT NULL UNIQUE,
+    recipient   TEXT NOT NULL,
+    clave       TEXT NOT NULL,
+    payload     BLOB NOT NULL,
+    media_type  TEXT NOT NULL DEFAULT 'application/json',
+    estado      TEXT NOT NULL DEFAULT 'pendiente',
+    intentos    INTEGER NOT NULL DEFAULT 0,
+    proximo     REAL NOT NULL,
+    error       TEXT,
+    creado      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mensajes_cola ON mensajes (recipient, estado, clave, id);
+"""
+
+
+class Outbox:
+    """
+    Cola de salida durable del broker (store-and-forward).
+
+    /agent/send solo persiste el envelope en SQLite y responde; un worker
+    por destinatario lo entrega después con el Forwarder, con reintentos y
+    backoff exponencial. Dentro de un destinatario, los mensajes de un mismo
+    correlation_id se entregan en orden: solo el más antiguo pendiente de
+    cada clave es elegible. Tras OUTBOX_MAX_ATTEMPTS fallos el mensaje pasa
+    a dead-letter (estado 'muerto') y deja paso al siguiente; si el
+    destinatario lo rechaza con un 4xx, sin más intentos. Un mensaje
+    repetido (mismo message_id, p. ej. una retransmisión) no se encola dos
+    veces mientras siga pendiente. Lo pendiente sobrevive a un reinicio.
+
+    El envelope se guarda y se entrega tal como llegó (bytes + media type):
+    el broker no lo vuelve a validar ni a serializar. Si se pasa `push`, se
+    intenta primero (p. ej. la sesión WebSocket del destinatario); si
+    devuelve False se usa el callback HTTP.
+
+    Varios procesos pueden compartir el fichero: cada lote se reserva
+    durante OUTBOX_CLAIM_SECONDS en la transacción que lo selecciona.
+    """
+
+    def __init__(
+        self,
+        forwarder: Forwarder,
+        resolver: Callable[[str], Optional[str]],
+        path: str = OUTBOX_PATH,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        base_backoff: float = OUTBOX_BASE_BACKOFF,
+        max_backoff: float = OUTBOX_MAX_BACKOFF,
+        batch: int = OUTBOX_BATCH,
+        idle_seconds: float = OUTBOX_IDLE_SECONDS,
+        claim_seconds: float = OUTBOX_CLAIM_SECONDS,
+        push: Optional[Callable[[str, bytes, str], Awaitable[bool]]] = None,
+    ):
+        self.forwarder = forwarder
+        self.resolver = resolver            # agent_id -> callback_url | None
+        self.push = push                    # (agent_id, datos, media) -> entregado
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.batch = max(1, batch)
+        self.idle_seconds = idle_seconds
+        self.claim_seconds = claim_seconds
+        self._con: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._eventos: Dict[str, asyncio.Event] = {}
+        self.entregados = 0
+        self.fallos = 0
+        self.rechazados = 0
+
+    # — ciclo de vida —
+    async def start(self):
+        await asyncio.to_thread(self._abrir)
+        for recipient in await asyncio.to_thread(self._destinatarios_pendientes):
+            self.despertar(recipient)
+
+    async def close(self):
+        for tarea in self._workers.values():
+            tarea.cancel()
+        self._workers.clear()
+        self._eventos.clear()
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    # — API —
+    async def encolar(self, message_id: str, recipient: str, clave: str,
+                      datos: bytes, media_type: str = JSON_MEDIA) -> bool:
+        """
+        Persiste el envelope ya codificado (`datos`, en `media_type`) para su
+        destinatario; `clave` es su clave de orden (correlation_id). False si
+        ese message_id ya estaba en la cola.
+        """
+        nuevo = await asyncio.to_thread(
+            self._insertar, message_id, recipient, clave, datos, media_type
+        )
+        self.despertar(recipient)
+        return nuevo
+
+    async def reintentar(self, message_id: str) -> bool:
+        """Devuelve un mensaje de dead-letter a la cola. False si no existe."""
+        recipient = await asyncio.to_thread(self._resucitar, message_id)
+        if recipient is None:
+            return False
+        self.despertar(recipient)
+        return True
+
+    async def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._muertos, limit)
+
+    async def stats(self) -> Dict[str, Any]:
+        por_estado, por_destinatario = await asyncio.to_thread(self._contar)
+        return {
+            "por_estado": por_estado,
+            "pendientes_por_destinatario": por_destinatario,
+            "workers": len(self._workers),
+            "entregados": self.entregados,
+            "fallos": self.fallos,
+            "rechazados": self.rechazados,
+        }
+
+    # — workers —
+    def despertar(self, recipient: str):
+        evento = self._eventos.get(recipient)
+        if evento is None:
+            evento = self._eventos[recipient] = asyncio.Event()
+        evento.set()
+        if recipient not in self._workers:
+            self._workers[recipient] = asyncio.create_task(self._worker(recipient, evento))
+
+    async def _worker(self, recipient: str, evento: asyncio.Event):
+        try:
+            while True:
+                evento.clear()
+                lote, proximo = await asyncio.to_thread(self._siguientes, recipient, time.time())
+                if lote:
+                    await asyncio.gather(*(self._entregar(recipient, *fila) for fila in lote))
+                    continue
+                espera = self.idle_seconds if proximo is None else max(0.0, proximo - time.time())
+                try:
+                    await asyncio.wait_for(evento.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    if proximo is None and not evento.is_set():
+                        break  # sin nada pendiente: el worker termina
+        finally:
+            if self._workers.get(recipient) is asyncio.current_task():
+                del self._workers[recipient]
+                self._eventos.pop(recipient, None)
+
+    async def _entregar(self, recipient: str, fila_id: int, message_id: str,
+                        datos: bytes, media_type: str, intentos: int):
+        if isinstance(datos, str):  # filas guardadas como texto JSON
+            datos = datos.encode()
+        try:
+            if self.push is None or not await self.push(recipient, datos, media_type):
+                callback_url = self.resolver(recipient)
+                if callback_url is None:
+                    raise RuntimeError(f"Recipient '{recipient}' no registrado")
+                await self.forwarder.forward_raw(callback_url, datos, media_type)
+        except Exception as e:
+            self.fallos += 1
+            intentos += 1
+            codigo = _rechazo(e)
+            muerto = intentos >= self.max_attempts or codigo is not None
+            espera = min(self.base_backoff * 2 ** (intentos - 1), self.max_backoff)
+            await asyncio.to_thread(self._fallo, fila_id, intentos, time.time() + espera, str(e), muerto)
+            if codigo is not None:
+                self.rechazados += 1
+                logger.error(f"[Outbox] {message_id} rechazado por {recipient} ({codigo}), a dead-letter: {e}")
+            elif muerto:
+                logger.error(f"[Outbox] {message_id} → {recipient} a dead-letter tras {intentos} intentos: {e}")
+            else:
+                logger.warning(f"[Outbox] entrega de {message_id} → {recipient} fallida "
+                               f"(intento {intentos}), reintento en {espera:.1f}s: {e}")
+            return
+        self.entregados += 1
+        await asyncio.to_thread(self._borrar, fila_id)
+
+    # — SQLite (se ejecuta en hilos, serializado por _lock) —
+    def _abrir(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            self._con = sqlite3.connect(self.path, check_same_thread=False,
+                                        isolation_level=None, timeout=5)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: lo confirmado sobrevive a la caída del proceso
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._con.executescript(_ESQUEMA)
+            columnas = {c[1] for c in self._con.execute("PRAGMA table_info(mensajes)")}
+            if "media_type" not in columnas:  # colas creadas antes de los codecs
+                self._con.execute(
+                    "ALTER TABLE mensajes ADD COLUMN media_type TEXT NOT NULL DEFAULT 'application/json'"
+                )
+
+    def _insertar(self, message_id: str, recipient: str, clave: str,
+                  datos: bytes, media_type: str) -> bool:
+        with self._lock:
+            cur = self._con.execute(
+                "INSERT OR IGNORE INTO mensajes "
+                "(message_id, recipient, clave, payload, media_type, proximo, creado) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (message_id, recipient, clave, datos, media_type, time.time()),
+            )
+            return cur.rowcount == 1
+
+    def _siguientes(self, recipient: str, ahora: float) -> Tuple[List[tuple], Optional[float]]:
+        # Cabeza de cada correlation_id (el pendiente más antiguo), si ya toca.
+        # Las filas elegidas se reservan (proximo = ahora + claim_seconds) en la
+        # misma transacción, para que otro proceso no las entregue a la vez
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                return self._reservar(recipient, ahora)
+            finally:
+                self._con.execute("COMMIT")
+
+    def _reservar(self, recipient: str, ahora: float) -> Tuple[List[tuple], Optional[float]]:
+        filas = self._con.execute(
+            """
+            SELECT m.id, m.message_id, m.payload, m.media_type, m.intentos FROM mensajes m
+            WHERE m.recipient = ? AND m.estado = 'pendiente' AND m.proximo <= ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM mensajes p
+                  WHERE p.recipient = m.recipient AND p.estado = 'pendiente'
+                    AND p.clave = m.clave AND p.id < m.id)
+            ORDER BY m.id LIMIT ?
+            """,
+            (recipient, ahora, self.batch),
+        ).fetchall()
+        if filas:
+            self._con.executemany(
+                "UPDATE mensajes SET proximo = ? WHERE id = ?",
+                [(ahora + self.claim_seconds, f[0]) for f in filas],
+            )
+            return filas, None
+        (proximo,) = self._con.execute(
+            "SELECT MIN(proximo) FROM mensajes WHERE recipient = ? AND estado = 'pendiente'",
+            (recipient,),
+        ).fetchone()
+        return [], proximo
+
+    def _borrar(self, fila_id: int):
+        with self._lock:
+            self._con.execute("DELETE FROM mensajes WHERE id = ?", (fila_id,))
+
+    def _fallo(self, fila_id: int, intentos: int, proximo: float, error: str, muerto: bool):
+        with self._lock:
+            self._con.execute(
+                "UPDATE mensajes SET intentos = ?, proximo = ?, error = ?, estado = ? WHERE id = ?",
+                (intentos, proximo, error, MUERTO if muerto else PENDIENTE, fila_id),
+            )
+
+    def _resucitar(self, message_id: str) -> Optional[str]:
+        with self._lock:
+            fila = self._con.execute(
+                "SELECT recipient FROM mensajes WHERE message_id = ? AND estado = 'muerto'",
+                (message_id,),
+            ).fetchone()
+            if fila is None:
+                return None
+            self._con.execute(
+                "UPDATE mensajes SET estado = 'pendiente', intentos = 0, proximo = 0, error = NULL "
+                "WHERE message_id = ?",
+                (message_id,),
+            )
+            return fila[0]
+
+    def _destinatarios_pendientes(self) -> List[str]:
+        with self._lock:
+            return [r for (r,) in self._con.execute(
+                "SELECT DISTINCT recipient FROM mensajes WHERE estado = 'pendiente'"
+            )]
+
+    def _muertos(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            filas = self._con.execute(
+                "SELECT message_id, recipient, clave, intentos, error, creado FROM mensajes "
+                "WHERE estado = 'muerto' ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {"message_id": m, "recipient": r, "correlation_id": c, "intentos": i,
+             "error": e, "creado": creado}
+            for m, r, c, i, e, creado in filas
+        ]
+
+    def _contar(self) -> Tuple[Dict[str, int], Dict[str, int]]:
+        with self._lock:
+            por_estado = dict(self._con.execute(
+                "SELECT estado, COUNT(*) FROM mensajes GROUP BY estado"
+            ).fetchall())
+            por_destinatario = dict(self._con.execute(
+                "SELECT recipient, COUNT(*) FROM mensajes WHERE estado = 'pendiente' GROUP BY recipient"
+            ).fetchall())
+        return por_estado, por_destinatario
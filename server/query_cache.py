@@ -0,0 +1,188 @@
+# server/query_cache.py
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import duckdb
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Segundos que un resultado permanece en caché
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+# Máximo de consultas distintas en caché
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "256"))
+# Máximo de filas sumando todas las entradas (un resultado mayor no se cachea)
+QUERY_CACHE_MAX_ROWS = int(os.getenv("QUERY_CACHE_MAX_ROWS", "200000"))
+
+# Sentencias que modifican datos o esquema e invalidan la caché
+_ESCRITURAS = {
+    duckdb.StatementType.INSERT,
+    duckdb.StatementType.UPDATE,
+    duckdb.StatementType.DELETE,
+    duckdb.StatementType.CREATE,
+    duckdb.StatementType.DROP,
+    duckdb.StatementType.ALTER,
+    duckdb.StatementType.COPY,
+    duckdb.StatementType.ATTACH,
+    duckdb.StatementType.DETACH,
+    duckdb.StatementType.COPY_DATABASE,
+    duckdb.StatementType.MERGE_INTO,
+}
+
+# Literales de texto ('...') e identificadores entrecomillados ("...")
+_LITERALES = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalizar_sql(sql: str) -> str:
+    """
+    Forma canónica de una consulta para usarla como clave: espacios
+    colapsados, minúsculas y sin ';' final, sin tocar literales ni
+    identificadores entrecomillados.
+    """
+    partes = _LITERALES.split(sql.strip().rstrip(";").strip())
+    return "".join(
+        parte if i % 2 else re.sub(r"\s+", " ", parte).lower()
+        for i, parte in enumerate(partes)
+    ).strip()
+
+
+def tipo_sentencia(sql: str) -> str:
+    """
+    'lectura' si es un único SELECT (cacheable), 'escritura' si alguna
+    sentencia modifica datos o esquema, y 'otra' en el resto de casos.
+    """
+    try:
+        sentencias = duckdb.extract_statements(sql)
+    except Exception:
+        return "otra"
+    if any(s.type in _ESCRITURAS for s in sentencias):
+        return "escritura"
+    if len(sentencias) == 1 and sentencias[0].type == duckdb.StatementType.SELECT:
+        return "lectura"
+    return "otra"
+
+
+class TableVersion:
+    """
+    Token de versión del lake. Cambia con cada escritura hecha a través del
+    servidor y cuando cambia la versión de un origen externo (el manifiesto
+    del lago Parquet, que también actualizan la ingesta y otros procesos).
+    El prefijo de arranque evita reutilizar tokens tras un reinicio.
+    """
+
+    def __init__(self):
+        self._epoch = uuid4().hex[:8]
+        self._version = 0
+        self._externa: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def token(self) -> str:
+        return f"{self._epoch}-{self._version}"
+
+    def bump(self) -> str:
+        with self._lock:
+            self._version += 1
+            return self.token()
+
+    def observar(self, externa: str) -> Optional[str]:
+        """
+        Registra la versión actual del origen externo. Si cambió, avanza el
+        token y lo devuelve (para invalidar); si no, None.
+        """
+        with self._lock:
+            if externa == self._externa:
+                return None
+            self._externa = externa
+            self._version += 1
+            return self.token()
+
+
+class QueryCache:
+    """
+    Caché LRU de resultados de /tool/consulta con TTL y presupuesto de filas.
+    La clave es (SQL normalizado, token de versión): tras una escritura las
+    entradas antiguas dejan de ser alcanzables y además se vacían.
+    """
+
+    def __init__(
+        self,
+        ttl: float = QUERY_CACHE_TTL,
+        max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+        max_rows: int = QUERY_CACHE_MAX_ROWS,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, int, List[Any]]]" = OrderedDict()
+        self._rows = 0
+        self._token: Optional[str] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, sql: str, token: str) -> Optional[List[Any]]:
+        key = (normalizar_sql(sql), token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, sql: str, token: str, datos: List[Any]):
+        if self.max_entries <= 0 or len(datos) > self.max_rows:
+            return
+        key = (normalizar_sql(sql), token)
+        with self._lock:
+            # Resultado calculado con una versión ya superada: no se guarda
+            if self._token is not None and token != self._token:
+                return
+            self._token = token
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, len(datos), datos)
+            self._rows += len(datos)
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, token: str):
+        # Llamar tras una escritura con el nuevo token de versión
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+            self._token = token
+            self.invalidations += 1
+
+    def _drop(self, key: Tuple[str, str]):
+        _, filas, _ = self._entries.pop(key)
+        self._rows -= filas
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "rows": self._rows,
+                "version": self._token,
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "max_rows": self.max_rows,
+            }
@@ -0,0 +1,198 @@
+# server/query_guard.py
+
+import json
+import math
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import duckdb
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Segundos por consulta si el cliente no pide otro presupuesto (el agente de
+# ventas abandona a los 10 s: pasado ese punto nadie espera el resultado)
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "8"))
+# Presupuesto máximo que puede pedir un cliente (?timeout=)
+QUERY_TIMEOUT_MAX = float(os.getenv("QUERY_TIMEOUT_MAX", "60"))
+# Filas máximas devueltas por consulta (?max_filas= solo puede bajarlo)
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "50000"))
+# Rechazar planes cuya estimación de filas leídas (suma de los escaneos) o
+# de filas producidas por algún join supere estos límites (0 = sin límite)
+QUERY_MAX_SCAN_ROWS = int(os.getenv("QUERY_MAX_SCAN_ROWS", "200000000"))
+QUERY_MAX_JOIN_ROWS = int(os.getenv("QUERY_MAX_JOIN_ROWS", "50000000"))
+
+_JOINS = ("JOIN", "CROSS_PRODUCT")
+
+
+class _Reloj:
+    # Interrumpe el cursor al agotarse el presupuesto, salvo que antes se pare
+    def __init__(self, cur: duckdb.DuckDBPyConnection, segundos: float):
+        self.cur = cur
+        self.interrumpida = False
+        self._parado = False
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(segundos, self._vencer)
+        self._timer.daemon = True
+
+    def _vencer(self):
+        with self._lock:
+            if self._parado:
+                return
+            self.interrumpida = True
+            self.cur.interrupt()
+
+    def arrancar(self):
+        self._timer.start()
+
+    def parar(self):
+        with self._lock:
+            self._parado = True
+        self._timer.cancel()
+
+
+class QueryGuard:
+    """
+    Límites de /tool/consulta: presupuesto de tiempo por petición (la
+    consulta se cancela con interrupt() de DuckDB al agotarse), tope de filas
+    devueltas y una comprobación previa con EXPLAIN que rechaza los planes
+    que leerían o cruzarían demasiadas filas según el optimizador.
+
+    La memoria y los hilos de DuckDB son de la instancia, no de cada
+    consulta (ver DUCKDB_MEMORY_LIMIT y DUCKDB_THREADS en db_pool.py).
+    """
+
+    def __init__(
+        self,
+        timeout: float = QUERY_TIMEOUT,
+        timeout_max: float = QUERY_TIMEOUT_MAX,
+        max_filas: int = QUERY_MAX_ROWS,
+        max_escaneo: int = QUERY_MAX_SCAN_ROWS,
+        max_join: int = QUERY_MAX_JOIN_ROWS,
+    ):
+        self.timeout = timeout
+        self.timeout_max = timeout_max
+        self.max_filas = max_filas
+        self.max_escaneo = max_escaneo
+        self.max_join = max_join
+        self._lock = threading.Lock()
+        self.rechazadas = 0
+        self.interrumpidas = 0
+        self.truncadas = 0
+
+    def presupuesto(self, timeout: Optional[float] = None,
+                    max_filas: Optional[int] = None) -> Tuple[float, int]:
+        """(segundos, filas) de una petición: lo pedido, acotado por la configuración."""
+        segundos = min(timeout or self.timeout, self.timeout_max)
+        filas = min(max_filas, self.max_filas) if max_filas else self.max_filas
+        return segundos, filas
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Comprobación previa del plan
+    # —————————————————————————————————————————————————————————————————————————
+    def estimar(self, cur: duckdb.DuckDBPyConnection, sql: str) -> Optional[Dict[str, int]]:
+        """
+        {"filas_escaneadas", "filas_join"} estimadas por el optimizador para
+        `sql` (suma de los escaneos y mayor salida de un join), o None si no
+        hay plan que examinar.
+        """
+        try:
+            fila = cur.execute(f"EXPLAIN (FORMAT json) {sql}").fetchone()
+        except duckdb.InterruptException:
+            raise  # presupuesto agotado ya durante la planificación
+        except Exception:
+            return None  # el error real lo dará la ejecución
+        if not fila:
+            return None
+        totales = {"filas_escaneadas": 0, "filas_join": 0}
+        for raiz in json.loads(fila[1]):
+            self._recorrer(raiz, totales)
+        return totales
+
+    def _recorrer(self, nodo: Dict[str, Any], totales: Dict[str, int]) -> Optional[int]:
+        # Filas estimadas a la salida de `nodo`, acumulando escaneos y joins
+        hijos = [self._recorrer(h, totales) for h in nodo.get("children", [])]
+        nombre = nodo.get("name", "")
+        estimadas = self._cardinalidad(nodo)
+        if any(j in nombre for j in _JOINS):
+            if estimadas is None and hijos and None not in hijos:
+                # Joins sin igualdad (producto, nested loop): DuckDB no
+                # estima su salida y el peor caso es el producto
+                estimadas = math.prod(hijos)
+            if estimadas is not None:
+                totales["filas_join"] = max(totales["filas_join"], estimadas)
+        elif not hijos and estimadas is not None:
+            totales["filas_escaneadas"] += estimadas
+        elif estimadas is None:
+            estimadas = 1 if nombre == "UNGROUPED_AGGREGATE" else (hijos[0] if len(hijos) == 1 else None)
+        return estimadas
+
+    @staticmethod
+    def _cardinalidad(nodo: Dict[str, Any]) -> Optional[int]:
+        valor = nodo.get("extra_info", {}).get("Estimated Cardinality")
+        try:
+            return int(str(valor).lstrip("~"))
+        except ValueError:
+            return None
+
+    def motivo_rechazo(self, estimacion: Optional[Dict[str, int]]) -> Optional[str]:
+        if estimacion is None:
+            return None
+        motivo = None
+        if self.max_escaneo and estimacion["filas_escaneadas"] > self.max_escaneo:
+            motivo = (f"leería ~{estimacion['filas_escaneadas']} filas "
+                      f"(máximo {self.max_escaneo}); acota el WHERE o agrega")
+        elif self.max_join and estimacion["filas_join"] > self.max_join:
+            motivo = (f"un join produciría ~{estimacion['filas_join']} filas "
+                      f"(máximo {self.max_join}); revisa las condiciones del join")
+        if motivo:
+            with self._lock:
+                self.rechazadas += 1
+        return motivo
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Ejecución
+    # —————————————————————————————————————————————————————————————————————————
+    def iniciar(self, cur: duckdb.DuckDBPyConnection, segundos: float) -> _Reloj:
+        """
+        Interrumpe lo que esté ejecutando `cur` dentro de `segundos` salvo
+        que antes se llame a terminar(); reloj.interrumpida indica si llegó
+        a hacerlo.
+        """
+        reloj = _Reloj(cur, segundos)
+        reloj.arrancar()
+        return reloj
+
+    def terminar(self, reloj: _Reloj):
+        reloj.parar()
+        if reloj.interrumpida:
+            with self._lock:
+                self.interrumpidas += 1
+
+    @contextmanager
+    def cronometro(self, cur: duckdb.DuckDBPyConnection, segundos: float) -> Iterator[_Reloj]:
+        # iniciar()/terminar() alrededor del bloque `with`
+        reloj = self.iniciar(cur, segundos)
+        try:
+            yield reloj
+        finally:
+            self.terminar(reloj)
+
+    def truncada(self):
+        with self._lock:
+            self.truncadas += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "timeout": self.timeout,
+                "timeout_max": self.timeout_max,
+                "max_filas": self.max_filas,
+                "max_filas_escaneadas": self.max_escaneo,
+                "max_filas_join": self.max_join,
+                "rechazadas": self.rechazadas,
+                "interrumpidas": self.interrumpidas,
+                "truncadas": self.truncadas,
+            }
@@ -0,0 +1,267 @@
+# server/registry.py
+
+import heapq
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+def _index_values(value: Any) -> Iterable[Any]:
+    # Valores indexables de una capacidad: escalares, o cada elemento de una lista
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [v for v in value if isinstance(v, (str, int, float, bool))]
+    if isinstance(value, (str, int, float, bool)):
+        return [value]
+    return []
+
+
+class RegistryBackend:
+    """
+    Interfaz común de los registros de agentes del broker.
+
+    register/heartbeat/heartbeat_many dan de alta y renuevan leases;
+    expire_due/is_online/online_ids resuelven la liveness; get, items,
+    `in`, find y find_any son el descubrimiento. Las transiciones
+    online/offline se notifican a los suscriptores de subscribe() en el
+    proceso que las detecta.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        # Un agente está online si su último latido tiene menos de ttl_seconds
+        self.ttl_seconds = ttl_seconds
+        self._listeners: List[Callable[[str, bool, float], None]] = []
+
+    def subscribe(self, listener: Callable[[str, bool, float], None]):
+        """
+        listener(agent_id, online, cuando) se llama en cada transición,
+        fuera del lock y desde el hilo que la detecta.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, cambios: List[Tuple[str, bool, float]]):
+        for agent_id, online, cuando in cambios:
+            for listener in self._listeners:
+                listener(agent_id, online, cuando)
+
+    def register(self, payload: dict) -> str:
+        raise NotImplementedError
+
+    def heartbeat(self, agent_id: str, timestamp: datetime) -> bool:
+        raise NotImplementedError
+
+    def heartbeat_many(self, agent_ids: Iterable[str], timestamp: datetime) -> List[str]:
+        raise NotImplementedError
+
+    def expire_due(self, now: Optional[float] = None) -> Optional[float]:
+        raise NotImplementedError
+
+    def is_online(self, agent_id: str) -> bool:
+        raise NotImplementedError
+
+    def online_ids(self) -> Set[str]:
+        raise NotImplementedError
+
+    def get(self, agent_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def items(self) -> List[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    def __contains__(self, agent_id: str) -> bool:
+        raise NotImplementedError
+
+    def find(self, **caps: Any) -> List[str]:
+        raise NotImplementedError
+
+    def find_any(self, value: Any, keys: Iterable[str]) -> List[str]:
+        raise NotImplementedError
+
+
+class AgentRegistry(RegistryBackend):
+    """
+    Registro en memoria de agentes A2A (un solo proceso).
+
+    Mantiene índices invertidos (clave de capabilities, valor) → agent_ids y
+    el conjunto de agentes online, que se actualiza con cada heartbeat y se
+    depura con un heap de vencimientos de lease. Así una búsqueda por
+    capacidad cuesta O(coincidencias) y no O(agentes registrados).
+
+    Cada latido renueva el lease del agente hasta ahora + ttl_seconds.
+    expire_due() (llamado periódicamente por el broker, y también antes de
+    cada consulta de liveness) pasa a offline los leases vencidos, y cada
+    cambio online/offline se notifica a los suscriptores de subscribe().
+    El heap guarda a lo sumo una entrada por agente: un latido solo mueve
+    su deadline, y la entrada se reprograma al salir del heap si el lease
+    se renovó entretanto.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        super().__init__(ttl_seconds)
+        self.agents: Dict[str, dict] = {}
+        self._index: Dict[Tuple[str, Any], Set[str]] = defaultdict(set)
+        self._online: Set[str] = set()
+        self._deadline: Dict[str, float] = {}
+        self._expiry: List[Tuple[float, str]] = []
+        self._en_heap: Set[str] = set()
+        self._lock = threading.Lock()
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Altas y latidos
+    # —————————————————————————————————————————————————————————————————————————
+    def register(self, payload: dict) -> str:
+        agent_id = payload["agent_id"]
+        with self._lock:
+            previous = self.agents.get(agent_id)
+            if previous is not None:
+                self._unindex(agent_id, previous.get("capabilities", {}))
+                # Un re-registro conserva el último latido conocido
+                payload.setdefault("last_heartbeat", previous.get("last_heartbeat"))
+            self.agents[agent_id] = payload
+            self._reindex(agent_id, payload.get("capabilities", {}))
+        return agent_id
+
+    def heartbeat(self, agent_id: str, timestamp: datetime) -> bool:
+        """
+        Registra un latido. Devuelve False si el agente no está registrado.
+        """
+        with self._lock:
+            cambio = self._renew(agent_id, timestamp, time.time())
+            if cambio is False:
+                return False
+        if cambio:
+            self._notify([cambio])
+        return True
+
+    def heartbeat_many(self, agent_ids: Iterable[str], timestamp: datetime) -> List[str]:
+        """
+        Renueva el lease de varios agentes con un único lock. Devuelve los
+        agent_ids que no están registrados.
+        """
+        desconocidos, cambios = [], []
+        now = time.time()
+        with self._lock:
+            for agent_id in agent_ids:
+                cambio = self._renew(agent_id, timestamp, now)
+                if cambio is False:
+                    desconocidos.append(agent_id)
+                elif cambio:
+                    cambios.append(cambio)
+        self._notify(cambios)
+        return desconocidos
+
+    def _renew(self, agent_id: str, timestamp: datetime, now: float):
+        # False si no existe; la transición (id, True, now) si pasa a online;
+        # None si no cambia de estado. Requiere el lock.
+        info = self.agents.get(agent_id)
+        if info is None:
+            return False
+        deadline = timestamp.timestamp() + self.ttl_seconds
+        if deadline <= self._deadline.get(agent_id, 0.0):
+            return None  # latido más antiguo que el lease vigente
+        info["last_heartbeat"] = timestamp
+        self._deadline[agent_id] = deadline
+        if agent_id not in self._en_heap:
+            # Si ya tiene entrada (con un deadline anterior), _expire la
+            # reprograma al sacarla: nada de una entrada por envelope
+            heapq.heappush(self._expiry, (deadline, agent_id))
+            self._en_heap.add(agent_id)
+        if deadline > now and agent_id not in self._online:
+            self._online.add(agent_id)
+            return (agent_id, True, now)
+        return None
+
+    def _reindex(self, agent_id: str, caps: Dict[str, Any]):
+        for key, value in caps.items():
+            for v in _index_values(value):
+                self._index[(key, v)].add(agent_id)
+
+    def _unindex(self, agent_id: str, caps: Dict[str, Any]):
+        for key, value in caps.items():
+            for v in _index_values(value):
+                ids = self._index.get((key, v))
+                if ids is not None:
+                    ids.discard(agent_id)
+                    if not ids:
+                        del self._index[(key, v)]
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Liveness
+    # —————————————————————————————————————————————————————————————————————————
+    def _expire(self, now: float) -> List[Tuple[str, bool, float]]:
+        # Saca del heap los vencimientos pasados; si el agente latió después,
+        # su entrada vuelve al heap con el deadline vigente sin tocar el
+        # conjunto online.
+        cambios = []
+        while self._expiry and self._expiry[0][0] <= now:
+            _, agent_id = heapq.heappop(self._expiry)
+            deadline = self._deadline.get(agent_id, 0.0)
+            if deadline > now:
+                heapq.heappush(self._expiry, (deadline, agent_id))
+                continue
+            self._en_heap.discard(agent_id)
+            if agent_id in self._online:
+                self._online.discard(agent_id)
+                cambios.append((agent_id, False, deadline))
+        return cambios
+
+    def expire_due(self, now: Optional[float] = None) -> Optional[float]:
+        """
+        Pasa a offline los leases vencidos y notifica las transiciones.
+        Devuelve el próximo vencimiento pendiente (o None si no hay).
+        """
+        with self._lock:
+            cambios = self._expire(time.time() if now is None else now)
+            proximo = self._expiry[0][0] if self._expiry else None
+        self._notify(cambios)
+        return proximo
+
+    def is_online(self, agent_id: str) -> bool:
+        with self._lock:
+            cambios = self._expire(time.time())
+            online = agent_id in self._online
+        self._notify(cambios)
+        return online
+
+    def online_ids(self) -> Set[str]:
+        with self._lock:
+            cambios = self._expire(time.time())
+            online = set(self._online)
+        self._notify(cambios)
+        return online
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Consultas
+    # —————————————————————————————————————————————————————————————————————————
+    def get(self, agent_id: str) -> Optional[dict]:
+        return self.agents.get(agent_id)
+
+    def items(self) -> List[Tuple[str, dict]]:
+        return list(self.agents.items())
+
+    def __contains__(self, agent_id: str) -> bool:
+        return agent_id in self.agents
+
+    def find(self, **caps: Any) -> List[str]:
+        """
+        agent_ids cuyas capabilities coinciden con TODOS los filtros dados
+        (los filtros a None se ignoran). Sin filtros devuelve todos.
+        """
+        filters = [(k, v) for k, v in caps.items() if v is not None]
+        with self._lock:
+            if not filters:
+                return list(self.agents)
+            sets = [self._index.get(f, set()) for f in filters]
+            sets.sort(key=len)
+            return list(sets[0].intersection(*sets[1:]))
+
+    def find_any(self, value: Any, keys: Iterable[str]) -> List[str]:
+        """
+        agent_ids con capabilities[key] == value para ALGUNA de las claves.
+        """
+        with self._lock:
+            found: Set[str] = set()
+            for key in keys:
+                found |= self._index.get((key, value), set())
+            return list(found)
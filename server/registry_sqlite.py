@@ -0,0 +1,269 @@
+# server/registry_sqlite.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from registry import RegistryBackend, _index_values
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# Fichero SQLite compartido por todos los workers/réplicas del broker
+REGISTRY_PATH = os.getenv("REGISTRY_PATH", os.path.join(DATA_DIR, "registry.sqlite"))
+# Un latido que alarga el lease menos de esto (s) no se escribe: con un latido
+# implícito por cada envelope, evita una transacción por mensaje
+REGISTRY_RENEW_MIN = float(os.getenv("REGISTRY_RENEW_MIN", "1"))
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS agentes (
+    agent_id        TEXT PRIMARY KEY,
+    info            TEXT NOT NULL,
+    last_heartbeat  REAL,
+    deadline        REAL NOT NULL DEFAULT 0,
+    online          INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS agentes_lease ON agentes (online, deadline);
+CREATE TABLE IF NOT EXISTS capacidades (
+    clave     TEXT NOT NULL,
+    valor     TEXT NOT NULL,
+    agent_id  TEXT NOT NULL,
+    PRIMARY KEY (clave, valor, agent_id)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteRegistry(RegistryBackend):
+    """
+    Registro de agentes en un fichero SQLite compartido, para ejecutar el
+    broker con `uvicorn --workers N` o varias réplicas en la misma máquina.
+
+    Mismo modelo que AgentRegistry: la tabla `capacidades` es el índice
+    invertido (clave, valor JSON) → agent_id, y cada agente guarda su
+    deadline de lease y su estado online. Las escrituras van en
+    transacciones BEGIN IMMEDIATE, así que cada transición online/offline la
+    detecta (y la notifica a sus suscriptores) un único proceso. La
+    liveness que se consulta (is_online, online_ids) es deadline > ahora y
+    no necesita escribir.
+    """
+
+    def __init__(self, ttl_seconds: float, path: str = REGISTRY_PATH,
+                 renew_min: float = REGISTRY_RENEW_MIN):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self.renew_min = renew_min
+        self._lock = threading.Lock()
+        # Último deadline escrito por este proceso, por agente
+        self._escrito: Dict[str, float] = {}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._con = sqlite3.connect(self.path, check_same_thread=False,
+                                    isolation_level=None, timeout=5)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.executescript(_ESQUEMA)
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def _escribir(self, fn, *args):
+        # Ejecuta fn(*args) dentro de una transacción de escritura
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                resultado = fn(*args)
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            self._con.execute("COMMIT")
+            return resultado
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Altas y latidos
+    # —————————————————————————————————————————————————————————————————————————
+    def register(self, payload: dict) -> str:
+        agent_id = payload["agent_id"]
+        info = {k: v for k, v in payload.items() if k != "last_heartbeat"}
+        filas = [
+            (key, json.dumps(v), agent_id)
+            for key, value in info.get("capabilities", {}).items()
+            for v in _index_values(value)
+        ]
+
+        def alta():
+            # Un re-registro conserva el último latido y el lease
+            self._con.execute(
+                "INSERT INTO agentes (agent_id, info) VALUES (?, ?) "
+                "ON CONFLICT(agent_id) DO UPDATE SET info = excluded.info",
+                (agent_id, json.dumps(info)),
+            )
+            self._con.execute("DELETE FROM capacidades WHERE agent_id = ?", (agent_id,))
+            self._con.executemany(
+                "INSERT OR IGNORE INTO capacidades (clave, valor, agent_id) VALUES (?, ?, ?)", filas
+            )
+
+        self._escribir(alta)
+        return agent_id
+
+    def heartbeat(self, agent_id: str, timestamp: datetime) -> bool:
+        deadline = timestamp.timestamp() + self.ttl_seconds
+        if deadline - self._escrito.get(agent_id, 0.0) < self.renew_min:
+            return True  # este proceso acaba de renovarlo
+        cambio = self._escribir(self._renew, agent_id, timestamp, time.time())
+        if cambio is False:
+            return False
+        if cambio:
+            self._notify([cambio])
+        return True
+
+    def heartbeat_many(self, agent_ids: Iterable[str], timestamp: datetime) -> List[str]:
+        now = time.time()
+
+        def renovar():
+            desconocidos, cambios = [], []
+            for agent_id in agent_ids:
+                cambio = self._renew(agent_id, timestamp, now)
+                if cambio is False:
+                    desconocidos.append(agent_id)
+                elif cambio:
+                    cambios.append(cambio)
+            return desconocidos, cambios
+
+        desconocidos, cambios = self._escribir(renovar)
+        self._notify(cambios)
+        return desconocidos
+
+    def _renew(self, agent_id: str, timestamp: datetime, now: float):
+        # Igual que AgentRegistry._renew; requiere la transacción abierta
+        fila = self._con.execute(
+            "SELECT deadline, online FROM agentes WHERE agent_id = ?", (agent_id,)
+        ).fetchone()
+        if fila is None:
+            return False
+        deadline = timestamp.timestamp() + self.ttl_seconds
+        if deadline <= fila[0]:
+            return None  # latido más antiguo que el lease vigente
+        pasa_online = deadline > now and not fila[1]
+        self._con.execute(
+            "UPDATE agentes SET last_heartbeat = ?, deadline = ?, online = online OR ? "
+            "WHERE agent_id = ?",
+            (timestamp.timestamp(), deadline, pasa_online, agent_id),
+        )
+        self._escrito[agent_id] = deadline
+        return (agent_id, True, now) if pasa_online else None
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Liveness
+    # —————————————————————————————————————————————————————————————————————————
+    def expire_due(self, now: Optional[float] = None) -> Optional[float]:
+        """
+        Pasa a offline los leases vencidos y notifica las transiciones.
+        Devuelve el próximo vencimiento pendiente (o None si no hay).
+        """
+        now = time.time() if now is None else now
+
+        def expirar():
+            vencidos = self._con.execute(
+                "SELECT agent_id, deadline FROM agentes WHERE online = 1 AND deadline <= ?", (now,)
+            ).fetchall()
+            if vencidos:
+                self._con.execute(
+                    "UPDATE agentes SET online = 0 WHERE online = 1 AND deadline <= ?", (now,)
+                )
+            (proximo,) = self._con.execute(
+                "SELECT MIN(deadline) FROM agentes WHERE online = 1"
+            ).fetchone()
+            return [(aid, False, deadline) for aid, deadline in vencidos], proximo
+
+        with self._lock:
+            # Lectura previa sin bloquear a los demás procesos: lo normal es
+            # que no haya nada vencido y no haga falta transacción de escritura
+            (hay,) = self._con.execute(
+                "SELECT EXISTS (SELECT 1 FROM agentes WHERE online = 1 AND deadline <= ?)", (now,)
+            ).fetchone()
+            if not hay:
+                (proximo,) = self._con.execute(
+                    "SELECT MIN(deadline) FROM agentes WHERE online = 1"
+                ).fetchone()
+                return proximo
+        cambios, proximo = self._escribir(expirar)
+        self._notify(cambios)
+        return proximo
+
+    def is_online(self, agent_id: str) -> bool:
+        with self._lock:
+            fila = self._con.execute(
+                "SELECT deadline FROM agentes WHERE agent_id = ?", (agent_id,)
+            ).fetchone()
+        return fila is not None and fila[0] > time.time()
+
+    def online_ids(self) -> Set[str]:
+        # Un lease vigente siempre tiene online = 1 (_renew lo marca y
+        # expire_due solo lo quita si ya venció): el filtro por online deja
+        # que el índice agentes_lease acote el recorrido a los agentes online
+        with self._lock:
+            return {aid for (aid,) in self._con.execute(
+                "SELECT agent_id FROM agentes WHERE online = 1 AND deadline > ?", (time.time(),)
+            )}
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Consultas
+    # —————————————————————————————————————————————————————————————————————————
+    @staticmethod
+    def _info(info: str, last: Optional[float]) -> dict:
+        datos = json.loads(info)
+        datos["last_heartbeat"] = datetime.fromtimestamp(last, timezone.utc) if last else None
+        return datos
+
+    def get(self, agent_id: str) -> Optional[dict]:
+        with self._lock:
+            fila = self._con.execute(
+                "SELECT info, last_heartbeat FROM agentes WHERE agent_id = ?", (agent_id,)
+            ).fetchone()
+        return self._info(*fila) if fila else None
+
+    def items(self) -> List[Tuple[str, dict]]:
+        with self._lock:
+            filas = self._con.execute(
+                "SELECT agent_id, info, last_heartbeat FROM agentes ORDER BY agent_id"
+            ).fetchall()
+        return [(aid, self._info(info, last)) for aid, info, last in filas]
+
+    def __contains__(self, agent_id: str) -> bool:
+        with self._lock:
+            return self._con.execute(
+                "SELECT 1 FROM agentes WHERE agent_id = ?", (agent_id,)
+            ).fetchone() is not None
+
+    def find(self, **caps: Any) -> List[str]:
+        """
+        agent_ids cuyas capabilities coinciden con TODOS los filtros dados
+        (los filtros a None se ignoran). Sin filtros devuelve todos.
+        """
+        filters = [(k, json.dumps(v)) for k, v in caps.items() if v is not None]
+        with self._lock:
+            if not filters:
+                return [aid for (aid,) in self._con.execute("SELECT agent_id FROM agentes")]
+            sql = " INTERSECT ".join(
+                ["SELECT agent_id FROM capacidades WHERE clave = ? AND valor = ?"] * len(filters)
+            )
+            return [aid for (aid,) in self._con.execute(sql, [x for f in filters for x in f])]
+
+    def find_any(self, value: Any, keys: Iterable[str]) -> List[str]:
+        """
+        agent_ids con capabilities[key] == value para ALGUNA de las claves.
+        """
+        keys = list(keys)
+        if not keys:
+            return []
+        with self._lock:
+            return [aid for (aid,) in self._con.execute(
+                f"SELECT DISTINCT agent_id FROM capacidades "
+                f"WHERE valor = ? AND clave IN ({', '.join('?' * len(keys))})",
+                [json.dumps(value), *keys],
+            )]
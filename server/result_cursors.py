@@ -0,0 +1,148 @@
+# server/result_cursors.py
+
+import base64
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from query_cache import normalizar_sql
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# Páginas de los resultados paginados (?pagina=); en disco para que las
+# sirva cualquier worker de uvicorn, no solo el que ejecutó la consulta
+QUERY_CURSOR_DIR = os.getenv("QUERY_CURSOR_DIR", os.path.join(DATA_DIR, "_cursores"))
+# Segundos sin pedir páginas tras los que se borra un resultado paginado
+QUERY_CURSOR_TTL = float(os.getenv("QUERY_CURSOR_TTL", "300"))
+
+_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _huella(sql: str) -> str:
+    return hashlib.sha1(normalizar_sql(sql).encode("utf-8")).hexdigest()[:16]
+
+
+class ResultCursors:
+    """
+    Resultados paginados de /tool/consulta. La consulta se ejecuta una sola
+    vez: abrir() trocea su resultado (ya acotado por QUERY_MAX_ROWS) en
+    páginas que se guardan en QUERY_CURSOR_DIR/<id>/ y siguiente() las
+    sirve por cursor. Así las páginas son cortes de una misma ejecución, sin
+    huecos ni filas repetidas aunque DuckDB no garantice el orden sin ORDER
+    BY, y cada página cuesta leer un fichero, no repetir la consulta.
+
+    El cursor es opaco para el cliente: id del resultado y número de página.
+    Un resultado se borra al servir su última página o tras QUERY_CURSOR_TTL
+    segundos sin uso.
+    """
+
+    def __init__(self, root: str = QUERY_CURSOR_DIR, ttl: float = QUERY_CURSOR_TTL):
+        self.root = root
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ultima_purga = 0.0
+        self.abiertos = 0
+        self.paginas = 0
+        self.caducados = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    # — API —
+    def abrir(self, sql: str, datos: List[Any], tamano: int,
+              truncado: bool) -> Tuple[List[Any], Optional[str], Dict[str, Any]]:
+        """
+        (primera página, cursor de la siguiente o None, info de paginación)
+        del resultado completo `datos`. Solo se guarda en disco si hay más
+        de una página.
+        """
+        self._purgar()
+        total = len(datos)
+        paginas = max(1, -(-total // tamano))
+        info = {"numero": 0, "tamano": tamano, "paginas": paginas,
+                "filas_total": total, "truncado": truncado}
+        if paginas == 1:
+            return datos, None, info
+        rid = uuid4().hex
+        tmp = os.path.join(self.root, f".{rid}")
+        os.makedirs(tmp)
+        for n in range(1, paginas):
+            with open(os.path.join(tmp, f"{n}.pkl"), "wb") as f:
+                pickle.dump(datos[n * tamano:(n + 1) * tamano], f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(info, huella=_huella(sql)), f)
+        os.rename(tmp, os.path.join(self.root, rid))
+        with self._lock:
+            self.abiertos += 1
+        return datos[:tamano], self._cursor(rid, 1), info
+
+    def siguiente(self, cursor: str, sql: str) -> Optional[Tuple[List[Any], Optional[str], Dict[str, Any]]]:
+        """
+        (página, cursor de la siguiente o None, info) del cursor, o None si
+        no es válido para `sql`, ya se leyó la última página o caducó.
+        """
+        try:
+            estado = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            rid, numero = str(estado["c"]), int(estado["p"])
+        except Exception:
+            return None
+        if not _ID.match(rid) or numero < 1:
+            return None
+        carpeta = os.path.join(self.root, rid)
+        try:
+            with open(os.path.join(carpeta, "info.json"), encoding="utf-8") as f:
+                info = json.load(f)
+            if info.pop("huella") != _huella(sql) or numero >= info["paginas"]:
+                return None
+            with open(os.path.join(carpeta, f"{numero}.pkl"), "rb") as f:
+                filas = pickle.load(f)
+        except Exception:
+            return None  # borrado, caducado o de otra consulta
+        with self._lock:
+            self.paginas += 1
+        info["numero"] = numero
+        if numero + 1 < info["paginas"]:
+            os.utime(carpeta)  # en uso: aplaza la caducidad
+            return filas, self._cursor(rid, numero + 1), info
+        shutil.rmtree(carpeta, ignore_errors=True)
+        return filas, None, info
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "abiertos": self.abiertos,
+                "paginas_servidas": self.paginas,
+                "caducados": self.caducados,
+                "ttl": self.ttl,
+            }
+
+    # — internos —
+    @staticmethod
+    def _cursor(rid: str, numero: int) -> str:
+        estado = json.dumps({"c": rid, "p": numero}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(estado.encode()).decode().rstrip("=")
+
+    def _purgar(self):
+        # Como mucho una vez por minuto: resultados abandonados a medias
+        ahora = time.time()
+        with self._lock:
+            if ahora - self._ultima_purga < 60:
+                return
+            self._ultima_purga = ahora
+        for nombre in os.listdir(self.root):
+            ruta = os.path.join(self.root, nombre)
+            try:
+                viejo = ahora - os.path.getmtime(ruta) > self.ttl
+            except OSError:
+                continue
+            if viejo:
+                shutil.rmtree(ruta, ignore_errors=True)
+                with self._lock:
+                    self.caducados += 1
@@ -0,0 +1,106 @@
+# server/result_formats.py
+
+import json
+import os
+from typing import Iterator, List, Optional
+
+import duckdb
+
+try:
+    import pyarrow as pa
+except ImportError:  # formato Arrow opcional
+    pa = None
+
+# —————————————————————————————————————————————————————————————————————————————
+# FORMATOS DE RESULTADO DE /tool/consulta
+# —————————————————————————————————————————————————————————————————————————————
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+NDJSON = "application/x-ndjson"
+JSON = "application/json"
+
+# Filas por lote al transmitir resultados en streaming
+RESULT_BATCH_ROWS = int(os.getenv("RESULT_BATCH_ROWS", "10000"))
+
+_NDJSON_ALIASES = (NDJSON, "application/jsonl", "application/json-seq")
+
+
+def negociar_formato(accept: Optional[str]) -> str:
+    """
+    Elige el formato de respuesta a partir de la cabecera Accept.
+    Por defecto (o con */*) se mantiene el JSON de siempre.
+    """
+    if not accept:
+        return JSON
+    tipos = [parte.split(";")[0].strip().lower() for parte in accept.split(",")]
+    for tipo in tipos:
+        if tipo == ARROW_STREAM:
+            return ARROW_STREAM
+        if tipo in _NDJSON_ALIASES:
+            return NDJSON
+        if tipo in (JSON, "*/*"):
+            return JSON
+    return JSON
+
+
+class _Chunks:
+    # Destino "file-like" para el escritor IPC: acumula lo escrito hasta drenarlo
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def stream_arrow(cur: duckdb.DuckDBPyConnection, batch_rows: int = RESULT_BATCH_ROWS,
+                 max_rows: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Emite el resultado pendiente de `cur` como Arrow IPC stream, lote a lote,
+    sin convertir las filas a objetos Python. Como mucho `max_rows` filas.
+    """
+    reader = cur.fetch_record_batch(batch_rows)
+    restantes = max_rows
+    sink = _Chunks()
+    with pa.ipc.new_stream(sink, reader.schema) as writer:
+        yield sink.drain()
+        for batch in reader:
+            if restantes is not None:
+                if restantes <= 0:
+                    break
+                batch = batch.slice(0, restantes)
+                restantes -= batch.num_rows
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def stream_ndjson(cur: duckdb.DuckDBPyConnection, batch_rows: int = RESULT_BATCH_ROWS,
+                  max_rows: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Emite el resultado pendiente de `cur` como NDJSON (un objeto por fila),
+    leyendo como mucho `batch_rows` filas a la vez y `max_rows` en total.
+    """
+    columnas = [desc[0] for desc in cur.description]
+    restantes = max_rows
+    while restantes is None or restantes > 0:
+        filas = cur.fetchmany(batch_rows if restantes is None else min(batch_rows, restantes))
+        if restantes is not None:
+            restantes -= len(filas)
+        if not filas:
+            break
+        yield "".join(
+            json.dumps(dict(zip(columnas, fila)), default=str, ensure_ascii=False) + "\n"
+            for fila in filas
+        ).encode("utf-8")
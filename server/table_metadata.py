@@ -0,0 +1,127 @@
+# server/table_metadata.py
+
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from db_pool import CursorPool
+from ventas_lake import VentasLake
+
+
+class TableMetadata:
+    """
+    Metadatos de iceberg_space.ventas que usa el LLM para construir el prompt
+    (productos distintos y rango de fechas), calculados una sola vez por
+    versión del lake en lugar de con un escaneo completo en cada petición.
+
+    Con el lago, el rango de fechas sale del min/max de cada fichero en el
+    manifiesto y los productos se acumulan leyendo solo la columna producto
+    de los ficheros nuevos desde el cálculo anterior; solo si se retiró algún
+    fichero se vuelven a leer todos. Los cálculos no se solapan: quien llega
+    mientras otro calcula espera y reutiliza su resultado si es de la misma
+    versión. Con la tabla vacía las fechas son None.
+    """
+
+    def __init__(self, pool: CursorPool, version: Callable[[], str],
+                 tabla: str = "iceberg_space.ventas",
+                 reescribir: Callable[[str], str] = lambda sql: sql,
+                 lago: Optional[VentasLake] = None):
+        self.pool = pool
+        self.version = version
+        self.tabla = tabla
+        # Traduce las consultas sobre la tabla a su origen real (el lago Parquet)
+        self.reescribir = reescribir
+        self.lago = lago
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._calculo = threading.Lock()
+        # Ficheros del lago cuyos productos ya están en _productos
+        self._ficheros: Set[str] = set()
+        self._productos: Set[str] = set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        {version, productos, min_fecha, max_fecha} para la versión actual.
+        """
+        token = self.version()
+        vigente = self._vigente(token)
+        if vigente is not None:
+            return vigente
+        with self._calculo:
+            token = self.version()
+            vigente = self._vigente(token)
+            if vigente is not None:
+                return vigente  # lo calculó quien tenía el turno
+            if self.lago is not None and self.lago.existe():
+                productos, min_fecha, max_fecha = self._desde_lago()
+            else:
+                productos, min_fecha, max_fecha = self._completo()
+            snapshot = {
+                "version": token,
+                "productos": productos,
+                "min_fecha": min_fecha,
+                "max_fecha": max_fecha,
+            }
+            with self._lock:
+                # Si entretanto hubo una escritura, este cálculo ya no es el vigente
+                if token == self.version():
+                    self._snapshot = snapshot
+        return snapshot
+
+    def _vigente(self, token: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._snapshot is not None and self._snapshot["version"] == token:
+                return self._snapshot
+        return None
+
+    def _desde_lago(self):
+        # Requiere _calculo. Fechas del manifiesto; productos, incrementales
+        ficheros = [f for f in self.lago.manifiesto()["ficheros"] if f["filas"]]
+        rutas = {f["ruta"] for f in ficheros}
+        if not self._ficheros <= rutas:
+            self._ficheros, self._productos = set(), set()
+        nuevos = [f for f in ficheros if f["ruta"] not in self._ficheros]
+        if nuevos:
+            self._productos |= self._leer_productos(nuevos)
+            self._ficheros |= {f["ruta"] for f in nuevos}
+        minimos = [f["min"]["fecha"] for f in ficheros if f["min"].get("fecha") is not None]
+        maximos = [f["max"]["fecha"] for f in ficheros if f["max"].get("fecha") is not None]
+        return (sorted(self._productos),
+                min(minimos) if minimos else None,
+                max(maximos) if maximos else None)
+
+    def _leer_productos(self, ficheros: List[Dict[str, Any]]) -> Set[str]:
+        # Un fichero de un solo producto no hace falta leerlo
+        productos = {f["min"]["producto"] for f in ficheros
+                     if f["min"].get("producto") is not None
+                     and f["min"].get("producto") == f["max"].get("producto")}
+        leer = [os.path.join(self.lago.root, f["ruta"]) for f in ficheros
+                if f["min"].get("producto") is None
+                or f["min"].get("producto") != f["max"].get("producto")]
+        if leer:
+            with self.pool.cursor() as cur:
+                productos |= {
+                    fila[0] for fila in
+                    cur.execute(
+                        f"SELECT DISTINCT producto FROM {self.lago._origen(leer)} "
+                        f"WHERE producto IS NOT NULL"
+                    ).fetchall()
+                }
+        return productos
+
+    def _completo(self):
+        # Sin lago: DISTINCT y MIN/MAX sobre la tabla
+        with self.pool.cursor() as cur:
+            productos = [
+                fila[0] for fila in
+                cur.execute(self.reescribir(
+                    f"SELECT DISTINCT producto FROM {self.tabla} "
+                    f"WHERE producto IS NOT NULL ORDER BY producto"
+                )).fetchall()
+            ]
+            min_fecha, max_fecha = cur.execute(self.reescribir(
+                f"SELECT MIN(fecha), MAX(fecha) FROM {self.tabla}"
+            )).fetchone()
+        return (productos,
+                str(min_fecha) if min_fecha is not None else None,
+                str(max_fecha) if max_fecha is not None else None)
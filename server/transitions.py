@@ -0,0 +1,65 @@
+# server/transitions.py
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class TransitionFeed:
+    """
+    Publicación de las transiciones online/offline de los agentes.
+
+    Guarda las últimas `maxlen` transiciones con un número de secuencia
+    creciente (para consultar "desde la N") y las reparte en vivo a los
+    suscriptores, cada uno con su asyncio.Queue. publish() puede llamarse
+    desde cualquier hilo: la entrega a las colas se hace en el event loop.
+    """
+
+    def __init__(self, maxlen: int = 1000, queue_size: int = 1000):
+        self._recientes: Deque[Dict[str, Any]] = deque(maxlen=maxlen)
+        self._suscriptores: Set[asyncio.Queue] = set()
+        self._queue_size = queue_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.seq = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def publish(self, agent_id: str, online: bool, cuando: float):
+        with self._lock:
+            self.seq += 1
+            evento = {
+                "seq": self.seq,
+                "agent_id": agent_id,
+                "online": online,
+                "timestamp": datetime.fromtimestamp(cuando, timezone.utc).isoformat(),
+            }
+            self._recientes.append(evento)
+        logger.info(f"[Liveness] {agent_id} {'online' if online else 'offline'}")
+        if self._loop is not None and self._suscriptores:
+            self._loop.call_soon_threadsafe(self._repartir, evento)
+
+    def _repartir(self, evento: Dict[str, Any]):
+        for cola in list(self._suscriptores):
+            try:
+                cola.put_nowait(evento)
+            except asyncio.QueueFull:
+                pass  # suscriptor lento: pierde eventos, puede releer con since()
+
+    def since(self, seq: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [e for e in self._recientes if e["seq"] > seq]
+
+    def subscribe(self) -> asyncio.Queue:
+        cola: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self._suscriptores.add(cola)
+        return cola
+
+    def unsubscribe(self, cola: asyncio.Queue):
+        self._suscriptores.discard(cola)
@@ -0,0 +1,565 @@
+# server/ventas_lake.py
+
+import copy
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from uuid import uuid4
+
+import duckdb
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# Directorio del lago de ventas (Parquet particionado estilo Hive + manifiesto)
+VENTAS_LAKE_DIR = os.getenv("VENTAS_LAKE_DIR", os.path.join(DATA_DIR, "ventas"))
+# Buckets por hash de producto dentro de cada mes (0 = particionar solo por mes).
+# Se usa md5_number y no hash(): es estable entre versiones de DuckDB, así que
+# el bucket de un producto se puede recalcular al podar
+VENTAS_BUCKETS = int(os.getenv("VENTAS_BUCKETS", "0"))
+
+TABLA = "iceberg_space.ventas"
+# Esquema de la tabla: todos los ficheros se escriben con estos tipos
+COLUMNAS = (("fecha", "DATE"), ("producto", "VARCHAR"), ("cantidad", "INTEGER"), ("precio", "DOUBLE"))
+
+_MANIFIESTO = "_manifest.json"
+# Lote de los ficheros con las filas de la tabla DuckDB anterior al lago
+LOTE_IMPORTADA = "importada"
+_RANGO = {"COMPARE_GREATERTHAN", "COMPARE_GREATERTHANOREQUALTO",
+          "COMPARE_LESSTHAN", "COMPARE_LESSTHANOREQUALTO", "COMPARE_EQUAL"}
+_INVERSA = {"COMPARE_GREATERTHAN": "COMPARE_LESSTHAN",
+            "COMPARE_GREATERTHANOREQUALTO": "COMPARE_LESSTHANOREQUALTO",
+            "COMPARE_LESSTHAN": "COMPARE_GREATERTHAN",
+            "COMPARE_LESSTHANOREQUALTO": "COMPARE_GREATERTHANOREQUALTO",
+            "COMPARE_EQUAL": "COMPARE_EQUAL"}
+# Identificador SQL, con o sin comillas, opcionalmente cualificado (catálogo.esquema.tabla)
+_IDENT = r'(?:"[^"]*"|[A-Za-z_]\w*)'
+_NOMBRE = rf"{_IDENT}(?:\s*\.\s*{_IDENT}){{0,2}}"
+# Sentencias que modifican las filas de una tabla: destino en el grupo 1
+_DESTINOS = [re.compile(p, re.IGNORECASE | re.DOTALL) for p in (
+    rf"\bINSERT\s+(?:OR\s+\w+\s+)?INTO\s+({_NOMBRE})",
+    rf"\bUPDATE\s+({_NOMBRE})\s+(?:AS\s+)?(?:{_IDENT}\s+)?SET\b",
+    rf"\bDELETE\s+FROM\s+({_NOMBRE})",
+    rf"\bTRUNCATE\s+(?:TABLE\s+)?({_NOMBRE})",
+)]
+# Único INSERT que se traduce a escribir(): columnas opcionales y VALUES/SELECT
+_INSERT = re.compile(
+    rf"\s*INSERT\s+INTO\s+{_NOMBRE}\s*(?:\(\s*({_IDENT}(?:\s*,\s*{_IDENT})*)\s*\))?\s*(?=\(|VALUES\b|SELECT\b|WITH\b|FROM\b)(.*?)[\s;]*",
+    re.IGNORECASE | re.DOTALL,
+)
+_SIN_SOPORTE = re.compile(r"\b(?:ON\s+CONFLICT|RETURNING)\b", re.IGNORECASE)
+
+
+def _quitar_comillas(nombre: str) -> str:
+    return nombre[1:-1] if len(nombre) > 1 and nombre[0] == nombre[-1] == '"' else nombre
+
+
+def _literal(texto: str) -> str:
+    # Literal SQL en línea: pasar parámetros de Python a DuckDB cuesta más
+    # que la propia (de)serialización de una consulta corta
+    return "'" + texto.replace("'", "''") + "'"
+
+
+def _min_max(stats: Optional[Dict[str, Dict[str, Any]]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    # min/max por columna de las column_statistics de COPY ... RETURN_STATS
+    minimos, maximos = {}, {}
+    for columna, valores in (stats or {}).items():
+        columna = _quitar_comillas(columna)
+        if "min" in valores:
+            minimos[columna] = valores["min"]
+        if "max" in valores:
+            maximos[columna] = valores["max"]
+    return minimos, maximos
+
+
+class VentasLake:
+    """
+    iceberg_space.ventas como lago de ficheros Parquet particionados por
+    mes de `fecha` (mes=YYYY-MM/) y, opcionalmente, por bucket de hash de
+    `producto` (bucket=N/).
+
+    El manifiesto (_manifest.json) es la lista autorizada de ficheros, con
+    filas, tamaño y min/max por columna de cada uno; se reemplaza de forma
+    atómica y su número de versión sube con cada escritura. Lo que no está
+    en el manifiesto (ficheros a medio escribir) no se lee nunca.
+
+    reescribir() sustituye cada referencia a la tabla en un SELECT por un
+    read_parquet() de solo los ficheros cuyo rango de fechas (y de
+    productos) se solapa con los filtros de su WHERE, usando el árbol
+    sintáctico de DuckDB (json_serialize_sql); si no puede, deja la
+    consulta como está y responde la vista de compatibilidad.
+    """
+
+    def __init__(self, root: str = VENTAS_LAKE_DIR, buckets: int = VENTAS_BUCKETS,
+                 tabla: str = TABLA):
+        self.root = os.path.abspath(root)
+        self.buckets = buckets
+        self.tabla = tabla
+        self.schema, self.nombre = tabla.split(".")
+        self._manifiesto: Dict[str, Any] = {"version": 0, "ficheros": []}
+        self._clave: Optional[Tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._plantillas: Dict[Tuple, Dict[str, Any]] = {}
+        self.consultas = 0
+        self.ficheros_leidos = 0
+        self.ficheros_podados = 0
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Manifiesto
+    # —————————————————————————————————————————————————————————————————————————
+    @property
+    def ruta_manifiesto(self) -> str:
+        return os.path.join(self.root, _MANIFIESTO)
+
+    def existe(self) -> bool:
+        return os.path.exists(self.ruta_manifiesto)
+
+    def manifiesto(self) -> Dict[str, Any]:
+        # Se relee solo si el fichero cambió (os.replace cambia el inodo)
+        try:
+            st = os.stat(self.ruta_manifiesto)
+        except FileNotFoundError:
+            return {"version": 0, "ficheros": []}
+        clave = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if clave != self._clave:
+                with open(self.ruta_manifiesto, encoding="utf-8") as f:
+                    self._manifiesto = json.load(f)
+                self._clave = clave
+            return self._manifiesto
+
+    def version(self) -> str:
+        return str(self.manifiesto()["version"])
+
+    @contextmanager
+    def _bloqueo(self) -> Iterator[None]:
+        # Exclusión entre procesos escritores (broker, ingesta)
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "_manifest.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _guardar(self, manifiesto: Dict[str, Any]):
+        tmp = f"{self.ruta_manifiesto}.{uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifiesto, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta_manifiesto)
+
+    def _leer_disco(self) -> Dict[str, Any]:
+        try:
+            with open(self.ruta_manifiesto, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                "version": 0,
+                "particion": {"mes": "fecha", "buckets": self.buckets, "bucket": "producto"},
+                "ficheros": [],
+            }
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Escritura
+    # —————————————————————————————————————————————————————————————————————————
+    def escribir(self, con: duckdb.DuckDBPyConnection, fuente: str,
+                 lote: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Añade al lago las filas del SELECT `fuente` (columnas fecha,
+        producto, cantidad, precio) en ficheros nuevos, marcados con `lote`
+        si se indica. Devuelve {"ficheros", "filas", "version"}.
+        """
+        staging, nuevos = self._copiar(con, fuente)
+        if lote is not None:
+            for fichero in nuevos:
+                fichero["lote"] = lote
+        try:
+            with self._bloqueo():
+                version = self._publicar(nuevos)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return {"ficheros": len(nuevos), "filas": sum(f["filas"] for f in nuevos), "version": version}
+
+    def insercion(self, sql: str) -> Optional[str]:
+        """
+        SELECT con las filas que añade `sql` si es un INSERT INTO sobre la
+        tabla (VALUES o SELECT, con o sin lista de columnas), listo para
+        escribir(); None si `sql` no modifica la tabla. El lago solo admite
+        añadir ficheros: cualquier otra modificación de la tabla (UPDATE,
+        DELETE, TRUNCATE, INSERT OR REPLACE, ON CONFLICT, RETURNING o un
+        INSERT junto a otras sentencias) lanza ValueError.
+        """
+        try:
+            sentencias = [s.query for s in duckdb.extract_statements(sql)]
+        except Exception:
+            return None  # DuckDB dará el error de sintaxis
+        destino = [s for s in sentencias if self._modifica(s)]
+        if not destino:
+            return None
+        if len(sentencias) > 1:
+            raise ValueError(f"{self.tabla} es un lago de solo inserción: "
+                             f"el INSERT debe enviarse como sentencia única")
+        encaje = _INSERT.fullmatch(destino[0])
+        if encaje is None or _SIN_SOPORTE.search(self._sin_literales(destino[0])):
+            raise ValueError(f"{self.tabla} es un lago de solo inserción: solo admite "
+                             f"INSERT INTO {self.tabla} [(columnas)] VALUES/SELECT ...")
+        todas = [c for c, _ in COLUMNAS]
+        columnas = todas
+        if encaje.group(1) is not None:
+            columnas = [_quitar_comillas(c.strip()).lower() for c in encaje.group(1).split(",")]
+            extra = [c for c in columnas if c not in todas]
+            if extra or len(set(columnas)) != len(columnas):
+                raise ValueError(f"Columnas no válidas para {self.tabla}: {', '.join(columnas)}")
+        # Las columnas que no se indican quedan a NULL, como en la tabla; el
+        # salto de línea cierra un posible comentario final de la consulta
+        lista = ", ".join(c if c in columnas else f"NULL AS {c}" for c in todas)
+        return f"SELECT {lista} FROM ({encaje.group(2)}\n) AS filas({', '.join(columnas)})"
+
+    def _modifica(self, sentencia: str) -> bool:
+        texto = self._sin_literales(sentencia)
+        for patron in _DESTINOS:
+            encaje = patron.search(texto)
+            if encaje is None:
+                continue
+            partes = [_quitar_comillas(p.strip()).lower() for p in encaje.group(1).split(".")]
+            if partes[-2:] == [self.schema, self.nombre]:
+                return True
+        return False
+
+    @staticmethod
+    def _sin_literales(sql: str) -> str:
+        # Sin el contenido de las cadenas ni los comentarios, que no son SQL
+        sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+        return re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.DOTALL)
+
+    def inicializar(self, con: duckdb.DuckDBPyConnection, legado: Optional[str] = None) -> bool:
+        """
+        Crea el manifiesto si no existe e importa las filas de la tabla
+        DuckDB `legado` si se indica y aún no están en el lago (lote
+        LOTE_IMPORTADA), también si otro proceso creó antes el manifiesto.
+        True si la ha importado ahora.
+        """
+        with self._bloqueo():
+            manifiesto = self._leer_disco()
+            importada = any(f.get("lote") == LOTE_IMPORTADA for f in manifiesto["ficheros"])
+            if legado is None or importada:
+                if not self.existe():
+                    self._publicar([])
+                return False
+            staging, nuevos = self._copiar(con, f"SELECT * FROM {legado}")
+            try:
+                for fichero in nuevos:
+                    fichero["lote"] = LOTE_IMPORTADA
+                self._publicar(nuevos)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        return True
+
+    def importada(self) -> bool:
+        """True si las filas de la tabla DuckDB anterior ya están en el lago."""
+        return LOTE_IMPORTADA in self.lotes()
+
+    def lotes(self) -> Set[str]:
+        """Lotes publicados en el manifiesto (ver escribir(lote=...))."""
+        return {f["lote"] for f in self.manifiesto()["ficheros"] if "lote" in f}
+
+    def _copiar(self, con: duckdb.DuckDBPyConnection, fuente: str) -> Tuple[str, List[Dict[str, Any]]]:
+        # COPY ... PARTITION_BY a un directorio temporal; después cada fichero
+        # se mueve a su partición definitiva (aún invisible: no está en el manifiesto)
+        staging = os.path.join(self.root, "_staging", uuid4().hex)
+        os.makedirs(os.path.dirname(staging), exist_ok=True)
+        columnas = ", ".join(f"CAST({c} AS {t}) AS {c}" for c, t in COLUMNAS)
+        particion = "strftime(fecha, '%Y-%m') AS mes"
+        claves = "mes"
+        if self.buckets > 0:
+            particion += f", {self._bucket_sql('producto')} AS bucket"
+            claves += ", bucket"
+        filas = con.execute(
+            f"COPY (SELECT *, {particion} FROM (SELECT {columnas} FROM ({fuente}) AS fuente)) "
+            f"TO {_literal(staging)} (FORMAT parquet, PARTITION_BY ({claves}), "
+            f"FILENAME_PATTERN 'part-{{uuid}}', RETURN_STATS true)"
+        ).fetchall()
+        nuevos = []
+        for fichero, filas_fichero, tamaño, _, stats, claves_particion in filas:
+            ruta = os.path.relpath(fichero, staging)
+            destino = os.path.join(self.root, ruta)
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(fichero, destino)
+            minimos, maximos = _min_max(stats)
+            nuevos.append({"ruta": ruta, "filas": filas_fichero, "bytes": tamaño,
+                           "particion": dict(claves_particion or {}),
+                           "min": minimos, "max": maximos})
+        return staging, nuevos
+
+    def _publicar(self, nuevos: List[Dict[str, Any]]) -> int:
+        # Requiere el bloqueo: relee el manifiesto, añade y lo reemplaza
+        manifiesto = self._leer_disco()
+        manifiesto["ficheros"].extend(nuevos)
+        manifiesto["version"] += 1
+        self._guardar(manifiesto)
+        return manifiesto["version"]
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Lectura con poda de ficheros
+    # —————————————————————————————————————————————————————————————————————————
+    def ficheros(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+                 productos: Optional[Set[str]] = None) -> Tuple[List[str], int]:
+        """
+        Rutas de los ficheros que pueden contener filas con fecha en
+        [desde, hasta] y producto en `productos` (None = sin filtro), y el
+        total de ficheros del lago.
+        """
+        manifiesto = self.manifiesto()
+        todos = manifiesto["ficheros"]
+        buckets = None
+        n = manifiesto.get("particion", {}).get("buckets", 0)
+        if productos is not None and n > 0:
+            buckets = {str(b) for b in self._buckets(productos, n)}
+        elegidos = [os.path.join(self.root, f["ruta"]) for f in todos
+                    if self._solapa(f, desde, hasta, productos, buckets)]
+        return elegidos, len(todos)
+
+    def _bucket_sql(self, expr: str, buckets: Optional[int] = None) -> str:
+        return f"md5_number({expr}) % {buckets or self.buckets}"
+
+    def _buckets(self, productos: Set[str], buckets: int) -> List[int]:
+        con = self._con()
+        return [b for (b,) in con.execute(
+            f"SELECT DISTINCT {self._bucket_sql('p', buckets)} FROM unnest(?) AS t(p)", [sorted(productos)]
+        ).fetchall()]
+
+    @staticmethod
+    def _solapa(fichero: Dict[str, Any], desde: Optional[str], hasta: Optional[str],
+                productos: Optional[Set[str]], buckets: Optional[Set[str]]) -> bool:
+        # Sin estadística (p. ej. todo NULL) no se puede descartar
+        minimo, maximo = fichero["min"].get("fecha"), fichero["max"].get("fecha")
+        if desde is not None and maximo is not None and maximo < desde:
+            return False
+        if hasta is not None and minimo is not None and minimo > hasta:
+            return False
+        bucket = fichero.get("particion", {}).get("bucket") or ""
+        if buckets is not None and bucket.isdigit() and bucket not in buckets:
+            return False
+        if productos is not None:
+            minimo, maximo = fichero["min"].get("producto"), fichero["max"].get("producto")
+            if minimo is not None and maximo is not None:
+                return any(minimo <= p <= maximo for p in productos)
+        return True
+
+    def sql_vista(self) -> str:
+        """CREATE VIEW de compatibilidad sobre todos los ficheros del lago."""
+        return f"CREATE OR REPLACE VIEW {self.tabla} AS SELECT * FROM {self._origen(self.ficheros()[0])}"
+
+    def _origen(self, ficheros: List[str], columnas: Tuple = COLUMNAS) -> str:
+        if ficheros:
+            # Sin hive_partitioning: mes/bucket no son columnas de la tabla
+            lista = ", ".join(_literal(f) for f in ficheros)
+            return f"read_parquet([{lista}], hive_partitioning = false)"
+        vacia = ", ".join(f"NULL::{t} AS {c}" for c, t in columnas)
+        return f"(SELECT {vacia} WHERE false)"
+
+    def _con(self) -> duckdb.DuckDBPyConnection:
+        # Conexión en memoria por hilo, solo para (de)serializar SQL
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = duckdb.connect()
+        return con
+
+    def _serializar(self, sql: str) -> Dict[str, Any]:
+        return json.loads(self._con().execute(f"SELECT json_serialize_sql({_literal(sql)})").fetchone()[0])
+
+    def _deserializar(self, arbol: Dict[str, Any]) -> str:
+        return self._con().execute(f"SELECT json_deserialize_sql({_literal(json.dumps(arbol))})").fetchone()[0]
+
+    def reescribir(self, sql: str) -> Tuple[str, Optional[Dict[str, int]]]:
+        """
+        (sql, {"ficheros": leídos, "total": del lago}) con las referencias a
+        la tabla sustituidas por los ficheros que hacen falta; (sql, None)
+        si la consulta no usa el lago o no se puede reescribir.
+        """
+        if self.nombre not in sql.lower() or not self.existe():
+            return sql, None
+        try:
+            arbol = self._serializar(sql)
+        except Exception:
+            return sql, None
+        if arbol.get("error"):
+            return sql, None
+
+        # 1) Límites de fecha/producto del WHERE de cada SELECT que lee la tabla
+        #    directamente (sin joins: así el filtro afecta a todas sus filas)
+        limites: Dict[int, Tuple] = {}
+        for nodo in self._nodos(arbol):
+            if nodo.get("type") == "SELECT_NODE" and self._es_tabla(nodo.get("from_table")):
+                tabla = nodo["from_table"]
+                limites[id(tabla)] = self._limites(nodo.get("where_clause"), tabla.get("alias") or "")
+
+        # 2) Sustituir cada referencia por un read_parquet de sus ficheros
+        leidos, total, cambios = 0, 0, 0
+        for padre in self._nodos(arbol):
+            for clave, valor in list(padre.items()):
+                if not self._es_tabla(valor):
+                    continue
+                ficheros, total = self.ficheros(*limites.get(id(valor), (None, None, None)))
+                padre[clave] = self._nodo_origen(ficheros, valor)
+                leidos += len(ficheros)
+                cambios += 1
+        if not cambios:
+            return sql, None
+        try:
+            nuevo = self._deserializar(arbol)
+        except Exception:
+            return sql, None
+        with self._lock:
+            self.consultas += 1
+            self.ficheros_leidos += leidos
+            self.ficheros_podados += total * cambios - leidos
+        return nuevo, {"ficheros": leidos, "total": total * cambios}
+
+    @staticmethod
+    def _nodos(arbol: Any) -> Iterator[Dict[str, Any]]:
+        pendientes = [arbol]
+        while pendientes:
+            actual = pendientes.pop()
+            if isinstance(actual, dict):
+                yield actual
+                pendientes.extend(actual.values())
+            elif isinstance(actual, list):
+                pendientes.extend(actual)
+
+    def _es_tabla(self, nodo: Any) -> bool:
+        return (
+            isinstance(nodo, dict) and nodo.get("type") == "BASE_TABLE"
+            and str(nodo.get("table_name", "")).lower() == self.nombre
+            and str(nodo.get("schema_name", "")).lower() == self.schema
+        )
+
+    def _nodo_origen(self, ficheros: List[str], original: Dict[str, Any],
+                     columnas: Tuple = COLUMNAS) -> Dict[str, Any]:
+        # Nodo FROM equivalente: read_parquet([...]) o la subconsulta vacía
+        # (con `columnas`), copiado de una plantilla serializada una sola vez
+        con_ficheros = bool(ficheros)
+        clave = (True,) if con_ficheros else (False, columnas)
+        plantilla = self._plantillas.get(clave)
+        if plantilla is None:
+            sql = f"SELECT * FROM {self._origen(['x'] if con_ficheros else [], columnas)} AS t"
+            plantilla = self._plantillas[clave] = self._serializar(sql)["statements"][0]["node"]["from_table"]
+        nodo = copy.deepcopy(plantilla)
+        if con_ficheros:
+            lista = nodo["function"]["children"][0]
+            constante = lista["children"][0]
+            lista["children"] = []
+            for fichero in ficheros:
+                hijo = dict(constante, value=dict(constante["value"], value=fichero))
+                lista["children"].append(hijo)
+        nodo["alias"] = original.get("alias") or self.nombre
+        nodo["column_name_alias"] = original.get("column_name_alias", [])
+        nodo["sample"] = original.get("sample")
+        return nodo
+
+    # — análisis del WHERE —
+    def _limites(self, where: Any, alias: str) -> Tuple[Optional[str], Optional[str], Optional[Set[str]]]:
+        desde = hasta = None
+        productos: Optional[Set[str]] = None
+        for conj in self._conjunciones(where):
+            for columna, op, valores in self._comparaciones(conj, alias):
+                if columna == "fecha":
+                    fechas = [f for f in (self._fecha(v) for v in valores) if f is not None]
+                    if len(fechas) != len(valores):
+                        continue
+                    if op in ("COMPARE_GREATERTHAN", "COMPARE_GREATERTHANOREQUALTO",
+                              "COMPARE_EQUAL", "COMPARE_IN"):
+                        desde = max(filter(None, (desde, min(fechas))))
+                    if op in ("COMPARE_LESSTHAN", "COMPARE_LESSTHANOREQUALTO",
+                              "COMPARE_EQUAL", "COMPARE_IN"):
+                        hasta = min(filter(None, (hasta, max(fechas))))
+                elif columna == "producto" and op in ("COMPARE_EQUAL", "COMPARE_IN"):
+                    if all(isinstance(v, str) for v in valores):
+                        productos = set(valores) if productos is None else productos & set(valores)
+        return desde, hasta, productos
+
+    @classmethod
+    def _conjunciones(cls, nodo: Any) -> Iterator[Dict[str, Any]]:
+        if not isinstance(nodo, dict):
+            return
+        if nodo.get("type") == "CONJUNCTION_AND":
+            for hijo in nodo.get("children", []):
+                yield from cls._conjunciones(hijo)
+        else:
+            yield nodo
+
+    def _comparaciones(self, nodo: Dict[str, Any], alias: str) -> Iterator[Tuple[str, str, List[Any]]]:
+        # (columna, operador, [valores constantes]) de un predicado simple
+        tipo = nodo.get("type")
+        if tipo == "COMPARE_BETWEEN":
+            columna = self._columna(nodo.get("input"), alias)
+            bajo, alto = self._constante(nodo.get("lower")), self._constante(nodo.get("upper"))
+            if columna and bajo is not None and alto is not None:
+                yield columna, "COMPARE_GREATERTHANOREQUALTO", [bajo]
+                yield columna, "COMPARE_LESSTHANOREQUALTO", [alto]
+        elif tipo in _RANGO:
+            izquierda, derecha = nodo.get("left"), nodo.get("right")
+            columna, valor = self._columna(izquierda, alias), self._constante(derecha)
+            if columna is None:  # constante a la izquierda: '2024-04-01' <= fecha
+                columna, valor, tipo = self._columna(derecha, alias), self._constante(izquierda), _INVERSA[tipo]
+            if columna and valor is not None:
+                yield columna, tipo, [valor]
+        elif tipo == "COMPARE_IN":
+            hijos = nodo.get("children", [])
+            columna = self._columna(hijos[0], alias) if hijos else None
+            valores = [self._constante(h) for h in hijos[1:]]
+            if columna and valores and all(v is not None for v in valores):
+                yield columna, tipo, valores
+
+    def _columna(self, nodo: Any, alias: str) -> Optional[str]:
+        if not isinstance(nodo, dict) or nodo.get("type") != "COLUMN_REF":
+            return None
+        *prefijo, columna = [n.lower() for n in nodo.get("column_names", [])]
+        validos = ([], [alias.lower()] if alias else [self.nombre], [self.schema, self.nombre])
+        return columna if prefijo in validos else None
+
+    @classmethod
+    def _constante(cls, nodo: Any) -> Any:
+        if not isinstance(nodo, dict):
+            return None
+        if nodo.get("type") == "OPERATOR_CAST":
+            return cls._constante(nodo.get("child"))
+        if nodo.get("type") == "VALUE_CONSTANT" and not nodo["value"].get("is_null"):
+            return nodo["value"].get("value")
+        return None
+
+    @staticmethod
+    def _fecha(valor: Any) -> Optional[str]:
+        # Solo se acota con literales de fecha ISO; cualquier otra cosa no poda
+        if not isinstance(valor, str):
+            return None
+        try:
+            return date.fromisoformat(valor.strip()[:10]).isoformat()
+        except ValueError:
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        manifiesto = self.manifiesto()
+        ficheros = manifiesto["ficheros"]
+        with self._lock:
+            return {
+                "version": manifiesto["version"],
+                "ficheros": len(ficheros),
+                "filas": sum(f["filas"] for f in ficheros),
+                "bytes": sum(f["bytes"] for f in ficheros),
+                "particiones": len({os.path.dirname(f["ruta"]) for f in ficheros}),
+                "buckets": manifiesto.get("particion", {}).get("buckets", self.buckets),
+                "consultas_reescritas": self.consultas,
+                "ficheros_leidos": self.ficheros_leidos,
+                "ficheros_podados": self.ficheros_podados,
+            }
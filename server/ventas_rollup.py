@@ -0,0 +1,415 @@
+# server/ventas_rollup.py
+
+import copy
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from uuid import uuid4
+
+import duckdb
+
+from ventas_lake import VENTAS_LAKE_DIR, VentasLake, _literal, _min_max
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Directorio del rollup diario × producto (Parquet + manifiesto propio)
+VENTAS_ROLLUP_DIR = os.getenv("VENTAS_ROLLUP_DIR", os.path.join(VENTAS_LAKE_DIR, "_rollup"))
+# Con más ficheros que estos, el siguiente refresco los compacta en uno
+VENTAS_ROLLUP_COMPACT = int(os.getenv("VENTAS_ROLLUP_COMPACT", "16"))
+# Segundos que se conservan los ficheros compactados (consultas en curso)
+VENTAS_ROLLUP_RETAIN = float(os.getenv("VENTAS_ROLLUP_RETAIN", "300"))
+
+# Una fila por (fecha, producto) y refresco: filas = count(*),
+# cantidad = sum(cantidad), importe = sum(cantidad * precio)
+COLUMNAS_ROLLUP = (("fecha", "DATE"), ("producto", "VARCHAR"), ("filas", "BIGINT"),
+                   ("cantidad", "BIGINT"), ("importe", "DOUBLE"))
+_AGREGAR = (
+    "SELECT fecha, producto, CAST(sum(filas) AS BIGINT) AS filas, "
+    "CAST(sum(cantidad) AS BIGINT) AS cantidad, sum(importe) AS importe "
+    "FROM ({fuente}) GROUP BY fecha, producto"
+)
+_DESDE_VENTAS = (
+    "SELECT fecha, producto, 1 AS filas, cantidad, cantidad * precio AS importe FROM {origen}"
+)
+_MANIFIESTO = "_manifest.json"
+# Columnas por las que el rollup agrupa: fuera de los agregados solo se
+# pueden usar estas (o alias del SELECT que no choquen con otras columnas)
+_GRUPO = {"fecha", "producto"}
+_OCUPADOS = {"cantidad", "precio", "filas", "importe"}
+
+
+class VentasRollup:
+    """
+    Rollup diario × producto de iceberg_space.ventas (número de filas, suma
+    de cantidad y de cantidad*precio), mantenido de forma incremental a
+    partir del manifiesto del lago.
+
+    Como el lago solo añade ficheros, cada refresco agrega únicamente los
+    que se han publicado desde el anterior y escribe un fichero de rollup
+    más; cuando hay demasiados se compactan en uno. Un rollup con varias
+    filas para el mismo (fecha, producto) sigue siendo correcto: todos los
+    agregados que se sirven desde él se pueden volver a agregar.
+
+    reescribir() sustituye la tabla por el rollup en los SELECT de agregación
+    que solo agrupan y filtran por fecha/producto y cuyos agregados son
+    count(*), sum(cantidad), sum(cantidad * precio), min/max o count(DISTINCT)
+    de fecha/producto; solo mientras el rollup está al día con el lago.
+    """
+
+    def __init__(self, lago: VentasLake, root: str = VENTAS_ROLLUP_DIR,
+                 compactar: int = VENTAS_ROLLUP_COMPACT, retener: float = VENTAS_ROLLUP_RETAIN):
+        self.lago = lago
+        self.root = os.path.abspath(root)
+        self.compactar = compactar
+        self.retener = retener
+        self._manifiesto: Dict[str, Any] = self._vacio()
+        self._clave: Optional[Tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+        self._plantillas: Dict[str, Dict[str, Any]] = {}
+        self._funciones: Optional[Tuple[Set[str], Set[str]]] = None
+        self.consultas = 0
+        self.refrescos = 0
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Manifiesto
+    # —————————————————————————————————————————————————————————————————————————
+    @property
+    def ruta_manifiesto(self) -> str:
+        return os.path.join(self.root, _MANIFIESTO)
+
+    @staticmethod
+    def _vacio() -> Dict[str, Any]:
+        # fuente: versión del lago agregada; cubiertos: ficheros del lago
+        # (en orden de publicación) que ya están en el rollup
+        return {"version": 0, "fuente": 0, "cubiertos": 0, "ficheros": [], "retirados": []}
+
+    def manifiesto(self) -> Dict[str, Any]:
+        try:
+            st = os.stat(self.ruta_manifiesto)
+        except FileNotFoundError:
+            return self._vacio()
+        clave = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if clave != self._clave:
+                with open(self.ruta_manifiesto, encoding="utf-8") as f:
+                    self._manifiesto = json.load(f)
+                self._clave = clave
+            return self._manifiesto
+
+    def al_dia(self) -> bool:
+        """True si el rollup refleja la versión actual del lago."""
+        if not self.lago.existe():
+            return False
+        return self.manifiesto()["fuente"] == self.lago.manifiesto()["version"]
+
+    @contextmanager
+    def _bloqueo(self) -> Iterator[None]:
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "_manifest.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _leer_disco(self) -> Dict[str, Any]:
+        try:
+            with open(self.ruta_manifiesto, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self._vacio()
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Refresco incremental
+    # —————————————————————————————————————————————————————————————————————————
+    def refrescar(self) -> Optional[Dict[str, Any]]:
+        """
+        Agrega al rollup los ficheros del lago publicados desde el último
+        refresco. None si ya estaba al día; si no, {"ficheros" (del lago
+        agregados), "filas" (del rollup escritas), "compactado", "version"}.
+        """
+        if not self.lago.existe():
+            return None
+        with self._bloqueo():
+            manifiesto = self._leer_disco()
+            lago = self.lago.manifiesto()
+            if manifiesto["fuente"] == lago["version"]:
+                return None
+            if lago["version"] < manifiesto["fuente"] or len(lago["ficheros"]) < manifiesto["cubiertos"]:
+                # El lago se ha recreado: el rollup se reconstruye desde cero
+                manifiesto = dict(self._vacio(), version=manifiesto["version"],
+                                  retirados=manifiesto.get("retirados", []) + [
+                                      {"ruta": f["ruta"], "desde": time.time()} for f in manifiesto["ficheros"]
+                                  ])
+            nuevos = lago["ficheros"][manifiesto["cubiertos"]:]
+            con = duckdb.connect()
+            try:
+                escritos = []
+                if nuevos:
+                    rutas = [os.path.join(self.lago.root, f["ruta"]) for f in nuevos]
+                    fuente = _DESDE_VENTAS.format(origen=self.lago._origen(rutas))
+                    escritos.append(self._escribir(con, _AGREGAR.format(fuente=fuente)))
+                ficheros = manifiesto["ficheros"] + escritos
+                compactado = len(ficheros) > self.compactar
+                if compactado:
+                    origen = self.lago._origen([os.path.join(self.root, f["ruta"]) for f in ficheros])
+                    ficheros = [self._escribir(con, _AGREGAR.format(fuente=f"SELECT * FROM {origen}"))]
+                    manifiesto["retirados"] = manifiesto.get("retirados", []) + [
+                        {"ruta": f["ruta"], "desde": time.time()} for f in manifiesto["ficheros"] + escritos
+                    ]
+            finally:
+                con.close()
+            manifiesto.update(
+                version=manifiesto["version"] + 1, fuente=lago["version"],
+                cubiertos=len(lago["ficheros"]), ficheros=ficheros,
+            )
+            manifiesto["retirados"] = self._purgar(manifiesto.get("retirados", []))
+            self._guardar(manifiesto)
+        with self._lock:
+            self.refrescos += 1
+        return {"ficheros": len(nuevos), "filas": sum(f["filas"] for f in escritos),
+                "compactado": compactado, "version": manifiesto["version"]}
+
+    def _escribir(self, con: duckdb.DuckDBPyConnection, fuente: str) -> Dict[str, Any]:
+        # Un fichero Parquet con el resultado de `fuente` (aún fuera del manifiesto)
+        ruta = f"part-{uuid4().hex}.parquet"
+        columnas = ", ".join(f"CAST({c} AS {t}) AS {c}" for c, t in COLUMNAS_ROLLUP)
+        _, filas, tamaño, _, stats, _ = con.execute(
+            f"COPY (SELECT {columnas} FROM ({fuente})) TO {_literal(os.path.join(self.root, ruta))} "
+            f"(FORMAT parquet, RETURN_STATS true)"
+        ).fetchone()
+        minimos, maximos = _min_max(stats)
+        return {"ruta": ruta, "filas": filas, "bytes": tamaño, "particion": {},
+                "min": minimos, "max": maximos}
+
+    def _purgar(self, retirados: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Borra los ficheros compactados hace más de `retener` segundos
+        limite, quedan = time.time() - self.retener, []
+        for fichero in retirados:
+            if fichero["desde"] > limite:
+                quedan.append(fichero)
+                continue
+            try:
+                os.remove(os.path.join(self.root, fichero["ruta"]))
+            except FileNotFoundError:
+                pass
+        return quedan
+
+    def _guardar(self, manifiesto: Dict[str, Any]):
+        tmp = f"{self.ruta_manifiesto}.{uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifiesto, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta_manifiesto)
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Reescritura de consultas de agregación
+    # —————————————————————————————————————————————————————————————————————————
+    def reescribir(self, sql: str) -> Tuple[str, Optional[Dict[str, int]]]:
+        """
+        (sql, {"consultas": SELECT servidos por el rollup, "ficheros": leídos})
+        con esos SELECT leyendo del rollup; (sql, None) si ninguno encaja o
+        el rollup no está al día. El resto de referencias a la tabla quedan
+        como estaban (para VentasLake.reescribir).
+        """
+        if self.lago.nombre not in sql.lower() or not self.al_dia():
+            return sql, None
+        try:
+            arbol = self.lago._serializar(sql)
+        except Exception:
+            return sql, None
+        if arbol.get("error"):
+            return sql, None
+
+        servidas, leidos = 0, 0
+        for nodo in list(self.lago._nodos(arbol)):
+            if nodo.get("type") != "SELECT_NODE" or not self.lago._es_tabla(nodo.get("from_table")):
+                continue
+            try:
+                cambios = self._agregados(nodo)
+            except Exception:
+                cambios = None
+            if cambios is None:
+                continue
+            tabla = nodo["from_table"]
+            alias = tabla.get("alias") or ""
+            # Los elementos del SELECT sin alias conservan el nombre de columna original
+            for elemento in nodo["select_list"]:
+                if not elemento.get("alias") and any(o is not n and self._contiene(elemento, o)
+                                                     for o, n in cambios):
+                    elemento["alias"] = self._nombre(elemento)
+            for original, nuevo in cambios:
+                if original is not nuevo:
+                    alias_original = original.get("alias", "")
+                    original.clear()
+                    original.update(nuevo, alias=alias_original)
+            ficheros = self.ficheros(*self.lago._limites(nodo.get("where_clause"), alias))
+            nodo["from_table"] = self.lago._nodo_origen(ficheros, tabla, COLUMNAS_ROLLUP)
+            servidas += 1
+            leidos += len(ficheros)
+        if not servidas:
+            return sql, None
+        try:
+            nuevo = self.lago._deserializar(arbol)
+        except Exception:
+            return sql, None
+        with self._lock:
+            self.consultas += 1
+        return nuevo, {"consultas": servidas, "ficheros": leidos}
+
+    def ficheros(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+                 productos: Optional[Set[str]] = None) -> List[str]:
+        return [os.path.join(self.root, f["ruta"]) for f in self.manifiesto()["ficheros"]
+                if VentasLake._solapa(f, desde, hasta, productos, None)]
+
+    def _agregados(self, nodo: Dict[str, Any]) -> Optional[List[Tuple[Dict, Dict]]]:
+        """
+        [(nodo de agregado, su equivalente sobre el rollup)] si el SELECT se
+        puede responder desde el rollup; None si no.
+        """
+        tabla = nodo["from_table"]
+        if tabla.get("sample") or nodo.get("sample") or nodo.get("qualify"):
+            return None
+        alias = tabla.get("alias") or ""
+        nombres = {e["alias"].lower() for e in nodo["select_list"] if e.get("alias")} - _GRUPO - _OCUPADOS
+        cambios: List[Tuple[Dict, Dict]] = []
+        # WHERE y GROUP BY se evalúan por fila: ahí no caben agregados
+        for parte in (nodo.get("where_clause"), nodo.get("group_expressions")):
+            sin_agregados: List[Tuple[Dict, Dict]] = []
+            if not self._apto(parte, alias, nombres, sin_agregados) or sin_agregados:
+                return None
+        for parte in (nodo["select_list"], nodo.get("having"), nodo.get("modifiers")):
+            if not self._apto(parte, alias, nombres, cambios):
+                return None
+        distinct = any(m.get("type") == "DISTINCT_MODIFIER" for m in nodo.get("modifiers", []))
+        # Sin agregación (filas sueltas) el rollup no sirve: cada fila es un grupo
+        if not (cambios or nodo.get("group_expressions") or distinct):
+            return None
+        return cambios
+
+    def _apto(self, expr: Any, alias: str, nombres: Set[str],
+              cambios: List[Tuple[Dict, Dict]]) -> bool:
+        # La expresión solo usa columnas de grupo, alias y agregados reescribibles
+        if isinstance(expr, list):
+            return all(self._apto(e, alias, nombres, cambios) for e in expr)
+        if not isinstance(expr, dict):
+            return True
+        tipo = expr.get("type")
+        tipo = tipo if isinstance(tipo, str) else ""
+        if tipo == "FUNCTION":
+            nombre = expr.get("function_name", "").lower()
+            escalares, agregadas = self._tipos_funcion()
+            if nombre in agregadas and not expr.get("schema"):
+                equivalente = self._equivalente(expr, alias, nombres)
+                if equivalente is None:
+                    return False
+                cambios.append((expr, equivalente))
+                return True
+            if not expr.get("is_operator") and nombre not in escalares:
+                return False
+        elif tipo == "COLUMN_REF":
+            partes = [n.lower() for n in expr.get("column_names", [])]
+            if len(partes) == 1 and partes[0] in nombres:
+                return True
+            return len(partes) <= 2 and self.lago._columna(expr, alias) in _GRUPO
+        elif tipo in ("SUBQUERY", "STAR", "LAMBDA") or tipo.startswith("WINDOW"):
+            return False
+        return all(self._apto(v, alias, nombres, cambios)
+                   for v in expr.values() if isinstance(v, (dict, list)))
+
+    def _equivalente(self, expr: Dict[str, Any], alias: str, nombres: Set[str]) -> Optional[Dict[str, Any]]:
+        # El agregado equivalente sobre el rollup (el mismo nodo si no cambia)
+        if expr.get("export_state") or expr.get("order_bys", {}).get("orders"):
+            return None
+        filtro, hijos = expr.get("filter"), expr.get("children", [])
+        sin_agregados: List[Tuple[Dict, Dict]] = []
+        if filtro is not None and (not self._apto(filtro, alias, nombres, sin_agregados) or sin_agregados):
+            return None
+        nombre, distinct = expr["function_name"].lower(), expr.get("distinct")
+        if nombre == "count_star" and not hijos:
+            equivalente = self._plantilla("CAST(COALESCE(sum(filas), 0) AS BIGINT)")
+        elif nombre == "sum" and not distinct and len(hijos) == 1:
+            columnas = self._producto(hijos[0], alias)
+            if columnas == ["cantidad"]:
+                return expr
+            if columnas != ["cantidad", "precio"]:
+                return None
+            equivalente = self._plantilla("sum(importe)")
+        elif (nombre in ("min", "max") or (nombre == "count" and distinct)) and len(hijos) == 1:
+            # No dependen de cuántas veces se repite cada valor
+            if not self._apto(hijos[0], alias, set(), sin_agregados) or sin_agregados:
+                return None
+            return expr
+        else:
+            return None
+        if filtro is not None:
+            # FILTER va en el sum() de la plantilla, no en el CAST que lo envuelve
+            for nodo in VentasLake._nodos(equivalente):
+                if nodo.get("type") == "FUNCTION" and nodo.get("function_name") == "sum":
+                    nodo["filter"] = filtro
+        return equivalente
+
+    def _producto(self, expr: Dict[str, Any], alias: str) -> Optional[List[str]]:
+        # ["cantidad"] para cantidad; ["cantidad", "precio"] para cantidad * precio
+        if expr.get("type") == "COLUMN_REF":
+            return [self.lago._columna(expr, alias)] if len(expr.get("column_names", [])) <= 2 else None
+        if expr.get("type") == "FUNCTION" and expr.get("function_name") == "*" and expr.get("is_operator"):
+            factores = [self._producto(h, alias) for h in expr.get("children", [])]
+            if len(factores) == 2 and all(f is not None and len(f) == 1 for f in factores):
+                return sorted(f[0] for f in factores)
+        return None
+
+    def _plantilla(self, sql: str) -> Dict[str, Any]:
+        plantilla = self._plantillas.get(sql)
+        if plantilla is None:
+            arbol = self.lago._serializar(f"SELECT {sql}")
+            plantilla = self._plantillas[sql] = arbol["statements"][0]["node"]["select_list"][0]
+        return copy.deepcopy(plantilla)
+
+    def _nombre(self, elemento: Dict[str, Any]) -> str:
+        # Nombre de columna que DuckDB da a una expresión sin alias (su ToString)
+        arbol = self._plantilla_select()
+        arbol["statements"][0]["node"]["select_list"] = [elemento]
+        return self.lago._deserializar(arbol)[len("SELECT "):]
+
+    def _plantilla_select(self) -> Dict[str, Any]:
+        plantilla = self._plantillas.get("")
+        if plantilla is None:
+            plantilla = self._plantillas[""] = self.lago._serializar("SELECT 1")
+        return copy.deepcopy(plantilla)
+
+    @staticmethod
+    def _contiene(arbol: Any, buscado: Dict[str, Any]) -> bool:
+        return any(nodo is buscado for nodo in VentasLake._nodos(arbol))
+
+    def _tipos_funcion(self) -> Tuple[Set[str], Set[str]]:
+        # (escalares y macros, agregadas) del catálogo de DuckDB; una función
+        # desconocida no se reescribe, podría ser un agregado
+        if self._funciones is None:
+            filas = self.lago._con().execute(
+                "SELECT DISTINCT function_name, function_type FROM duckdb_functions() "
+                "WHERE function_type IN ('scalar', 'macro', 'aggregate')"
+            ).fetchall()
+            agregadas = {n.lower() for n, t in filas if t == "aggregate"}
+            self._funciones = ({n.lower() for n, t in filas if t != "aggregate"} - agregadas, agregadas)
+        return self._funciones
+
+    def stats(self) -> Dict[str, Any]:
+        manifiesto = self.manifiesto()
+        al_dia = self.al_dia()
+        with self._lock:
+            return {
+                "version": manifiesto["version"],
+                "version_lago": manifiesto["fuente"],
+                "al_dia": al_dia,
+                "ficheros": len(manifiesto["ficheros"]),
+                "filas": sum(f["filas"] for f in manifiesto["ficheros"]),
+                "refrescos": self.refrescos,
+                "consultas_reescritas": self.consultas,
+            }
@@ -0,0 +1,119 @@
+# server/wire_codec.py
+
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # sin orjson se usa el json de la librería estándar
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # sin msgpack solo se ofrece JSON
+    msgpack = None
+
+# —————————————————————————————————————————————————————————————————————————————
+# CONFIGURACIÓN DESDE ENTORNO
+# —————————————————————————————————————————————————————————————————————————————
+# Codec con el que un agente envía sus envelopes: json | msgpack
+A2A_CODEC = os.getenv("A2A_CODEC", "json").lower()
+
+JSON_MEDIA = "application/json"
+MSGPACK_MEDIA = "application/msgpack"
+
+# Tipos de envelope que el broker sabe enrutar
+TIPOS = frozenset({"query", "response", "heartbeat", "ack"})
+
+
+class Codec:
+    """Codificación de envelopes en el cable, identificada por su media type."""
+
+    def __init__(self, nombre: str, media_type: str, binario: bool):
+        self.nombre = nombre
+        self.media_type = media_type
+        self.binario = binario      # en WebSocket: frame binario o de texto
+
+    def encode(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    def __init__(self):
+        super().__init__("json", JSON_MEDIA, binario=False)
+
+    def encode(self, obj: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators=(",", ":"), default=str).encode()
+
+    def decode(self, data: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    def __init__(self):
+        super().__init__("msgpack", MSGPACK_MEDIA, binario=True)
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, default=str)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: Dict[str, Codec] = {"json": JSONCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+_POR_MEDIA = {c.media_type: c for c in CODECS.values()}
+if msgpack is not None:
+    _POR_MEDIA["application/x-msgpack"] = CODECS["msgpack"]
+
+
+def codec(nombre: str = A2A_CODEC) -> Codec:
+    """Codec por nombre; si no está disponible (p. ej. falta msgpack), JSON."""
+    return CODECS.get(nombre) or CODECS["json"]
+
+
+def codec_para(content_type: Optional[str]) -> Codec:
+    """
+    Codec correspondiente a una cabecera Content-Type. Sin cabecera se
+    asume JSON; un media type desconocido lanza ValueError.
+    """
+    media = (content_type or JSON_MEDIA).split(";")[0].strip().lower()
+    c = _POR_MEDIA.get(media)
+    if c is None:
+        raise ValueError(f"Content-Type no soportado: {content_type}")
+    return c
+
+
+def cabecera(obj: Any) -> Tuple[str, str, str, str, str]:
+    """
+    Campos de enrutado de un envelope ya decodificado, sin validar su
+    payload: (message_id, type, sender, recipient, clave de orden). La
+    clave es el correlation_id del sobre o del mensaje interno, o el propio
+    message_id. Lanza ValueError si falta algún campo de cabecera.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("el envelope debe ser un objeto")
+    try:
+        message_id, tipo = obj["message_id"], obj["type"]
+        sender, recipient = obj["sender"], obj["recipient"]
+        payload = obj["payload"]
+    except KeyError as e:
+        raise ValueError(f"falta el campo {e.args[0]!r} en el envelope")
+    if not all(isinstance(v, str) and v for v in (message_id, sender, recipient)):
+        raise ValueError("message_id, sender y recipient deben ser cadenas no vacías")
+    if tipo not in TIPOS:
+        raise ValueError(f"tipo de envelope inválido: {tipo!r}")
+    if not isinstance(payload, dict):
+        raise ValueError("payload debe ser un objeto")
+    body = payload.get("body")
+    corr = obj.get("correlation_id") or (body.get("correlation_id") if isinstance(body, dict) else None)
+    return message_id, tipo, sender, recipient, str(corr or message_id)
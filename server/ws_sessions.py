@@ -0,0 +1,68 @@
+# server/ws_sessions.py
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import WebSocket
+
+from wire_codec import JSON_MEDIA
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class WebSocketSessions:
+    """
+    Sesiones WebSocket persistentes de los agentes conectados al broker.
+
+    Como mucho una sesión por agent_id (una reconexión sustituye a la
+    anterior). push() envía un envelope ya codificado por la sesión del
+    agente si la hay (JSON como frame de texto, el resto como binario); si
+    no, devuelve False y el llamante usa el callback HTTP. Los envíos de
+    una misma sesión se serializan con un lock, porque un WebSocket no
+    admite escrituras concurrentes.
+    """
+
+    def __init__(self):
+        self._sesiones: Dict[str, Tuple[WebSocket, asyncio.Lock]] = {}
+        self.enviados = 0
+        self.recibidos = 0
+
+    def add(self, agent_id: str, ws: WebSocket) -> Optional[WebSocket]:
+        """Registra la sesión y devuelve la anterior del agente, si había."""
+        anterior = self._sesiones.get(agent_id)
+        self._sesiones[agent_id] = (ws, asyncio.Lock())
+        return anterior[0] if anterior else None
+
+    def remove(self, agent_id: str, ws: WebSocket):
+        actual = self._sesiones.get(agent_id)
+        if actual is not None and actual[0] is ws:
+            del self._sesiones[agent_id]
+
+    def __contains__(self, agent_id: str) -> bool:
+        return agent_id in self._sesiones
+
+    async def push(self, agent_id: str, datos: bytes, media_type: str = JSON_MEDIA) -> bool:
+        sesion = self._sesiones.get(agent_id)
+        if sesion is None:
+            return False
+        ws, lock = sesion
+        try:
+            async with lock:
+                if media_type == JSON_MEDIA:
+                    await ws.send_text(datos.decode())
+                else:
+                    await ws.send_bytes(datos)
+        except Exception as e:
+            logger.warning(f"[WS] sesión de {agent_id} caída al enviar: {e}")
+            self.remove(agent_id, ws)
+            return False
+        self.enviados += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conectados": sorted(self._sesiones),
+            "enviados": self.enviados,
+            "recibidos": self.recibidos,
+        }
@@ -0,0 +1,117 @@
+# utils/batching.py
+
+import os
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+# —————————————————————————————————————————————————————————————————————————————
+# Configuración
+# —————————————————————————————————————————————————————————————————————————————
+# Prompts máximos por llamada a model.generate
+GEN_BATCH_MAX_SIZE = int(os.getenv("GEN_BATCH_MAX_SIZE", "4"))
+# Milisegundos que se espera a que lleguen más prompts antes de lanzar el lote
+GEN_BATCH_MAX_WAIT_MS = float(os.getenv("GEN_BATCH_MAX_WAIT_MS", "20"))
+
+
+class _Peticion:
+    def __init__(self, prompt: str, kwargs: Dict[str, Any]):
+        self.prompt = prompt
+        self.kwargs = kwargs
+        # Solo se agrupan prompts con los mismos parámetros de generación
+        self.grupo = tuple(sorted(kwargs.items()))
+        self.future: Future = Future()
+
+
+class BatchScheduler:
+    """
+    Planificador de micro-lotes para model.generate.
+
+    Los prompts que llegan dentro de una ventana de GEN_BATCH_MAX_WAIT_MS se
+    agrupan (hasta GEN_BATCH_MAX_SIZE) en un único lote con padding a la
+    izquierda, y cada petición recibe su texto decodificado a través de un
+    Future. Un solo hilo ejecuta el modelo, de modo que las peticiones
+    concurrentes no compiten por los mismos hilos de torch.
+    """
+
+    def __init__(self, model, tokenizer,
+                 max_batch: int = GEN_BATCH_MAX_SIZE,
+                 max_wait_ms: float = GEN_BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self._cola: "queue.Queue[_Peticion]" = queue.Queue()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self.lotes = 0
+        self.prompts = 0
+
+    def submit(self, prompt: str, **kwargs) -> Future:
+        """
+        Encola un prompt; el Future devuelve el texto completo decodificado
+        (prompt + generación), igual que tokenizer.decode(output[0]).
+        """
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, daemon=True)
+                self._hilo.start()
+        peticion = _Peticion(prompt, kwargs)
+        self._cola.put(peticion)
+        return peticion.future
+
+    def generate(self, prompt: str, **kwargs) -> str:
+        return self.submit(prompt, **kwargs).result()
+
+    def _recoger(self) -> List[_Peticion]:
+        lote = [self._cola.get()]
+        limite = time.monotonic() + self.max_wait
+        while len(lote) < self.max_batch:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self._cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _bucle(self):
+        while True:
+            lote = self._recoger()
+            grupos: Dict[Tuple, List[_Peticion]] = {}
+            for peticion in lote:
+                grupos.setdefault(peticion.grupo, []).append(peticion)
+            for peticiones in grupos.values():
+                self._ejecutar(peticiones)
+
+    def _ejecutar(self, peticiones: List[_Peticion]):
+        try:
+            self.tokenizer.padding_side = "left"
+            inputs = self.tokenizer(
+                [p.prompt for p in peticiones], return_tensors="pt", padding=True
+            ).to(self.model.device)
+            with torch.inference_mode():
+                output = self.model.generate(
+                    **inputs,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **peticiones[0].kwargs
+                )
+            textos = self.tokenizer.batch_decode(output, skip_special_tokens=True)
+            self.lotes += 1
+            self.prompts += len(peticiones)
+            logging.info(f"[Batching] lote de {len(peticiones)} prompts generado")
+            for peticion, texto in zip(peticiones, textos):
+                peticion.future.set_result(texto)
+        except Exception as e:
+            logging.error(f"[Batching] error generando lote: {e}")
+            for peticion in peticiones:
+                if not peticion.future.done():
+                    peticion.future.set_exception(e)
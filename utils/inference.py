@@ -0,0 +1,81 @@
+# utils/inference.py
+
+import os
+import logging
+from typing import Tuple
+
+import torch
+from transformers import AutoModelForCausalLM
+
+# —————————————————————————————————————————————————————————————————————————————
+# Configuración
+# —————————————————————————————————————————————————————————————————————————————
+# Precisión de inferencia: fp32 | bf16 | int8 | auto (bf16 si la CPU lo soporta)
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "fp32").lower()
+# Hilos intra-op de torch (0 = valor por defecto de torch, un hilo por núcleo)
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+# Hilos inter-op de torch (0 = valor por defecto de torch)
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "0"))
+
+PRECISIONES = ("fp32", "bf16", "int8", "auto")
+
+
+def configurar_hilos(intra: int = TORCH_NUM_THREADS, inter: int = TORCH_INTEROP_THREADS):
+    """
+    Fija los hilos de torch. Debe llamarse antes de ejecutar el modelo:
+    torch no permite cambiar los hilos inter-op una vez usados.
+    """
+    if intra > 0:
+        torch.set_num_threads(intra)
+    if inter > 0:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError as e:
+            logging.warning(f"[Inferencia] no se pudieron fijar los hilos inter-op: {e}")
+    logging.info(
+        f"[Inferencia] hilos torch intra-op={torch.get_num_threads()} "
+        f"inter-op={torch.get_num_interop_threads()}"
+    )
+
+
+def cpu_soporta_bf16() -> bool:
+    """
+    True si la CPU tiene instrucciones bf16 nativas (AVX512-BF16 o AMX);
+    sin ellas bf16 se emula y suele ser más lento que fp32.
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return torch.backends.mkldnn.is_available() and (
+        "avx512_bf16" in flags or "amx_bf16" in flags
+    )
+
+
+def cargar_modelo(nombre: str, precision: str = INFERENCE_PRECISION) -> Tuple[torch.nn.Module, str]:
+    """
+    Carga el modelo en CPU con la precisión pedida y devuelve
+    (modelo, precisión efectiva).
+      - fp32: pesos y cálculo en float32 (comportamiento original)
+      - bf16: pesos en bfloat16; si la CPU no lo soporta se usa fp32
+      - int8: cuantización dinámica int8 de las capas Linear
+    """
+    if precision not in PRECISIONES:
+        raise ValueError(f"INFERENCE_PRECISION inválida: {precision} (válidas: {PRECISIONES})")
+    if precision == "auto":
+        precision = "bf16" if cpu_soporta_bf16() else "fp32"
+    if precision == "bf16" and not cpu_soporta_bf16():
+        logging.warning("[Inferencia] la CPU no soporta bf16 nativo; se usa fp32")
+        precision = "fp32"
+
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(nombre, torch_dtype=dtype)
+    model.to(torch.device("cpu"))
+    model.eval()
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    logging.info(f"[Inferencia] modelo {nombre} cargado en {precision}")
+    return model, precision
@@ -3,18 +3,53 @@
 import re
 import os
 import json
+import time
 import logging
+import threading
 import requests
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from typing import Iterator, Optional
+from transformers import AutoTokenizer, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 import torch
 
+from utils.batching import BatchScheduler
+from utils.inference import cargar_modelo, configurar_hilos
+from utils.prefix_cache import PrefixCache
+from utils.sql_grammar import SQLGrammarLogitsProcessor, StopOnStatementEnd, estado_sql, extraer_sentencia
+
 # —————————————————————————————————————————————————————————————————————————————
 # Carga del modelo TinyLlama en CPU
+# (INFERENCE_PRECISION, TORCH_NUM_THREADS, TORCH_INTEROP_THREADS)
 # —————————————————————————————————————————————————————————————————————————————
 modelo = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+configurar_hilos()
 tokenizer = AutoTokenizer.from_pretrained(modelo)
-model = AutoModelForCausalLM.from_pretrained(modelo, torch_dtype=torch.float32)
-model.to(torch.device("cpu"))
+model, precision = cargar_modelo(modelo)
+
+# —————————————————————————————————————————————————————————————————————————————
+# Micro-batching de model.generate entre peticiones concurrentes
+# (GEN_BATCHING, GEN_BATCH_MAX_SIZE, GEN_BATCH_MAX_WAIT_MS)
+# —————————————————————————————————————————————————————————————————————————————
+GEN_BATCHING = os.getenv("GEN_BATCHING", "1") == "1"
+scheduler = BatchScheduler(model, tokenizer) if GEN_BATCHING else None
+
+def _generar(prompt: str, agrupar: bool = True, **kwargs) -> str:
+    """
+    Genera texto para `prompt` y lo devuelve decodificado (prompt incluido),
+    pasando por el planificador de lotes si está activo y `agrupar` es True.
+    """
+    if scheduler is not None and agrupar:
+        return scheduler.generate(prompt, **kwargs)
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    output = model.generate(**inputs, **kwargs)
+    return tokenizer.decode(output[0], skip_special_tokens=True)
+
+# —————————————————————————————————————————————————————————————————————————————
+# KV cache del prefijo estático del prompt SQL (PREFIX_CACHE)
+# —————————————————————————————————————————————————————————————————————————————
+# Las generaciones con prefijo cacheado no pasan por el planificador de lotes:
+# cada una parte de su propia copia del KV cache.
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "1") == "1"
+prefix_cache = PrefixCache(model, tokenizer) if PREFIX_CACHE else None
 
 # —————————————————————————————————————————————————————————————————————————————
 # Logging
@@ -29,16 +64,68 @@ logging.basicConfig(
 )
 
 # —————————————————————————————————————————————————————————————————————————————
+# Metadatos de la tabla (productos y rango de fechas)
+# —————————————————————————————————————————————————————————————————————————————
+MCP_URL = os.getenv("MCP_URL", "http://mcp-server:8000")
+# Segundos durante los que se usan los metadatos locales sin revalidar con el MCP
+METADATA_TTL = float(os.getenv("METADATA_TTL", "30"))
+
+_metadata: dict = {}
+_metadata_etag = None
+_metadata_revalidar = 0.0
+_metadata_lock = threading.Lock()
+
 def extraer_info_tabla():
-    try:
-        productos_resp = requests.get("http://mcp-server:8000/tool/info/productos")
-        fechas_resp    = requests.get("http://mcp-server:8000/tool/info/fechas")
-        productos = productos_resp.json().get("productos", [])
-        fechas    = fechas_resp.json()
-        return productos, fechas.get("min_fecha", ""), fechas.get("max_fecha", "")
-    except Exception as e:
-        logging.error(f"Error metadatos MCP: {e}")
-        return [], "", ""
+    """
+    Devuelve (productos, min_fecha, max_fecha) desde una copia local que solo
+    se descarga de nuevo cuando cambia la versión (ETag) de los datos.
+    """
+    global _metadata, _metadata_etag, _metadata_revalidar
+    with _metadata_lock:
+        if _metadata and time.monotonic() < _metadata_revalidar:
+            return _tupla_metadata()
+        try:
+            headers = {"If-None-Match": _metadata_etag} if _metadata_etag else {}
+            resp = requests.get(f"{MCP_URL}/tool/info/metadata", headers=headers, timeout=5)
+            if resp.status_code != 304:
+                resp.raise_for_status()
+                data = resp.json()
+                if "error" in data:
+                    raise RuntimeError(data["error"])
+                _metadata = data
+                _metadata_etag = resp.headers.get("ETag")
+                logging.info(f"[Metadatos] versión {data.get('version')} descargada")
+            _metadata_revalidar = time.monotonic() + METADATA_TTL
+        except Exception as e:
+            logging.error(f"Error metadatos MCP: {e}")
+        if not _metadata:
+            return [], "", ""
+        return _tupla_metadata()
+
+def _tupla_metadata():
+    # Con la tabla vacía el MCP devuelve las fechas a null
+    return _metadata["productos"], _metadata["min_fecha"] or "", _metadata["max_fecha"] or ""
+
+# —————————————————————————————————————————————————————————————————————————————
+# Decodificación del SQL (SQL_DECODING)
+#   gramatica: greedy, restringida al subconjunto SQL válido para el catálogo
+#              y detenida en el primer ';' de una sentencia completa
+#   muestreo:  muestreo libre (temperature=0.7) + extracción por regex
+# —————————————————————————————————————————————————————————————————————————————
+SQL_DECODING = os.getenv("SQL_DECODING", "gramatica")
+SQL_MAX_NEW_TOKENS = int(os.getenv("SQL_MAX_NEW_TOKENS", "100"))
+
+def _parametros_sql(productos: list):
+    # (parámetros de generate, procesador de la gramática o None)
+    if SQL_DECODING != "gramatica":
+        return dict(max_new_tokens=SQL_MAX_NEW_TOKENS, temperature=0.7, do_sample=True), None
+    gramatica = SQLGrammarLogitsProcessor(tokenizer, productos)
+    return dict(
+        max_new_tokens=SQL_MAX_NEW_TOKENS,
+        do_sample=False,
+        logits_processor=LogitsProcessorList([gramatica]),
+        stopping_criteria=StoppingCriteriaList([StopOnStatementEnd(tokenizer, productos, gramatica)]),
+    ), gramatica
 
 # —————————————————————————————————————————————————————————————————————————————
 def generar_sql(pregunta: str) -> str:
@@ -49,7 +136,8 @@ def generar_sql(pregunta: str) -> str:
     productos, min_fecha, max_fecha = extraer_info_tabla()
     productos_str = ", ".join(f"'{p}'" for p in productos)
 
-    prompt = f"""
+    # Prefijo estático (solo cambia con los metadatos) + sufijo con la pregunta
+    prefijo = f"""
 Eres un experto en SQL con acceso a una tabla llamada iceberg_space.ventas:
 - fecha (DATE)
 - producto (TEXT)
@@ -60,18 +148,30 @@ Usa siempre iceberg_space.ventas.
 Productos: {productos_str}
 Fechas: {min_fecha} a {max_fecha}
 
-❓ Pregunta: {pregunta}
+"""
+    sufijo = f"""❓ Pregunta: {pregunta}
 ✅ SQL:
 """
+    prompt = prefijo + sufijo
     logging.info(f"[SQL Prompt] {prompt}")
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    output = model.generate(
-        **inputs,
-        max_new_tokens=100,
-        temperature=0.7,
-        do_sample=True
-    )
-    respuesta_raw = tokenizer.decode(output[0], skip_special_tokens=True)
+    parametros, gramatica = _parametros_sql(productos)
+    if prefix_cache is not None:
+        respuesta_raw = prefix_cache.generate(prefijo, sufijo, **parametros)
+    else:
+        # La decodificación restringida lleva estado propio: no se agrupa en lotes
+        respuesta_raw = _generar(prompt, agrupar=SQL_DECODING != "gramatica", **parametros)
+
+    # 0) Con gramática, lo generado ya es una sentencia completa y válida,
+    # salvo que se quedara sin tokens válidos y el resto saliera sin restringir
+    if gramatica is not None and gramatica.desbordado:
+        logging.warning("[SQL Generada] la gramática se quedó sin tokens válidos; se extrae con regex")
+    elif gramatica is not None:
+        generado = respuesta_raw.split("SQL:")[-1]
+        if ";" in generado and estado_sql(extraer_sentencia(generado), productos) == "completo":
+            sql = extraer_sentencia(generado)
+            logging.info(f"[SQL Generada] {sql}")
+            return sql
+        logging.warning("[SQL Generada] la gramática no llegó a una sentencia completa")
 
     # 1) Eliminar posibles marcadores de código (```)
     cleaned = respuesta_raw.replace("```", "").strip()
@@ -100,7 +200,7 @@ def consultar_mcp(sql: str):
     """
     try:
         response = requests.get(
-            "http://mcp-server:8000/tool/consulta",
+            f"{MCP_URL}/tool/consulta",
             params={"sql": sql},
             timeout=10
         )
@@ -113,11 +213,7 @@ def consultar_mcp(sql: str):
         return []
 
 # —————————————————————————————————————————————————————————————————————————————
-def generar_respuesta(pregunta: str, datos: list) -> str:
-    """
-    Toma la lista de dicts 'datos' y la pregunta original,
-    genera un prompt y devuelve la respuesta del LLM.
-    """
+def _prompt_respuesta(pregunta: str, datos: list) -> str:
     contexto = json.dumps(datos, indent=2)
     prompt = f"""
 Eres un asistente que responde preguntas de usuarios con datos de una consulta SQL.
@@ -128,12 +224,42 @@ Eres un asistente que responde preguntas de usuarios con datos de una consulta S
 ✍️ Respuesta:
 """
     logging.info(f"[Respuesta Prompt] {prompt}")
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    output = model.generate(
-        **inputs,
-        max_new_tokens=200,
-        temperature=0.5,
-        do_sample=True
-    )
-    respuesta = tokenizer.decode(output[0], skip_special_tokens=True)
+    return prompt
+
+_PARAMETROS_RESPUESTA = dict(max_new_tokens=200, temperature=0.5, do_sample=True)
+
+def generar_respuesta(pregunta: str, datos: list) -> str:
+    """
+    Toma la lista de dicts 'datos' y la pregunta original,
+    genera un prompt y devuelve la respuesta del LLM.
+    """
+    respuesta = _generar(_prompt_respuesta(pregunta, datos), **_PARAMETROS_RESPUESTA)
     return respuesta.strip()
+
+# —————————————————————————————————————————————————————————————————————————————
+class _Cancelada(StoppingCriteria):
+    # Detiene model.generate en el siguiente token una vez fijado el evento
+    def __init__(self, evento: threading.Event):
+        self.evento = evento
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> bool:
+        return self.evento.is_set()
+
+def generar_respuesta_stream(pregunta: str, datos: list,
+                             cancelar: Optional[threading.Event] = None) -> Iterator[str]:
+    """
+    Igual que generar_respuesta, pero devuelve un iterador con los fragmentos
+    de texto de la respuesta (sin el prompt) a medida que el modelo los genera.
+    Al fijar `cancelar` (p. ej. porque el cliente se desconectó) la generación
+    se detiene en el siguiente token y el iterador termina.
+    """
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    inputs = tokenizer(_prompt_respuesta(pregunta, datos), return_tensors="pt").to(model.device)
+    parada = StoppingCriteriaList([_Cancelada(cancelar)] if cancelar is not None else [])
+    hilo = threading.Thread(
+        target=model.generate,
+        kwargs=dict(**inputs, streamer=streamer, stopping_criteria=parada, **_PARAMETROS_RESPUESTA),
+        daemon=True,
+    )
+    hilo.start()
+    return streamer
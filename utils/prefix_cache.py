@@ -0,0 +1,63 @@
+# utils/prefix_cache.py
+
+import copy
+import logging
+import threading
+
+import torch
+
+
+class PrefixCache:
+    """
+    KV cache del prefijo estático de un prompt.
+
+    El prefijo (esquema, productos y fechas en generar_sql) se codifica una
+    sola vez y su past_key_values se reutiliza en cada generación, de modo
+    que el prefill solo procesa los tokens del sufijo (la pregunta). Se
+    recalcula cuando cambia el texto del prefijo, es decir, cuando cambian
+    los metadatos de la tabla.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self._prefijo = None
+        self._ids = None
+        self._kv = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _preparar(self, prefijo: str):
+        # Devuelve (ids del prefijo, copia de su KV cache), recalculándolo si cambió
+        with self._lock:
+            if prefijo != self._prefijo:
+                ids = self.tokenizer(prefijo, return_tensors="pt").input_ids.to(self.model.device)
+                with torch.inference_mode():
+                    out = self.model(input_ids=ids, use_cache=True)
+                self._prefijo, self._ids, self._kv = prefijo, ids, out.past_key_values
+                self.misses += 1
+                logging.info(f"[Prefix Cache] prefijo de {ids.shape[1]} tokens codificado")
+            else:
+                self.hits += 1
+            # generate() amplía la caché que recibe: cada petición usa su copia
+            return self._ids, copy.deepcopy(self._kv)
+
+    def generate(self, prefijo: str, sufijo: str, **kwargs) -> str:
+        """
+        Genera a partir de prefijo + sufijo reutilizando el KV del prefijo.
+        Devuelve el texto decodificado completo, prompt incluido.
+        """
+        prefijo_ids, kv = self._preparar(prefijo)
+        sufijo_ids = self.tokenizer(
+            sufijo, add_special_tokens=False, return_tensors="pt"
+        ).input_ids.to(self.model.device)
+        input_ids = torch.cat([prefijo_ids, sufijo_ids], dim=1)
+        with torch.inference_mode():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=kv,
+                **kwargs
+            )
+        return self.tokenizer.decode(output[0], skip_special_tokens=True)
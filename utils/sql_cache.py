@@ -0,0 +1,172 @@
+# utils/sql_cache.py
+
+import os
+import re
+import json
+import difflib
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+# —————————————————————————————————————————————————————————————————————————————
+# Configuración
+# —————————————————————————————————————————————————————————————————————————————
+# Fichero donde persiste la caché entre reinicios
+SQL_CACHE_PATH = os.getenv(
+    "SQL_CACHE_PATH",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'cache', 'consultas_llm.json'))
+)
+# Entradas máximas por tipo (pregunta→SQL y pregunta+datos→respuesta)
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "1000"))
+# Similitud mínima (0-1) para reutilizar el SQL de una pregunta parecida; 0 = solo exacta
+SQL_CACHE_FUZZY_THRESHOLD = float(os.getenv("SQL_CACHE_FUZZY_THRESHOLD", "0"))
+# Cachear también la respuesta final para una misma pregunta y mismos datos
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+
+
+def normalizar_pregunta(pregunta: str) -> str:
+    """
+    Minúsculas, sin tildes, sin signos de puntuación y con espacios colapsados:
+    "¿Cuál es la venta total?" y "cual es la venta total" comparten clave.
+    """
+    texto = unicodedata.normalize("NFKD", pregunta.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return re.sub(r"\s+", " ", texto).strip()
+
+
+def huella_datos(datos: Any) -> str:
+    # Hash estable del resultado de la consulta
+    canonico = json.dumps(datos, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(canonico.encode("utf-8")).hexdigest()[:16]
+
+
+class CacheConsultas:
+    """
+    Caché LRU persistente del LLM agent:
+      - pregunta normalizada → SQL generado
+      - pregunta normalizada + hash de los datos → respuesta final
+    Se guarda en un fichero JSON tras cada alta, de forma atómica.
+    """
+
+    def __init__(self, path: str = SQL_CACHE_PATH,
+                 max_entries: int = SQL_CACHE_MAX_ENTRIES,
+                 fuzzy_threshold: float = SQL_CACHE_FUZZY_THRESHOLD,
+                 respuestas: bool = ANSWER_CACHE):
+        self.path = path
+        self.max_entries = max_entries
+        self.fuzzy_threshold = fuzzy_threshold
+        self.respuestas_activas = respuestas
+        self.sql: "OrderedDict[str, str]" = OrderedDict()
+        self.respuestas: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cargar()
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Pregunta → SQL
+    # —————————————————————————————————————————————————————————————————————————
+    def get_sql(self, pregunta: str) -> Optional[str]:
+        clave = normalizar_pregunta(pregunta)
+        with self._lock:
+            if clave not in self.sql and self.fuzzy_threshold > 0:
+                parecidas = difflib.get_close_matches(
+                    clave, self.sql.keys(), n=1, cutoff=self.fuzzy_threshold
+                )
+                if parecidas:
+                    logging.info(f"[Cache SQL] '{clave}' ≈ '{parecidas[0]}'")
+                    clave = parecidas[0]
+            sql = self.sql.get(clave)
+            if sql is None:
+                self.misses += 1
+                return None
+            self.sql.move_to_end(clave)
+            self.hits += 1
+            return sql
+
+    def put_sql(self, pregunta: str, sql: str):
+        self._put(self.sql, normalizar_pregunta(pregunta), sql)
+
+    def descartar_sql(self, pregunta: str, sql: str):
+        """
+        Quita `sql` de la caché (p. ej. porque falló al ejecutarse): el de
+        la pregunta y el de cualquier pregunta parecida que lo devolviera.
+        """
+        clave = normalizar_pregunta(pregunta)
+        with self._lock:
+            claves = [k for k, v in self.sql.items() if k == clave or v == sql]
+            for k in claves:
+                del self.sql[k]
+            if claves:
+                logging.info(f"[Cache SQL] descartado '{clave}': {sql}")
+                self._guardar()
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Pregunta + datos → respuesta
+    # —————————————————————————————————————————————————————————————————————————
+    def get_respuesta(self, pregunta: str, datos: Any) -> Optional[str]:
+        if not self.respuestas_activas:
+            return None
+        clave = f"{normalizar_pregunta(pregunta)}|{huella_datos(datos)}"
+        with self._lock:
+            respuesta = self.respuestas.get(clave)
+            if respuesta is not None:
+                self.respuestas.move_to_end(clave)
+            return respuesta
+
+    def put_respuesta(self, pregunta: str, datos: Any, respuesta: str):
+        if self.respuestas_activas:
+            self._put(self.respuestas, f"{normalizar_pregunta(pregunta)}|{huella_datos(datos)}", respuesta)
+
+    # —————————————————————————————————————————————————————————————————————————
+    # Persistencia
+    # —————————————————————————————————————————————————————————————————————————
+    def _put(self, tabla: "OrderedDict[str, str]", clave: str, valor: str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            tabla[clave] = valor
+            tabla.move_to_end(clave)
+            while len(tabla) > self.max_entries:
+                tabla.popitem(last=False)
+            self._guardar()
+
+    def _cargar(self):
+        if self.max_entries <= 0:
+            return  # caché desactivada: ni siquiera lo ya guardado
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            # Las listas se guardan de menos a más reciente
+            self.sql = OrderedDict(data.get("sql", [])[-self.max_entries:])
+            self.respuestas = OrderedDict(data.get("respuestas", [])[-self.max_entries:])
+            logging.info(f"[Cache SQL] {len(self.sql)} consultas cargadas de {self.path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"[Cache SQL] no se pudo cargar {self.path}: {e}")
+
+    def _guardar(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"sql": list(self.sql.items()),
+                           "respuestas": list(self.respuestas.items())}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logging.error(f"[Cache SQL] no se pudo guardar {self.path}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "sql": len(self.sql),
+                "respuestas": len(self.respuestas),
+                "fuzzy_threshold": self.fuzzy_threshold,
+            }
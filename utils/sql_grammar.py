@@ -0,0 +1,510 @@
+# utils/sql_grammar.py
+
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+# —————————————————————————————————————————————————————————————————————————————
+# Catálogo conocido
+# —————————————————————————————————————————————————————————————————————————————
+TABLA = "ICEBERG_SPACE.VENTAS"
+COLUMNAS = {"FECHA", "PRODUCTO", "CANTIDAD", "PRECIO"}
+AGREGADOS = {"SUM", "AVG", "COUNT", "MIN", "MAX"}
+FUNCIONES_FECHA = {"YEAR", "MONTH", "DAY"}
+PARTES_FECHA = ["year", "quarter", "month", "week", "day"]
+COMPARADORES = {"=", "!=", "<>", "<", "<=", ">", ">="}
+ARITMETICOS = {"+", "-", "*", "/"}
+RESERVADAS = {"SELECT", "DISTINCT", "FROM", "WHERE", "GROUP", "ORDER", "BY", "LIMIT", "AS",
+              "ASC", "DESC", "AND", "OR", "NOT", "BETWEEN", "IN", "LIKE"}
+_PLANTILLA_FECHA = "dddd-dd-dd"
+# Tipo del resultado de cada nombre; "?" = el de su argumento (MIN, MAX)
+_TIPO_NOMBRE = {
+    "FECHA": "fecha", "PRODUCTO": "texto", "CANTIDAD": "numero", "PRECIO": "numero",
+    "SUM": "numero", "AVG": "numero", "COUNT": "numero", "MIN": "?", "MAX": "?",
+    "YEAR": "numero", "MONTH": "numero", "DAY": "numero", "DATE_TRUNC": "fecha",
+}
+
+
+class Incompleto(Exception):
+    """El texto es un prefijo válido de una sentencia aún sin terminar."""
+
+
+class Invalido(Exception):
+    """El texto no puede extenderse hasta una sentencia válida."""
+
+
+class _Lexema:
+    __slots__ = ("tipo", "texto", "abierto")
+
+    def __init__(self, tipo: str, texto: str, abierto: bool):
+        self.tipo = tipo      # 'palabra' | 'numero' | 'cadena' | 'simbolo'
+        self.texto = texto
+        self.abierto = abierto  # último lexema, que aún puede crecer
+
+
+def _lexer(texto: str) -> List[_Lexema]:
+    lexemas: List[_Lexema] = []
+    i, n = 0, len(texto)
+    while i < n:
+        c = texto[i]
+        if c.isspace():
+            i += 1
+        elif c == "'":
+            fin = texto.find("'", i + 1)
+            if fin < 0:
+                lexemas.append(_Lexema("cadena", texto[i + 1:], True))
+                i = n
+            else:
+                lexemas.append(_Lexema("cadena", texto[i + 1:fin], False))
+                i = fin + 1
+        elif "0" <= c <= "9":
+            m = re.match(r"[0-9]+(\.[0-9]*)?", texto[i:])
+            i += m.end()
+            lexemas.append(_Lexema("numero", m.group(0), i == n))
+        elif c.isascii() and (c.isalpha() or c == "_"):
+            m = re.match(r"[A-Za-z_][A-Za-z0-9_.]*", texto[i:])
+            i += m.end()
+            lexemas.append(_Lexema("palabra", m.group(0).upper(), i == n))
+        elif texto[i:i + 2] in ("<=", ">=", "<>", "!="):
+            lexemas.append(_Lexema("simbolo", texto[i:i + 2], False))
+            i += 2
+        elif c in "<>!" and i == n - 1:
+            lexemas.append(_Lexema("simbolo", c, True))
+            i += 1
+        elif c in "=<>(),*+-/;":
+            lexemas.append(_Lexema("simbolo", c, False))
+            i += 1
+        else:
+            raise Invalido(f"carácter no permitido: {c!r}")
+    return lexemas
+
+
+class _Parser:
+    """
+    Parser descendente del subconjunto de SQL admitido:
+
+      SELECT [DISTINCT] item (, item)* FROM iceberg_space.ventas
+        [WHERE condición] [GROUP BY expr (, expr)*]
+        [ORDER BY expr [ASC|DESC] (, ...)*] [LIMIT n] ;
+
+    Comprueba también tipos básicos (no se suma texto ni se compara una fecha
+    con un número) y que las columnas sueltas de un SELECT con agregados
+    estén en el GROUP BY. Los tipos se exigen al leer cada nombre, no al
+    cerrar la expresión: un prefijo como "SUM(producto" ya es Invalido, para
+    que la decodificación restringida no entre en callejones sin salida.
+    Tampoco admite agregados en el WHERE, en el GROUP BY ni dentro de otro
+    agregado, ni fechas literales como argumento de una función. La
+    agrupación se valida en cuanto ya no puede llegar un GROUP BY (y tras
+    cada item del ORDER BY). Si la entrada se acaba antes del ';' lanza
+    Incompleto; si algo no encaja, Invalido.
+    """
+
+    def __init__(self, lexemas: List[_Lexema], productos: Set[str]):
+        self.lx = lexemas
+        self.i = 0
+        self.productos = productos
+        self.alias: Set[str] = set()
+        self._tipo_alias: Dict[str, str] = {}
+        # Seguimiento para validar el GROUP BY: items del SELECT (expresión,
+        # alias), los de SELECT y ORDER BY con columnas fuera de un agregado
+        # (expresión, alias, columnas) y expresiones del GROUP BY
+        self._hay_agregado = False
+        self._items: List[tuple] = []
+        self._sueltos: List[tuple] = []
+        self._agrupadas: Set[str] = set()
+        self._agrupado = False
+        self._columnas: Set[str] = set()
+        # WHERE, GROUP BY y argumentos de un agregado: sin agregados
+        self._sin_agregados = False
+        self._en_agregado = 0
+        # GROUP BY y ORDER BY: un texto o fecha literal no agrupa ni ordena
+        self._sin_literales = False
+        self._alias_agregados: Set[str] = set()
+
+    # — primitivas —
+    def _actual(self) -> _Lexema:
+        if self.i >= len(self.lx):
+            raise Incompleto()
+        return self.lx[self.i]
+
+    def acepta(self, opciones: Iterable[str]) -> Optional[str]:
+        lx = self._actual()
+        if lx.tipo not in ("palabra", "simbolo"):
+            return None
+        if lx.abierto:
+            if any(o.startswith(lx.texto) and o != lx.texto for o in opciones):
+                raise Incompleto()
+            if lx.texto not in opciones:
+                return None
+            # Ya es una opción y no puede crecer hasta otra: se da por leído
+            # para comprobar desde ahora lo que venga detrás
+        if lx.texto in opciones:
+            self.i += 1
+            return lx.texto
+        return None
+
+    def espera(self, opciones: Iterable[str]) -> str:
+        opciones = set(opciones)
+        encontrado = self.acepta(opciones)
+        if encontrado is None:
+            raise Invalido(f"se esperaba {sorted(opciones)}")
+        return encontrado
+
+    def cadena(self, permitidas: Optional[Iterable[str]] = None, fecha: bool = False) -> str:
+        # Literal de texto: de `permitidas`, fecha 'AAAA-MM-DD' o libre (permitidas=None)
+        lx = self._actual()
+        if lx.tipo != "cadena":
+            raise Invalido("se esperaba un literal de texto")
+        ok = permitidas is None or (
+            any(p.startswith(lx.texto) for p in permitidas) if lx.abierto
+            else lx.texto in permitidas
+        )
+        es_fecha = fecha and _es_fecha(lx.texto, parcial=lx.abierto)
+        if not ok and not es_fecha:
+            raise Invalido(f"literal no permitido: {lx.texto!r}")
+        if lx.abierto:
+            raise Incompleto()
+        self.i += 1
+        return "fecha" if es_fecha else "texto"
+
+    # — gramática —
+    def sentencia(self):
+        self.espera({"SELECT"})
+        self.acepta({"DISTINCT"})
+        self.lista(self.item_select)
+        self.espera({"FROM"})
+        self.espera({TABLA})
+        if self.acepta({"WHERE"}):
+            self._sin_agregados = True
+            self.condicion()
+            self._sin_agregados = False
+        if self.acepta({"GROUP"}):
+            self.espera({"BY"})
+            self._sin_agregados = True
+            self.lista(self.item_group)
+            self._sin_agregados = False
+            self._agrupado = True
+        # Ya no puede llegar (más) GROUP BY: la agrupación es definitiva
+        self._comprobar_agrupacion()
+        if self.acepta({"ORDER"}):
+            self.espera({"BY"})
+            self.lista(self.item_order)
+        if self.acepta({"LIMIT"}):
+            self.numero()
+        self.espera({";"})
+
+    def _comprobar_agrupacion(self):
+        # Con GROUP BY o agregados, cada columna fuera de un agregado debe
+        # estar agrupada (sola, o como la expresión o el alias completos)
+        if not (self._agrupado or self._hay_agregado):
+            return
+        for expr, alias, columnas in self._sueltos:
+            if expr in self._agrupadas or alias in self._agrupadas:
+                continue
+            if not columnas <= self._agrupadas:
+                raise Invalido("columnas sin agregar fuera del GROUP BY")
+
+    def lista(self, elemento):
+        elemento()
+        while self.acepta({","}):
+            elemento()
+
+    def _texto(self, inicio: int) -> str:
+        return " ".join(lx.texto for lx in self.lx[inicio:self.i])
+
+    def item_select(self):
+        if self.acepta({"*"}):
+            self._items.append(("*", None))
+            self._sueltos.append(("*", None, {"*"}))
+            return
+        inicio, agregado_previo = self.i, self._hay_agregado
+        self._hay_agregado, self._columnas = False, set()
+        tipo = self.expresion()
+        expr, con_agregado = self._texto(inicio), self._hay_agregado
+        self._hay_agregado = self._hay_agregado or agregado_previo
+        alias = None
+        if self.acepta({"AS"}):
+            lx = self._actual()
+            if lx.tipo != "palabra" or "." in lx.texto:
+                raise Invalido("se esperaba un alias")
+            if lx.abierto:
+                raise Incompleto()
+            if lx.texto in RESERVADAS or lx.texto in _TIPO_NOMBRE or lx.texto in self.alias:
+                raise Invalido("se esperaba un alias nuevo")
+            alias = lx.texto
+            self.alias.add(alias)
+            self._tipo_alias[alias] = tipo
+            if con_agregado:
+                self._alias_agregados.add(alias)
+            self.i += 1
+        self._items.append((expr, alias))
+        if self._columnas:
+            self._sueltos.append((expr, alias, self._columnas))
+            self._columnas = set()
+
+    def _posicion(self, inicio: int) -> Optional[tuple]:
+        # Item de GROUP/ORDER BY que es un entero suelto: posición en el SELECT
+        if self.i - inicio != 1 or self.lx[inicio].tipo != "numero":
+            return None
+        texto = self.lx[inicio].texto
+        if "." in texto or any(expr == "*" for expr, _ in self._items):
+            raise Invalido("posición no válida")
+        if not 1 <= int(texto) <= len(self._items):
+            raise Invalido("posición fuera del SELECT")
+        return self._items[int(texto) - 1]
+
+    def item_group(self):
+        inicio, self._sin_literales = self.i, True
+        self.expresion(alias=True)
+        self._sin_literales = False
+        self._agrupadas.add(self._texto(inicio))
+        item = self._posicion(inicio)
+        if item is not None:
+            self._agrupadas.add(item[0])
+
+    def item_order(self):
+        inicio, self._columnas, self._sin_literales = self.i, set(), True
+        try:
+            self.expresion(alias=True)
+            self._sin_literales = False
+        except Incompleto:
+            # A medias: ya no tiene salida si lee columnas sin agrupar y no
+            # puede acabar siendo una expresión del GROUP BY
+            if self._agrupado or self._hay_agregado:
+                self._comprobar_agrupacion()
+                leido = " ".join(lx.texto for lx in self.lx[inicio:])
+                if not (self._columnas <= self._agrupadas
+                        or any(g.startswith(leido) for g in self._agrupadas)):
+                    raise Invalido("columnas sin agregar fuera del GROUP BY")
+            raise
+        if self._posicion(inicio) is None and self._columnas:
+            self._sueltos.append((self._texto(inicio), None, self._columnas))
+            self._columnas = set()
+        self._comprobar_agrupacion()
+        self.acepta({"ASC", "DESC"})
+
+    def numero(self):
+        lx = self._actual()
+        if lx.tipo != "numero":
+            raise Invalido("se esperaba un número")
+        self.i += 1
+
+    def expresion(self, alias: bool = False, esperado: Optional[str] = None) -> str:
+        # `esperado`: tipo que debe tener la expresión (None = cualquiera)
+        tipo = self.termino(alias, esperado)
+        while self.acepta(ARITMETICOS):
+            if tipo not in ("numero", "?"):
+                raise Invalido("aritmética sobre un valor no numérico")
+            self.termino(alias, "numero")
+            tipo = "numero"
+        return tipo
+
+    def termino(self, alias: bool = False, esperado: Optional[str] = None) -> str:
+        lx = self._actual()
+        if lx.tipo == "numero":
+            if esperado not in (None, "numero"):
+                raise Invalido(f"se esperaba {esperado}, no un número")
+            self.i += 1
+            return "numero"
+        if lx.tipo == "cadena":
+            if self._sin_literales:
+                raise Invalido("literal de texto en GROUP BY u ORDER BY")
+            if esperado == "numero":
+                raise Invalido("se esperaba un número, no texto")
+            if esperado == "fecha":
+                # Como argumento, DuckDB no sabe si '2024-01-01' es DATE o texto
+                raise Invalido("fecha literal como argumento de una función")
+            if esperado == "texto":
+                return self.cadena(self.productos)
+            return self.cadena(self.productos, fecha=True)
+        if self.acepta({"("}):
+            tipo = self.expresion(alias, esperado)
+            self.espera({")"})
+            return tipo
+        nombres = COLUMNAS | AGREGADOS | FUNCIONES_FECHA | {"DATE_TRUNC"}
+        if self._sin_agregados:
+            nombres = nombres - AGREGADOS
+        nombres = {n for n in nombres if esperado is None or _TIPO_NOMBRE[n] in (esperado, "?")}
+        if alias:
+            alias_validos = self.alias - self._alias_agregados if self._sin_agregados else self.alias
+            nombres = nombres | {a for a in alias_validos
+                                 if esperado is None or self._tipo_alias[a] in (esperado, "?")}
+        nombre = self.espera(nombres)
+        if nombre in COLUMNAS:
+            if not self._en_agregado:
+                self._columnas.add(nombre)
+            return _TIPO_NOMBRE[nombre]
+        if nombre in self.alias:
+            return self._tipo_alias[nombre]
+        self.espera({"("})
+        if nombre in AGREGADOS:
+            self._hay_agregado = True
+            anidado, self._sin_agregados = self._sin_agregados, True
+            self._en_agregado += 1
+            if nombre == "COUNT" and self.acepta({"*"}):
+                tipo = "numero"
+            else:
+                self.acepta({"DISTINCT"})
+                argumento = "numero" if nombre in ("SUM", "AVG") else None if nombre == "COUNT" else esperado
+                tipo = self.expresion(esperado=argumento)
+                tipo = "numero" if nombre in ("COUNT", "SUM", "AVG") else tipo
+            self._sin_agregados = anidado
+            self._en_agregado -= 1
+        elif nombre in FUNCIONES_FECHA:
+            self.expresion(esperado="fecha")
+            tipo = "numero"
+        else:  # DATE_TRUNC
+            self.cadena(PARTES_FECHA)
+            self.espera({","})
+            self.expresion(esperado="fecha")
+            tipo = "fecha"
+        self.espera({")"})
+        return tipo
+
+    def valor(self, tipo: str):
+        # Operando derecho de una comparación, acorde al tipo del izquierdo
+        if tipo == "fecha":
+            self.cadena([], fecha=True)
+        elif tipo == "texto":
+            self.cadena(self.productos)
+        else:
+            self.expresion(esperado=None if tipo == "?" else "numero")
+
+    def condicion(self):
+        self.predicado()
+        while self.acepta({"AND", "OR"}):
+            self.predicado()
+
+    def predicado(self):
+        if self.acepta({"NOT"}):
+            self.predicado()
+            return
+        if self.acepta({"("}):
+            self.condicion()
+            self.espera({")"})
+            return
+        tipo = self.expresion()
+        operadores = COMPARADORES | {"BETWEEN", "IN"}
+        if tipo in ("texto", "?"):
+            operadores = operadores | {"LIKE"}
+        operador = self.espera(operadores)
+        if operador == "BETWEEN":
+            self.valor(tipo)
+            self.espera({"AND"})
+            self.valor(tipo)
+        elif operador == "IN":
+            self.espera({"("})
+            self.lista(lambda: self.valor(tipo))
+            self.espera({")"})
+        elif operador == "LIKE":
+            self.cadena(None)
+        else:
+            self.valor(tipo)
+
+
+def _es_fecha(texto: str, parcial: bool) -> bool:
+    if len(texto) > len(_PLANTILLA_FECHA) or (not parcial and len(texto) != len(_PLANTILLA_FECHA)):
+        return False
+    if not all((c.isdigit() if p == "d" else c == p) for c, p in zip(texto, _PLANTILLA_FECHA)):
+        return False
+    if len(texto) == len(_PLANTILLA_FECHA):
+        try:
+            datetime.strptime(texto, "%Y-%m-%d")
+        except ValueError:
+            return False
+    return True
+
+
+def estado_sql(texto: str, productos: Iterable[str]) -> str:
+    """
+    'completo' si `texto` es una sentencia válida terminada en ';',
+    'prefijo' si aún puede completarse, 'invalido' en otro caso.
+    """
+    try:
+        lexemas = _lexer(texto)
+        parser = _Parser(lexemas, set(productos))
+        parser.sentencia()
+    except Incompleto:
+        return "prefijo"
+    except Invalido:
+        return "invalido"
+    # Tras el ';' no se admite nada más
+    return "completo" if parser.i == len(lexemas) else "invalido"
+
+
+# —————————————————————————————————————————————————————————————————————————————
+# Decodificación restringida
+# —————————————————————————————————————————————————————————————————————————————
+class SQLGrammarLogitsProcessor(LogitsProcessor):
+    """
+    Restringe cada paso de generación a los tokens que mantienen el texto
+    generado como prefijo válido de la gramática. Solo se examinan los
+    `top_k` tokens más probables (y si ninguno vale, un margen mayor); con
+    decodificación greedy esto equivale a elegir el mejor token válido. Si
+    aun así no hay ninguno, marca `desbordado` y deja de restringir;
+    generar_sql recurre entonces a la extracción por regex.
+    """
+
+    def __init__(self, tokenizer, productos: Iterable[str], top_k: int = 32):
+        self.tokenizer = tokenizer
+        self.productos = list(productos)
+        self.top_k = top_k
+        self.prompt_len: Optional[int] = None
+        self.desbordado = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1]
+        if self.desbordado:
+            return scores  # ya sin restricción: no se vuelve a examinar el vocabulario
+        for fila in range(input_ids.shape[0]):
+            generados = input_ids[fila, self.prompt_len:].tolist()
+            permitidos = self._permitidos(generados, scores[fila])
+            if not permitidos:
+                # Sin salida dentro de la gramática: se deja generar libremente
+                self.desbordado = True
+                continue
+            mascara = torch.full_like(scores[fila], float("-inf"))
+            mascara[permitidos] = 0
+            scores[fila] = scores[fila] + mascara
+        return scores
+
+    def _permitidos(self, generados: List[int], puntuaciones: torch.FloatTensor) -> List[int]:
+        vocab = puntuaciones.shape[-1]
+        for k in (self.top_k, self.top_k * 8):
+            candidatos = torch.topk(puntuaciones, min(k, vocab)).indices.tolist()
+            validos = []
+            for token in candidatos:
+                if token in self.tokenizer.all_special_ids:
+                    continue
+                texto = self.tokenizer.decode(generados + [token], skip_special_tokens=True)
+                if estado_sql(texto, self.productos) != "invalido":
+                    validos.append(token)
+            if validos:
+                return validos
+        return []
+
+
+class StopOnStatementEnd(StoppingCriteria):
+    """
+    Detiene la generación en cuanto el texto generado contiene una
+    sentencia completa (terminada en ';').
+    """
+
+    def __init__(self, tokenizer, productos: Iterable[str], processor: SQLGrammarLogitsProcessor):
+        self.tokenizer = tokenizer
+        self.productos = list(productos)
+        self.processor = processor
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> bool:
+        inicio = self.processor.prompt_len or input_ids.shape[1]
+        texto = self.tokenizer.decode(input_ids[0, inicio:], skip_special_tokens=True)
+        return ";" in texto and estado_sql(texto.split(";")[0] + ";", self.productos) == "completo"
+
+
+def extraer_sentencia(texto: str) -> str:
+    # Sentencia completa generada: hasta el primer ';' incluido
+    return texto.split(";")[0].strip() + ";"